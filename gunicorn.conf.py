@@ -0,0 +1,63 @@
+# Gunicorn configuration, picked up automatically from the working directory.
+import os
+import shutil
+
+# Workers write metric samples here and /metrics merges them. It has to be set,
+# and emptied of a previous master's samples, before prometheus_client is first
+# imported, which happens when the app is preloaded below.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/stuttersense-metrics')
+shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+bind = '0.0.0.0:8000'
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+# Threaded WSGI workers by default. GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker
+# serves stuttersense_v1.asgi instead: request bodies are read on the event
+# loop and the inference views run on a bounded pool (speech/offload.py), but
+# Django runs every other view (auth, jobs, /metrics, admin) on one thread per
+# worker, so only opt in for a tier that serves the inference endpoints. The
+# application is picked to match, so don't also name one on the command line.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+wsgi_app = ('stuttersense_v1.asgi:application' if 'uvicorn' in worker_class.lower()
+            else 'stuttersense_v1.wsgi:application')
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Load Django and the MS-CLAP weights once in the master; forked workers then
+# share the weights copy-on-write instead of each holding a private copy.
+preload_app = os.environ.get('CLAP_PRELOAD', '1') == '1'
+
+
+def pre_fork(server, worker):
+    # Give each worker the lowest slot not held by a live one, so a restarted
+    # worker takes over the cores of the one it replaces
+    taken = {getattr(w, 'cpu_slot', None) for w in server.WORKERS.values()}
+    worker.cpu_slot = next(slot for slot in range(len(taken) + 1) if slot not in taken)
+    worker.cpu_workers = server.num_workers
+
+
+def post_worker_init(worker):
+    # After the app is loaded, so Django settings are available without preload
+    from django.conf import settings
+    if settings.CLAP_INFERENCE_SOCKET:
+        # The inference daemon runs the model; workers never need torch
+        return
+    from speech.cpu import configure_threads
+    from speech.registry import load_pending_backend
+    configure_threads(slot=worker.cpu_slot, workers=worker.cpu_workers)
+    load_pending_backend()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    from django.conf import settings
+    if settings.CLAP_INFERENCE_SOCKET:
+        # run_inference_server warms itself up
+        return
+    from speech.registry import warm_up
+    warm_up()
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import AudioFile, ClassificationPrompt, PredictionSettings
+from .models import AudioFile, ClassificationPrompt, PredictionSettings, PredictionJob, PredictionResult
 from django.utils.html import format_html
 from django.urls import reverse
 from django.http import FileResponse
@@ -55,7 +55,21 @@ class PredictionSettingsAdmin(admin.ModelAdmin):
     list_filter = ['is_active']
     search_fields = ['name']
 
+class PredictionJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'audio_path', 'status', 'worker', 'created_at', 'finished_at']
+    list_filter = ['status']
+    search_fields = ['user__username', 'audio_path']
+    readonly_fields = ['result', 'error', 'worker', 'created_at', 'started_at', 'finished_at']
+
+class PredictionResultAdmin(admin.ModelAdmin):
+    list_display = ['audio_file', 'settings', 'content_hash', 'prompt_fingerprint', 'created_at']
+    list_filter = ['settings']
+    search_fields = ['content_hash', 'audio_file__user__username']
+    readonly_fields = ['audio_file', 'content_hash', 'settings', 'prompt_fingerprint', 'result', 'created_at']
+
 # Register models with the custom admin site
 custom_admin_site.register(AudioFile, AudioFileAdmin)
 custom_admin_site.register(ClassificationPrompt, ClassificationPromptAdmin)
 custom_admin_site.register(PredictionSettings, PredictionSettingsAdmin)
+custom_admin_site.register(PredictionJob, PredictionJobAdmin)
+custom_admin_site.register(PredictionResult, PredictionResultAdmin)
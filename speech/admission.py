@@ -0,0 +1,206 @@
+"""Admission control for the upload and inference endpoints.
+
+Two checks run after authentication, both backed by one small SQLite file
+(ADMISSION_DB_PATH) so every gunicorn worker on the host sees the same
+state:
+
+* TokenBucketThrottle gives each user a bucket of ADMISSION_USER_BURST
+  requests refilled at ADMISSION_USER_RATE per second. An empty bucket gets
+  429 with Retry-After set to when the next token arrives. Views whose cost
+  is only known once the request is read (a batch of uncached files) take
+  the rest with take_tokens().
+* AdmissionControlMixin caps requests in progress across all workers at
+  ADMISSION_MAX_CONCURRENT. Past that the request gets 503 with Retry-After.
+  Slots held by a worker that died are reclaimed the next time the cap is
+  reached.
+
+If the store can't be used, requests are let through and a warning is
+logged: rate limiting should never be the reason the API is down.
+"""
+import os
+import time
+import sqlite3
+import threading
+import logging
+from django.conf import settings
+from rest_framework import status
+from rest_framework.exceptions import APIException, Throttled
+from rest_framework.throttling import BaseThrottle
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS leases (id INTEGER PRIMARY KEY AUTOINCREMENT, pid INTEGER NOT NULL, started REAL NOT NULL);
+"""
+
+# The file may be locked past the timeout, or its directory unwritable
+STORE_ERRORS = (sqlite3.Error, OSError)
+
+
+class ServerBusy(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Too many requests in progress, please retry later'
+    default_code = 'server_busy'
+
+    def __init__(self, wait):
+        super().__init__()
+        # Read by DRF's exception handler to set Retry-After
+        self.wait = wait
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class AdmissionStore:
+    """Token buckets and concurrency leases in a SQLite file shared by local processes."""
+
+    def __init__(self, path, timeout=2.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        # One connection per thread, and never one inherited across fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.executescript(SCHEMA)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _transaction(self, fn):
+        conn = self._connection()
+        # IMMEDIATE takes the write lock up front, so read-modify-write is atomic
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = fn(conn)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return result
+
+    def take(self, key, rate, burst, cost=1.0):
+        """Take ``cost`` tokens from ``key``'s bucket; return 0, or seconds until there are enough."""
+        def take(conn):
+            now = time.time()
+            row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+            wait = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / rate
+            conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                         (key, tokens, now))
+            return wait
+        return self._transaction(take)
+
+    def acquire(self, limit):
+        """Take one of ``limit`` host-wide slots; return its lease id, or None if all are held."""
+        def acquire(conn):
+            held = conn.execute('SELECT COUNT(*) FROM leases').fetchone()[0]
+            if held >= limit:
+                dead = [pid for (pid,) in conn.execute('SELECT DISTINCT pid FROM leases') if not _pid_alive(pid)]
+                if dead:
+                    logger.warning(f"Reclaiming admission slots of dead processes {dead}")
+                    conn.executemany('DELETE FROM leases WHERE pid = ?', [(pid,) for pid in dead])
+                    held = conn.execute('SELECT COUNT(*) FROM leases').fetchone()[0]
+            if held >= limit:
+                return None
+            return conn.execute('INSERT INTO leases (pid, started) VALUES (?, ?)',
+                                (os.getpid(), time.time())).lastrowid
+        return self._transaction(acquire)
+
+    def release(self, lease_id):
+        self._connection().execute('DELETE FROM leases WHERE id = ?', (lease_id,))
+
+    def in_progress(self):
+        return self._connection().execute('SELECT COUNT(*) FROM leases').fetchone()[0]
+
+
+_store = None
+
+
+def get_admission_store():
+    global _store
+    if _store is None or _store.path != settings.ADMISSION_DB_PATH:
+        _store = AdmissionStore(settings.ADMISSION_DB_PATH)
+    return _store
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """Per-user token bucket; ``cost`` tokens per request."""
+    cost = 1.0
+
+    def allow_request(self, request, view):
+        self.delay = 0.0
+        rate, burst = settings.ADMISSION_USER_RATE, settings.ADMISSION_USER_BURST
+        if rate <= 0:
+            return True
+        if request.user and request.user.is_authenticated:
+            key = f'user:{request.user.pk}'
+        else:
+            key = f'ip:{self.get_ident(request)}'
+        # A request costing more than the bucket holds would never get through
+        cost = min(self.cost, burst)
+        try:
+            self.delay = get_admission_store().take(key, rate, burst, cost)
+        except STORE_ERRORS as e:
+            logger.warning(f"Admission store unavailable, not throttling: {e}")
+            return True
+        return self.delay == 0
+
+    def wait(self):
+        return self.delay
+
+
+def take_tokens(request, cost):
+    """Take ``cost`` more tokens from the user's bucket; raise Throttled if it can't cover them."""
+    if cost <= 0:
+        return
+    throttle = TokenBucketThrottle()
+    throttle.cost = cost
+    if not throttle.allow_request(request, None):
+        raise Throttled(wait=throttle.wait())
+
+
+class AdmissionControlMixin:
+    """Holds one host-wide slot of ADMISSION_MAX_CONCURRENT for the duration of the request."""
+
+    def initial(self, request, *args, **kwargs):
+        self._admission_lease = None
+        # Authentication, permissions and throttles first
+        super().initial(request, *args, **kwargs)
+        limit = settings.ADMISSION_MAX_CONCURRENT
+        if limit <= 0:
+            return
+        try:
+            self._admission_lease = get_admission_store().acquire(limit)
+        except STORE_ERRORS as e:
+            logger.warning(f"Admission store unavailable, not limiting concurrency: {e}")
+            return
+        if self._admission_lease is None:
+            raise ServerBusy(wait=settings.OFFLOAD_RETRY_AFTER)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        lease = getattr(self, '_admission_lease', None)
+        if lease is not None:
+            self._admission_lease = None
+            try:
+                get_admission_store().release(lease)
+            except STORE_ERRORS as e:
+                # Reclaimed with the rest of this process's leases once it exits
+                logger.warning(f"Could not release admission slot {lease}: {e}")
+        return super().finalize_response(request, response, *args, **kwargs)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class SpeechConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'speech'
+
+    def ready(self):
+        # Registers the receivers that invalidate the prediction config snapshot
+        from . import config  # noqa: F401
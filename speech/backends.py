@@ -0,0 +1,219 @@
+"""Inference backends for the CLAP audio encoder.
+
+``eager`` runs msclap's PyTorch module as-is. ``torchscript`` and ``onnx``
+export it once to CLAP_ARTIFACT_DIR and run the frozen graph instead, which
+avoids Python dispatch per op and lets the runtime fuse operators. An export
+is checked against the eager encoder before it is cached; if exporting or the
+check fails the eager encoder is used.
+
+Exporting and checking run the encoder, which must not happen in the
+gunicorn master before it forks (see registry.warm_up). The master only opens
+an artifact that already exists; `manage.py export_audio_encoder` creates it
+ahead of time, or else the first worker to start exports it after fork.
+
+Only the audio encoder is exported: text embeddings are computed once per
+prompt set and cached (see MSCLAPModel.get_text_embeddings), so the text
+encoder never runs on the request path.
+
+With CLAP_QUANTIZE the linear layers are converted to dynamic int8 (weights
+stored as int8, activations quantized per call), trading a little accuracy
+for smaller workers and faster matmuls; `manage.py validate_quantization`
+measures the accuracy side. The onnx backend can't export these layers.
+"""
+import os
+import hashlib
+import threading
+import logging
+from contextlib import contextmanager
+import numpy as np
+import torch
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('eager', 'torchscript', 'onnx')
+
+
+class _AudioEncoderGraph(torch.nn.Module):
+    # msclap's encoder returns (projected, unprojected); only the first is used
+    def __init__(self, audio_encoder):
+        super().__init__()
+        self.audio_encoder = audio_encoder
+
+    def forward(self, audio):
+        return self.audio_encoder(audio)[0]
+
+
+class EagerAudioEncoder:
+    backend = 'eager'
+
+    def __init__(self, audio_encoder):
+        self.module = _AudioEncoderGraph(audio_encoder).eval()
+
+    def __call__(self, batch):
+        with torch.inference_mode():
+            return self.module(batch)
+
+
+class TorchScriptAudioEncoder:
+    backend = 'torchscript'
+
+    def __init__(self, path):
+        self.module = torch.jit.optimize_for_inference(torch.jit.load(path, map_location='cpu'))
+
+    @staticmethod
+    def export(audio_encoder, example, path):
+        module = _AudioEncoderGraph(audio_encoder).eval()
+        with torch.no_grad():
+            traced = torch.jit.trace(module, example[:2], check_inputs=[(example,)])
+        traced.save(path)
+
+    def __call__(self, batch):
+        with torch.inference_mode():
+            return self.module(batch)
+
+
+class OnnxAudioEncoder:
+    backend = 'onnx'
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+
+    def session(self):
+        # onnxruntime's thread pool doesn't survive fork, so a model preloaded
+        # in the gunicorn master opens its session in each worker instead
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                import onnxruntime
+                from .cpu import intra_op_threads
+                options = onnxruntime.SessionOptions()
+                options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+                options.intra_op_num_threads = intra_op_threads()
+                options.inter_op_num_threads = 1
+                self._session = onnxruntime.InferenceSession(
+                    self.path, options, providers=['CPUExecutionProvider']
+                )
+                self._pid = os.getpid()
+            return self._session
+
+    @staticmethod
+    def export(audio_encoder, example, path):
+        module = _AudioEncoderGraph(audio_encoder).eval()
+        with torch.no_grad():
+            torch.onnx.export(
+                module, (example[:2],), path,
+                input_names=['audio'], output_names=['embedding'],
+                dynamic_axes={'audio': {0: 'batch'}, 'embedding': {0: 'batch'}},
+                opset_version=17,
+            )
+
+    def __call__(self, batch):
+        audio = batch.detach().cpu().numpy().astype(np.float32, copy=False)
+        return torch.from_numpy(self.session().run(['embedding'], {'audio': audio})[0])
+
+
+def quantize_dynamic_int8(module):
+    """Swap every nn.Linear in ``module`` for a dynamically quantized int8 version, in place."""
+    torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return module
+
+
+def _tensors(value):
+    if isinstance(value, torch.Tensor):
+        yield value.int_repr() if value.is_quantized else value
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            yield from _tensors(item)
+
+
+def weights_fingerprint(module):
+    """Short hash of a module's parameter names, shapes and leading values.
+
+    Cheap enough to compute at every start-up, and changes whenever the
+    weights an artifact was exported from do.
+    """
+    digest = hashlib.sha256()
+    for name, value in module.state_dict().items():
+        digest.update(name.encode('utf-8'))
+        for tensor in _tensors(value):
+            digest.update(str(tuple(tensor.shape)).encode('utf-8'))
+            digest.update(tensor.detach().flatten()[:64].cpu().numpy().tobytes())
+    return digest.hexdigest()[:12]
+
+
+def artifact_path(backend, version, clip_samples, fingerprint, quantized=False):
+    extension = 'onnx' if backend == 'onnx' else 'pt'
+    suffix = '-int8' if quantized else ''
+    filename = f'clap-{version}-audio-{clip_samples}-{fingerprint}{suffix}.{extension}'
+    return os.path.join(settings.CLAP_ARTIFACT_DIR, filename)
+
+
+def load_audio_encoder(audio_encoder, backend, version, clip_samples, quantized=False, export=True):
+    """A callable mapping a (batch, clip_samples) float tensor to audio embeddings.
+
+    Falls back to the eager encoder if ``backend`` can't be exported or loaded,
+    or if its artifact doesn't exist yet and ``export`` is false.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown CLAP_BACKEND '{backend}', expected one of {', '.join(BACKENDS)}")
+    eager = EagerAudioEncoder(audio_encoder)
+    if backend == 'eager':
+        return eager
+
+    path = artifact_path(backend, version, clip_samples, weights_fingerprint(audio_encoder), quantized)
+    try:
+        if not os.path.exists(path):
+            if not export:
+                logger.info(f"No {backend} artifact at {path} yet, running eager until it is exported")
+                return eager
+            with _export_lock(path):
+                # Another process may have exported it while this one waited
+                if not os.path.exists(path):
+                    _export(backend, eager, path, clip_samples)
+        return _open(backend, path)
+    except Exception as e:
+        logger.exception(f"Could not use the {backend} CLAP backend, falling back to eager: {e}")
+        return eager
+
+
+def _open(backend, path):
+    if backend == 'onnx':
+        return OnnxAudioEncoder(path)
+    return TorchScriptAudioEncoder(path)
+
+
+@contextmanager
+def _export_lock(path):
+    # Workers starting together export once; the rest wait and open the result
+    import fcntl
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _export(backend, eager, path, clip_samples):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    generator = torch.Generator().manual_seed(0)
+    # Three clips, so a graph specialised to the traced batch size of two is caught
+    example = torch.randn(3, clip_samples, generator=generator) * 0.1
+
+    # Export under a temporary name and rename, so concurrent workers never
+    # load a half-written artifact
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        logger.info(f"Exporting CLAP audio encoder to {path}")
+        encoder_class = OnnxAudioEncoder if backend == 'onnx' else TorchScriptAudioEncoder
+        encoder_class.export(eager.module.audio_encoder, example, temp_path)
+        exported = _open(backend, temp_path)
+        expected, actual = eager(example), exported(example)
+        if not torch.allclose(expected, actual, rtol=1e-3, atol=1e-4):
+            error = (expected - actual).abs().max().item()
+            raise RuntimeError(f"Exported encoder differs from eager (max abs error {error:.2e})")
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
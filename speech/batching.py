@@ -0,0 +1,91 @@
+import os
+import queue
+import threading
+import time
+import logging
+from concurrent.futures import Future
+from .metrics import BATCH_SIZE, QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+
+class BatchScheduler:
+    """Collects concurrent submissions and runs them through one batched call.
+
+    ``batch_fn`` receives a list of items and must return a list of results in
+    the same order. A batch is dispatched once ``max_batch_size`` items are
+    waiting or ``max_wait_ms`` has passed since the first of them arrived.
+    ``name`` labels the scheduler's queue depth and batch size metrics.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=8, max_wait_ms=10, name='default'):
+        self.batch_fn = batch_fn
+        self.name = name
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, max_wait_ms / 1000.0)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_worker(self):
+        # Threads don't survive fork, so a scheduler created before gunicorn
+        # forks its workers has to start a fresh dispatcher in each child.
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='clap-batcher', daemon=True)
+            self._thread.start()
+
+    def submit(self, item):
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((item, future))
+        QUEUE_DEPTH.labels(queue=self.name).set(self._queue.qsize())
+        return future
+
+    def __call__(self, item, timeout=None):
+        return self.submit(item).result(timeout=timeout)
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        QUEUE_DEPTH.labels(queue=self.name).set(self._queue.qsize())
+        BATCH_SIZE.labels(queue=self.name).observe(len(batch))
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            items = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+            try:
+                results = self.batch_fn(items)
+            except Exception as e:
+                if len(batch) == 1:
+                    futures[0].set_exception(e)
+                    continue
+                # One bad input shouldn't fail everyone it was batched with
+                logger.warning(f"Batch of {len(batch)} failed ({e}), retrying items individually")
+                for item, future in batch:
+                    try:
+                        future.set_result(self.batch_fn([item])[0])
+                    except Exception as item_error:
+                        future.set_exception(item_error)
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)
@@ -0,0 +1,103 @@
+"""Helpers for the benchmark_inference management command.
+
+StubCLAP stands in for msclap's CLAP so the inference path can be timed
+offline and repeatably: it has the same interface MSCLAPModel relies on
+(``args``, ``clap.audio_encoder``, ``get_text_embeddings``,
+``compute_similarity``), a fixed random projection as its encoder, and an
+optional sleep per input to approximate the real encoder's cost.
+"""
+import io
+import time
+import resource
+import hashlib
+import types
+import numpy as np
+import soundfile as sf
+import torch
+
+
+class StubAudioEncoder(torch.nn.Module):
+    def __init__(self, embedding_dim, latency_ms=0.0, seed=0):
+        super().__init__()
+        self.bands = 64
+        self.projection = torch.nn.Linear(self.bands, embedding_dim, bias=False)
+        with torch.no_grad():
+            generator = torch.Generator().manual_seed(seed)
+            self.projection.weight.copy_(torch.randn(embedding_dim, self.bands, generator=generator))
+        self.latency = latency_ms / 1000.0
+
+    def forward(self, batch):
+        if self.latency:
+            time.sleep(self.latency * batch.shape[0])
+        usable = batch.shape[1] // self.bands * self.bands
+        features = batch[:, :usable].reshape(batch.shape[0], self.bands, -1).abs().mean(-1)
+        return self.projection(features), None
+
+
+class StubClapModule(torch.nn.Module):
+    # Stands in for msclap's CLAP nn.Module, so it can be quantized the same way
+    def __init__(self, audio_encoder):
+        super().__init__()
+        self.audio_encoder = audio_encoder
+        self.logit_scale = torch.nn.Parameter(torch.tensor(float(np.log(10.0))), requires_grad=False)
+
+
+class StubCLAP:
+    """Deterministic drop-in for msclap.CLAP."""
+
+    def __init__(self, embedding_dim=1024, sampling_rate=44100, duration=7, latency_ms=0.0, seed=0):
+        self.embedding_dim = embedding_dim
+        self.args = types.SimpleNamespace(sampling_rate=sampling_rate, duration=duration)
+        self.clap = StubClapModule(StubAudioEncoder(embedding_dim, latency_ms, seed))
+
+    def get_text_embeddings(self, texts):
+        rows = []
+        for text in texts:
+            seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:4], 'little')
+            rows.append(torch.randn(self.embedding_dim, generator=torch.Generator().manual_seed(seed)))
+        return torch.stack(rows)
+
+    def compute_similarity(self, audio_embeddings, text_embeddings):
+        audio_embeddings = audio_embeddings / torch.norm(audio_embeddings, dim=-1, keepdim=True)
+        text_embeddings = text_embeddings / torch.norm(text_embeddings, dim=-1, keepdim=True)
+        return self.clap.logit_scale.exp() * audio_embeddings @ text_embeddings.T
+
+
+def make_stub_model(latency_ms=0.0, backend=None, quantize=None, **kwargs):
+    """An MSCLAPModel backed by StubCLAP, stored under its own embedding version."""
+    from .ms_clap import MSCLAPModel
+    return MSCLAPModel(version='stub', clap=StubCLAP(latency_ms=latency_ms, **kwargs),
+                       backend=backend, quantize=quantize)
+
+
+def synthetic_wav(duration, sample_rate=16000, seed=0):
+    """WAV bytes of speech-like audio: bursts of harmonics separated by pauses."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    pitch = 110 + 40 * rng.random()
+    voice = sum(np.sin(2 * np.pi * pitch * k * t) / k for k in range(1, 6))
+    # Syllable-rate envelope (~4 Hz) with random gaps
+    envelope = np.clip(np.sin(2 * np.pi * 4 * t + rng.random() * np.pi), 0, None)
+    envelope *= np.repeat(rng.random(len(t) // sample_rate + 1) > 0.2, sample_rate)[:len(t)]
+    waveform = 0.3 * voice * envelope + 0.01 * rng.standard_normal(len(t))
+    buffer = io.BytesIO()
+    sf.write(buffer, waveform.astype(np.float32), sample_rate, format='WAV', subtype='PCM_16')
+    return buffer.getvalue()
+
+
+def percentile_summary(latencies, wall_time):
+    """p50/p95/p99 latency in milliseconds and throughput in calls per second."""
+    values = np.asarray(latencies) * 1000.0
+    p50, p95, p99 = np.percentile(values, [50, 95, 99]) if len(values) else (0.0, 0.0, 0.0)
+    return {
+        'count': len(values),
+        'p50_ms': float(p50),
+        'p95_ms': float(p95),
+        'p99_ms': float(p99),
+        'throughput': len(values) / wall_time if wall_time > 0 else 0.0,
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
@@ -0,0 +1,100 @@
+"""In-process snapshot of the active PredictionSettings and ClassificationPrompts.
+
+Predictions used to query both tables (several round-trips) on every
+request. The snapshot is loaded once and reused until the configuration
+changes: saves and deletes of either model bump a version file shared by
+every process on the host, and each lookup only has to stat() it.
+"""
+import os
+import uuid
+import threading
+import logging
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import ClassificationPrompt, PredictionSettings, prompt_set_key
+from .registry import embedding_version
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_snapshot = None
+
+
+class PredictionConfig:
+    """Immutable view of the configuration a prediction runs under."""
+
+    def __init__(self, version, prediction_settings, prompts):
+        self.version = version
+        self.settings = prediction_settings
+        self.prompts = tuple(prompts)
+        self.prompt_names = [p.name for p in self.prompts]
+        self.prompt_texts = [p.encoder_text for p in self.prompts]
+        # Backend and quantization change the scores too, so results cached
+        # under one don't carry over to another
+        self.fingerprint = prompt_set_key(self.prompt_texts, embedding_version())
+
+
+def _read_version():
+    # A new inode per bump (see bump_version), so the change is visible even
+    # on filesystems with coarse mtime resolution
+    try:
+        stat = os.stat(settings.SPEECH_CONFIG_VERSION_FILE)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def bump_version():
+    path = settings.SPEECH_CONFIG_VERSION_FILE
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'w') as f:
+            f.write(uuid.uuid4().hex)
+        os.replace(temp_path, path)
+    except OSError as e:
+        logger.error("config_version_bump_failed path=%s error=%s", path, e)
+
+
+def get_prediction_config():
+    """Return the current PredictionConfig, reloading it only after a change."""
+    global _snapshot
+    version = _read_version()
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+
+    with _lock:
+        if _snapshot is None or _snapshot.version != version:
+            prediction_settings = PredictionSettings.get_active()
+            prompts = ClassificationPrompt.get_active()
+            config = PredictionConfig(version, prediction_settings, prompts)
+            if prediction_settings is None or not prompts:
+                # get_active() returns None or [] when the query failed; keep
+                # asking until the database answers instead of caching that
+                logger.warning("prediction_config_incomplete settings=%s prompts=%d, not caching",
+                               getattr(prediction_settings, 'id', None), len(config.prompts))
+                return config
+            _snapshot = config
+            logger.info(
+                "prediction_config_loaded settings=%s prompts=%s fingerprint=%s",
+                prediction_settings.id,
+                ','.join(_snapshot.prompt_names),
+                _snapshot.fingerprint[:12],
+            )
+        return _snapshot
+
+
+@receiver([post_save, post_delete], sender=PredictionSettings)
+@receiver([post_save, post_delete], sender=ClassificationPrompt)
+def invalidate_prediction_config(sender, **kwargs):
+    # Wait for the commit: a process reloading before it would cache the old
+    # rows under the new version
+    transaction.on_commit(_invalidate)
+
+
+def _invalidate():
+    global _snapshot
+    _snapshot = None
+    bump_version()
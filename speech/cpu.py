@@ -0,0 +1,87 @@
+"""CPU thread and core allocation for inference processes.
+
+torch sizes its intra-op pool to every core by default, so N gunicorn
+workers on one host would each run N-core matmuls and oversubscribe the CPU.
+gunicorn.conf.py calls configure_threads() in every worker after fork with
+the worker's slot (0..workers-1) so each gets an even share of the cores,
+optionally pinned to a disjoint set of them (CLAP_CPU_AFFINITY). Processes
+not started by gunicorn are configured from settings on first model load.
+"""
+import os
+import threading
+import logging
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_configured = {}
+
+
+def available_cores():
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        # Not available on macOS
+        return list(range(os.cpu_count() or 1))
+
+
+def worker_cores(slot, workers, cores=None):
+    """The disjoint share of ``cores`` that worker ``slot`` of ``workers`` runs on.
+
+    Leftover cores go to the lowest slots; with more workers than cores,
+    workers share cores round-robin.
+    """
+    cores = cores if cores is not None else available_cores()
+    if workers >= len(cores):
+        return [cores[slot % len(cores)]]
+    share, extra = divmod(len(cores), workers)
+    slot = slot % workers
+    start = slot * share + min(slot, extra)
+    return cores[start:start + share + (1 if slot < extra else 0)]
+
+
+def configure_threads(slot=None, workers=1, intra_op_threads=None):
+    """Size torch's thread pools (and pin the process, if enabled) for this process.
+
+    ``intra_op_threads`` overrides CLAP_INTRA_OP_THREADS, which in turn
+    overrides the even share of cores per worker.
+    """
+    import torch
+    with _lock:
+        cores = available_cores()
+        if settings.CLAP_CPU_AFFINITY and slot is not None:
+            cores = worker_cores(slot, workers, cores)
+            os.sched_setaffinity(0, cores)
+            share = len(cores)
+        else:
+            share = max(1, len(cores) // max(1, workers))
+
+        intra = intra_op_threads or settings.CLAP_INTRA_OP_THREADS or share
+        inter = settings.CLAP_INTER_OP_THREADS or 1
+        torch.set_num_threads(intra)
+        try:
+            torch.set_num_interop_threads(inter)
+        except RuntimeError:
+            # Only possible before the inter-op pool has started; a second
+            # call in the same process keeps the first value.
+            if torch.get_num_interop_threads() != inter:
+                logger.warning(f"Could not set inter-op threads to {inter}, using "
+                               f"{torch.get_num_interop_threads()}")
+
+        _configured.update(pid=os.getpid(), intra=intra, inter=inter, cores=cores)
+        logger.info(f"Inference threads for pid {os.getpid()}: intra-op {intra}, inter-op {inter}"
+                    + (f", pinned to cores {cores}" if settings.CLAP_CPU_AFFINITY and slot is not None else ""))
+        return intra
+
+
+def ensure_configured():
+    """Configure from settings unless this process has already been configured."""
+    if _configured.get('pid') != os.getpid():
+        configure_threads()
+
+
+def intra_op_threads():
+    """Intra-op thread count chosen for this process, e.g. to size an onnxruntime session."""
+    ensure_configured()
+    return _configured['intra']
@@ -0,0 +1,296 @@
+"""Local inference daemon protocol, server and client.
+
+With CLAP_INFERENCE_SOCKET set, web workers don't load MS-CLAP at all: they
+send requests over a Unix domain socket to one ``run_inference_server``
+process, which holds the only copy of the model and batches concurrent
+requests from every worker (see speech/batching.py).
+
+Every message is a fixed binary header followed by a small JSON body::
+
+    magic b'SI' | version (u8) | op or status (u8) | body length (u32, big-endian)
+
+Audio never crosses the socket. Files are named by AudioFile id or path on
+the disk both processes share. In-memory waveforms are written once into a
+POSIX shared memory block, and the server maps that block as a numpy array
+without copying.
+
+The daemon records the same stage, batch and queue metrics as the web
+workers; with CLAP_INFERENCE_METRICS_PORT set it serves them itself, since
+it is not one of the gunicorn processes behind /metrics.
+"""
+import os
+import json
+import struct
+import socket
+import threading
+import socketserver
+import logging
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SI'
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('!2sBBI')
+
+OP_PREDICT = 1
+OP_SEGMENTS = 2
+OP_TIMELINE = 3
+OP_PING = 4
+OP_PREDICT_MANY = 5
+
+# Whole-recording ops run one encoder pass per segment or window
+LONG_OPS = (OP_SEGMENTS, OP_TIMELINE)
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+
+class InferenceError(Exception):
+    """Raised by InferenceClient when the server reports a failure or can't be reached."""
+
+
+def _recv_exactly(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise ConnectionError('Connection closed mid-message')
+        received += count
+    return bytes(buffer)
+
+
+def _json_default(value):
+    # numpy scalars and arrays in model output
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def send_message(sock, code, body):
+    payload = json.dumps(body, separators=(',', ':'), default=_json_default).encode('utf-8')
+    sock.sendall(HEADER.pack(MAGIC, PROTOCOL_VERSION, code, len(payload)) + payload)
+
+
+def recv_message(sock):
+    """Return (code, body), or None if the peer closed the connection between messages."""
+    first = sock.recv(HEADER.size)
+    if not first:
+        return None
+    header = first + _recv_exactly(sock, HEADER.size - len(first))
+    magic, version, code, length = HEADER.unpack(header)
+    if magic != MAGIC or version != PROTOCOL_VERSION:
+        raise ConnectionError(f'Unexpected protocol header {header!r}')
+    return code, json.loads(_recv_exactly(sock, length)) if length else {}
+
+
+def attach_waveform(name, samples):
+    """Map a client's shared memory block as a float32 array, without copying."""
+    block = shared_memory.SharedMemory(name=name)
+    # The client owns the block; without this the server's resource tracker
+    # would unlink it when the server exits
+    resource_tracker.unregister(block._name, 'shared_memory')
+    return block, np.ndarray((samples,), dtype=np.float32, buffer=block.buf)
+
+
+class InferenceRequestHandler(socketserver.BaseRequestHandler):
+    """Serves one client connection, which may carry any number of requests."""
+
+    def handle(self):
+        while True:
+            try:
+                message = recv_message(self.request)
+            except (ConnectionError, OSError, ValueError) as e:
+                logger.warning(f"Dropping inference client: {e}")
+                return
+            if message is None:
+                return
+            op, body = message
+            close_old_connections()
+            try:
+                result = self.server.dispatch(op, body)
+            except Exception as e:
+                logger.exception(f"Inference request {op} failed: {e}")
+                send_message(self.request, STATUS_ERROR, {'error': str(e)})
+            else:
+                send_message(self.request, STATUS_OK, {'result': result})
+
+    def finish(self):
+        from django.db import connection
+        connection.close()
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, clap_model, prediction_batcher):
+        self.clap_model = clap_model
+        self.prediction_batcher = prediction_batcher
+        if os.path.exists(socket_path):
+            # Left behind by a server that didn't shut down cleanly
+            os.remove(socket_path)
+        os.makedirs(os.path.dirname(socket_path) or '.', exist_ok=True)
+        super().__init__(socket_path, InferenceRequestHandler)
+        os.chmod(socket_path, 0o660)
+
+    def cleanup_socket(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+    def dispatch(self, op, body):
+        if op == OP_PING:
+            return {'pid': os.getpid(), 'embedding_version': self.clap_model.embedding_version,
+                    'sample_rate': self.clap_model.sample_rate}
+        if op == OP_PREDICT:
+            return self.predict(body)
+        if op == OP_PREDICT_MANY:
+            results = self.clap_model.predict_many([self.audio_source(item) for item in body['items']])
+            return [
+                {'error': str(r) or type(r).__name__} if isinstance(r, Exception) else {'prediction': r}
+                for r in results
+            ]
+        if op == OP_SEGMENTS:
+            return self.clap_model.predict_segments(self.audio_source(body))
+        if op == OP_TIMELINE:
+            return self.clap_model.predict_timeline(self.audio_source(body), window=body.get('window'),
+                                                    hop=body.get('hop'))
+        raise ValueError(f'Unknown op {op}')
+
+    def predict(self, body):
+        if 'shm' not in body:
+            return self.prediction_batcher(self.audio_source(body))
+        block, waveform = attach_waveform(body['shm'], body['samples'])
+        try:
+            return self.prediction_batcher(waveform)
+        finally:
+            del waveform
+            try:
+                block.close()
+            except BufferError:
+                # Still referenced from an exception traceback; unmapped once that is collected
+                pass
+
+    def audio_source(self, body):
+        from .models import AudioFile
+        if body.get('audio_file_id') is not None:
+            audio_file = AudioFile.objects.filter(id=body['audio_file_id']).first()
+            if audio_file is not None:
+                return audio_file
+        return body['path']
+
+
+class InferenceClient:
+    """Client for run_inference_server; safe to share between threads.
+
+    Each thread keeps its own persistent connection and reconnects once if the
+    server restarted in between. Segment and timeline requests wait up to
+    ``long_timeout`` seconds, everything else ``timeout``.
+    """
+
+    def __init__(self, socket_path, timeout=60.0, long_timeout=600.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.long_timeout = long_timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            self._local.sock = sock
+        return sock
+
+    def _close(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            sock.close()
+            self._local.sock = None
+
+    def request(self, op, body):
+        for attempt in range(2):
+            try:
+                sock = self._connection()
+                sock.settimeout(self.long_timeout if op in LONG_OPS else self.timeout)
+                send_message(sock, op, body)
+                reply = recv_message(sock)
+                if reply is None:
+                    raise ConnectionError('Inference server closed the connection')
+                break
+            except (ConnectionError, socket.timeout, OSError) as e:
+                self._close()
+                # A request that timed out may still be running; don't send it twice
+                if attempt or isinstance(e, socket.timeout):
+                    raise InferenceError(f'Inference server unavailable: {e}')
+        status, body = reply
+        if status != STATUS_OK:
+            raise InferenceError(body.get('error', 'Inference failed'))
+        return body['result']
+
+    @staticmethod
+    def _source(audio_source):
+        """Request body naming an AudioFile or a file path."""
+        from .models import AudioFile
+        if isinstance(audio_source, AudioFile):
+            return {'audio_file_id': audio_source.id, 'path': audio_source.audio_file.path}
+        return {'path': os.path.abspath(audio_source)}
+
+    def predict(self, audio_source):
+        """Classify an AudioFile, a file path or a mono float32 waveform array."""
+        if not isinstance(audio_source, np.ndarray):
+            return self.request(OP_PREDICT, self._source(audio_source))
+
+        waveform = np.ascontiguousarray(audio_source, dtype=np.float32)
+        block = shared_memory.SharedMemory(create=True, size=max(1, waveform.nbytes))
+        try:
+            np.ndarray(waveform.shape, dtype=np.float32, buffer=block.buf)[:] = waveform
+            return self.request(OP_PREDICT, {'shm': block.name, 'samples': len(waveform)})
+        finally:
+            block.close()
+            block.unlink()
+
+    __call__ = predict
+
+    def predict_many(self, audio_sources):
+        """Classify AudioFiles or paths in one batch; failed items come back as InferenceError."""
+        items = [self._source(source) for source in audio_sources]
+        return [
+            InferenceError(item['error']) if 'error' in item else item['prediction']
+            for item in self.request(OP_PREDICT_MANY, {'items': items})
+        ]
+
+    def predict_segments(self, audio_source):
+        return self.request(OP_SEGMENTS, self._source(audio_source))
+
+    def predict_timeline(self, audio_source, window=None, hop=None):
+        return self.request(OP_TIMELINE, {**self._source(audio_source), 'window': window, 'hop': hop})
+
+    def ping(self):
+        return self.request(OP_PING, {})
+
+    @property
+    def sample_rate(self):
+        """Rate waveforms passed to predict() must be at; asked of the server once."""
+        if getattr(self, '_sample_rate', None) is None:
+            self._sample_rate = self.ping()['sample_rate']
+        return self._sample_rate
+
+
+_client = None
+
+
+def get_inference_client():
+    """The shared InferenceClient, or None when CLAP_INFERENCE_SOCKET is not set."""
+    global _client
+    if not settings.CLAP_INFERENCE_SOCKET:
+        return None
+    if _client is None:
+        _client = InferenceClient(settings.CLAP_INFERENCE_SOCKET, settings.CLAP_INFERENCE_TIMEOUT,
+                                  settings.CLAP_INFERENCE_LONG_TIMEOUT)
+    return _client
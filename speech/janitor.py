@@ -0,0 +1,159 @@
+"""Reclaims disk space under MEDIA_ROOT that nothing will read again.
+
+Candidates for removal are:
+
+* entries directly under TEMP_ROOT: per-request directories left by
+  preprocess_and_split_audio callers, and loose segment files from before
+  requests had directories of their own
+* half-written uploads (``.upload-*``) in MEDIA_ROOT/audio_files, left by a
+  worker that died mid-request
+* ``predictions/<name>`` folders whose AudioFile no longer exists
+* waveform sidecars (``<upload>.<rate>.npy``, see utils.load_waveform) in
+  MEDIA_ROOT/audio_files whose AudioFile no longer exists, and temp files
+  of sidecars whose writer died
+
+Anything older than ``max_age`` seconds is removed. If what remains still
+takes more than ``budget_bytes``, the oldest go first until it fits, but
+never anything younger than ``min_age``, which may belong to a request
+still in progress. A directory's age is that of the newest file in it.
+"""
+import os
+import time
+import shutil
+import logging
+from collections import namedtuple
+from django.conf import settings
+from .uploads import UPLOAD_PREFIX
+
+logger = logging.getLogger(__name__)
+
+Candidate = namedtuple('Candidate', ['path', 'mtime', 'size', 'files'])
+
+
+
+def _scan(path):
+    """Candidate for a file or a whole directory tree, or None if it vanished meanwhile."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if not os.path.isdir(path):
+        return Candidate(path, stat.st_mtime, stat.st_size, [path])
+
+    newest, size, files = None, 0, []
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = os.path.join(root, filename)
+            try:
+                file_stat = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            newest = max(newest or 0, file_stat.st_mtime)
+            size += file_stat.st_size
+            files.append(file_path)
+    # Only an empty directory is aged by its own mtime
+    return Candidate(path, stat.st_mtime if newest is None else newest, size, files)
+
+
+def _entries(directory, prefix=''):
+    try:
+        with os.scandir(directory) as entries:
+            return [entry.path for entry in entries if entry.name.startswith(prefix)]
+    except FileNotFoundError:
+        return []
+
+
+def orphaned_prediction_folders():
+    from .models import AudioFile
+    folders = _entries(os.path.join(settings.MEDIA_ROOT, 'predictions'))
+    if not folders:
+        return []
+    # Folders are named after the stem of the audio file (see create_segment_folders)
+    stems = {
+        os.path.splitext(os.path.basename(name))[0]
+        for name in AudioFile.objects.values_list('audio_file', flat=True).iterator()
+    }
+    return [folder for folder in folders if os.path.basename(folder) not in stems]
+
+
+def orphaned_sidecars():
+    from .models import AudioFile
+    directory = os.path.join(settings.MEDIA_ROOT, 'audio_files')
+    sidecars = [path for path in _entries(directory) if path.endswith('.npy') or '.npy.' in path]
+    if not sidecars:
+        return []
+    names = set(AudioFile.objects.values_list('audio_file', flat=True).iterator())
+    orphaned = []
+    for path in sidecars:
+        # <upload>.<rate>.npy, or <upload>.<rate>.npy.<pid>.tmp while being written
+        source = os.path.basename(path).split('.npy')[0].rsplit('.', 1)[0]
+        if path.endswith('.tmp') or os.path.join('audio_files', source) not in names:
+            orphaned.append(path)
+    return orphaned
+
+
+def find_candidates():
+    paths = _entries(settings.TEMP_ROOT)
+    paths += _entries(os.path.join(settings.MEDIA_ROOT, 'audio_files'), prefix=UPLOAD_PREFIX)
+    paths += orphaned_prediction_folders()
+    paths += orphaned_sidecars()
+    return [candidate for candidate in map(_scan, paths) if candidate is not None]
+
+
+def plan(candidates, now, max_age, min_age, budget_bytes):
+    """The candidates to remove, oldest first."""
+    candidates = sorted(candidates, key=lambda candidate: candidate.mtime)
+    expired = [c for c in candidates if now - c.mtime > max_age]
+    kept = [c for c in candidates if now - c.mtime <= max_age]
+
+    remaining = sum(c.size for c in kept)
+    evicted = []
+    for candidate in kept:
+        if remaining <= budget_bytes or now - candidate.mtime <= min_age:
+            break
+        evicted.append(candidate)
+        remaining -= candidate.size
+    return expired + evicted
+
+
+def forget_artifacts(paths):
+    """Drop AudioArtifact rows of files about to be removed."""
+    from .models import AudioArtifact
+    stored = [AudioArtifact.storage_path(path) for path in paths]
+    for start in range(0, len(stored), 500):
+        AudioArtifact.objects.filter(path__in=stored[start:start + 500]).delete()
+
+
+def remove(candidate):
+    forget_artifacts(candidate.files)
+    try:
+        if os.path.isdir(candidate.path):
+            shutil.rmtree(candidate.path)
+        else:
+            os.remove(candidate.path)
+    except FileNotFoundError:
+        pass
+
+
+def clean_media(max_age, min_age, budget_bytes, dry_run=False):
+    """Remove stale candidates; return a summary of what was (or would be) freed."""
+    candidates = find_candidates()
+    doomed = plan(candidates, time.time(), max_age, min_age, budget_bytes)
+    removed = freed = 0
+    for candidate in doomed:
+        if not dry_run:
+            try:
+                remove(candidate)
+            except OSError as e:
+                logger.error(f"Could not remove {candidate.path}: {e}")
+                continue
+        logger.info(f"{'Would remove' if dry_run else 'Removed'} {candidate.path} "
+                    f"({candidate.size / 1e6:.1f} MB)")
+        removed += 1
+        freed += candidate.size
+    return {
+        'candidates': len(candidates),
+        'removed': removed,
+        'freed_bytes': freed,
+        'remaining_bytes': sum(c.size for c in candidates) - freed,
+    }
@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import override_settings
+from django.utils.module_loading import import_string
+from rest_framework.test import APIRequestFactory, force_authenticate
+from speech import registry
+from speech.benchmark import make_stub_model, synthetic_wav, percentile_summary, peak_rss_mb
+from speech.utils import preprocess_and_split_audio, request_temp_dir
+from speech.views import AudioFileUploadView, PredictionView
+
+class Command(BaseCommand):
+    help = ('Time uploads and predictions end to end on synthetic audio, reporting '
+            'p50/p95/p99 latency, throughput and peak RSS')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', default='stub',
+                            help="'stub' (offline, default), 'real' (msclap weights, must already be "
+                                 "cached locally) or the dotted path of a factory returning an MSCLAPModel")
+        parser.add_argument('--stub-latency-ms', type=float, default=0.0,
+                            help='Simulated encoder cost per input for the stub model (default: 0)')
+        parser.add_argument('--durations', type=float, nargs='+', default=[1.0, 5.0, 10.0, 30.0],
+                            help='Synthetic recording lengths in seconds (default: 1 5 10 30)')
+        parser.add_argument('--iterations', type=int, default=20,
+                            help='Recordings per duration (default: 20)')
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='Requests in flight at once (default: 1)')
+        parser.add_argument('--warmup', type=int, default=2,
+                            help='Untimed predictions before measuring (default: 2)')
+        parser.add_argument('--json', dest='json_path',
+                            help='Also write the results to this file as JSON')
+
+    def handle(self, *args, **options):
+        clap_model = self.load_model(options)
+        previous = registry.use_clap_model(clap_model)
+        media_root = tempfile.mkdtemp(prefix='stuttersense-bench-')
+        user = User.objects.create(username=f'benchmark-{uuid.uuid4().hex[:8]}')
+        results = []
+        # Uploads land in a scratch MEDIA_ROOT so the benchmark never mixes with real audio
+        try:
+            # Predict in-process with the chosen model even if an inference daemon is
+            # configured, and without admission control turning the load away
+            with override_settings(MEDIA_ROOT=media_root, TEMP_ROOT=os.path.join(media_root, 'temp'),
+                                   CLAP_INFERENCE_SOCKET='', ADMISSION_USER_RATE=0, ADMISSION_MAX_CONCURRENT=0,
+                                   ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+                try:
+                    self.warm_up(user, options['warmup'])
+                    for duration in options['durations']:
+                        results.extend(self.run_duration(user, clap_model, duration, options))
+                finally:
+                    user.delete()
+        finally:
+            shutil.rmtree(media_root, ignore_errors=True)
+            registry.use_clap_model(previous)
+
+        self.report(results)
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump({'model': options['model'], 'results': results}, f, indent=2)
+
+    def load_model(self, options):
+        if options['model'] == 'stub':
+            return make_stub_model(latency_ms=options['stub_latency_ms'])
+        if options['model'] == 'real':
+            clap_model = registry.get_clap_model()
+            if clap_model is None:
+                raise CommandError('MS-CLAP model could not be loaded; are the weights cached locally?')
+            return clap_model
+        try:
+            return import_string(options['model'])()
+        except ImportError as e:
+            raise CommandError(f"Could not import model factory '{options['model']}': {e}")
+
+    def upload(self, user, duration, seed):
+        factory = APIRequestFactory()
+        audio = SimpleUploadedFile(f'bench-{seed}.wav', synthetic_wav(duration, seed=seed), 'audio/wav')
+        request = factory.post('/api/upload/', {'audio_file': audio}, format='multipart')
+        force_authenticate(request, user=user)
+        response = AudioFileUploadView.as_view()(request)
+        if response.status_code != 201:
+            raise RuntimeError(f'Upload failed: {response.data}')
+        return response.data['playback_url']
+
+    def predict(self, user, audio_url):
+        request = APIRequestFactory().get('/api/predict/', {'audio_url': audio_url})
+        force_authenticate(request, user=user)
+        response = PredictionView.as_view()(request)
+        if response.status_code != 200:
+            raise RuntimeError(f'Prediction failed: {response.data}')
+        return response.data
+
+    def warm_up(self, user, count):
+        # First calls pay for lazy imports, text embeddings and thread start-up
+        for i in range(count):
+            self.predict(user, self.upload(user, 1.0, seed=10 ** 6 + i))
+
+    def run_duration(self, user, clap_model, duration, options):
+        seeds = [int(duration * 1000) + i for i in range(options['iterations'])]
+        concurrency = options['concurrency']
+
+        upload, urls = self.measure(lambda seed: self.upload(user, duration, seed), seeds, concurrency)
+        # Fresh uploads, so this is the uncached path through the model
+        predict, _ = self.measure(lambda url: self.predict(user, url), urls, concurrency)
+        cached, _ = self.measure(lambda url: self.predict(user, url), urls, concurrency)
+
+        paths = [os.path.join(settings.MEDIA_ROOT, url.split(settings.MEDIA_URL, 1)[1]) for url in urls]
+        split, _ = self.measure(self.split, paths, concurrency)
+        model, _ = self.measure(lambda path: self.checked(clap_model.predict, path), paths, concurrency)
+
+        rss = peak_rss_mb()
+        return [
+            {'scenario': name, 'duration': duration, 'peak_rss_mb': rss, **stats}
+            for name, stats in [('upload', upload), ('predict', predict), ('predict_cached', cached),
+                                ('preprocess_and_split_audio', split), ('MSCLAPModel.predict', model)]
+        ]
+
+    def split(self, path):
+        with request_temp_dir() as temp_dir:
+            return self.checked(preprocess_and_split_audio, path, None, temp_dir)
+
+    def checked(self, fn, *args):
+        # These log and return None on failure instead of raising
+        result = fn(*args)
+        if result is None:
+            raise RuntimeError(f'{fn.__qualname__} returned no result, see the log for details')
+        return result
+
+    def measure(self, fn, inputs, concurrency):
+        """Call ``fn`` on every input, ``concurrency`` at a time, timing each call."""
+        def timed_call(item):
+            started = time.perf_counter()
+            try:
+                output = fn(item)
+                return output, time.perf_counter() - started
+            finally:
+                # Worker threads each open their own database connection
+                if concurrency > 1:
+                    connections.close_all()
+
+        started = time.perf_counter()
+        errors = []
+        outputs, latencies = [], []
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            for future in [executor.submit(timed_call, item) for item in inputs]:
+                try:
+                    output, latency = future.result()
+                except Exception as e:
+                    errors.append(str(e))
+                    continue
+                outputs.append(output)
+                latencies.append(latency)
+        stats = percentile_summary(latencies, time.perf_counter() - started)
+        stats['errors'] = len(errors)
+        if errors:
+            self.stderr.write(f'{len(errors)} call(s) failed, first error: {errors[0]}')
+        return stats, outputs
+
+    def report(self, results):
+        header = f"{'scenario':<28}{'dur(s)':>8}{'n':>5}{'err':>5}{'p50 ms':>10}{'p95 ms':>10}" \
+                 f"{'p99 ms':>10}{'req/s':>9}{'rss MB':>9}"
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        for r in results:
+            self.stdout.write(
+                f"{r['scenario']:<28}{r['duration']:>8g}{r['count']:>5}{r['errors']:>5}"
+                f"{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}"
+                f"{r['throughput']:>9.1f}{r['peak_rss_mb']:>9.0f}"
+            )
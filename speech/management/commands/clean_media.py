@@ -0,0 +1,39 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from speech.janitor import clean_media
+
+class Command(BaseCommand):
+    help = 'Remove stale temp files and orphaned prediction folders from MEDIA_ROOT'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age-hours', type=float, default=settings.MEDIA_JANITOR_MAX_AGE_HOURS,
+                            help='Remove anything older than this (default: MEDIA_JANITOR_MAX_AGE_HOURS)')
+        parser.add_argument('--min-age-minutes', type=float, default=settings.MEDIA_JANITOR_MIN_AGE_MINUTES,
+                            help='Never remove anything newer than this (default: MEDIA_JANITOR_MIN_AGE_MINUTES)')
+        parser.add_argument('--budget-mb', type=float, default=settings.MEDIA_JANITOR_BUDGET_MB,
+                            help='Remove the oldest files until the rest fit in this many MB '
+                                 '(default: MEDIA_JANITOR_BUDGET_MB)')
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep running, cleaning up every this many seconds (default: run once)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report what would be removed without removing it')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            summary = clean_media(
+                max_age=options['max_age_hours'] * 3600,
+                min_age=options['min_age_minutes'] * 60,
+                budget_bytes=options['budget_mb'] * 1024 * 1024,
+                dry_run=options['dry_run'],
+            )
+            self.stdout.write(
+                f"{'Would remove' if options['dry_run'] else 'Removed'} {summary['removed']} of "
+                f"{summary['candidates']} candidate(s), {summary['freed_bytes'] / 1e6:.1f} MB; "
+                f"{summary['remaining_bytes'] / 1e6:.1f} MB left"
+            )
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from speech.ms_clap import MSCLAPModel
+
+class Command(BaseCommand):
+    help = ('Export and check the CLAP audio encoder for CLAP_BACKEND ahead of time, so a preloading '
+            'gunicorn master only has to open the artifact')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', default=settings.CLAP_BACKEND,
+                            help='torchscript or onnx (default: CLAP_BACKEND)')
+
+    def handle(self, *args, **options):
+        backend = options['backend']
+        if backend == 'eager':
+            self.stdout.write('The eager backend has nothing to export')
+            return
+        clap_model = MSCLAPModel(backend=backend)
+        if clap_model.audio_encoder.backend != backend:
+            raise CommandError(f'Could not export the {backend} backend, see the log for details')
+        self.stdout.write(self.style.SUCCESS(f'{clap_model.embedding_version} audio encoder ready '
+                                             f'in {settings.CLAP_ARTIFACT_DIR}'))
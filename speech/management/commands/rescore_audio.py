@@ -0,0 +1,204 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import connections
+from speech.config import get_prediction_config
+from speech.models import AudioFile, AudioEmbedding, PredictionResult
+from speech.registry import embedding_version
+
+# Per-process state for pool workers, set up once by _init_worker
+_worker = {}
+
+def _init_worker(prediction_settings, prompts, threads):
+    import django
+    django.setup()
+    from speech.cpu import configure_threads
+    from speech.registry import get_clap_model
+    configure_threads(intra_op_threads=threads)
+    _worker['model'] = get_clap_model()
+    if _worker['model'] is None:
+        raise RuntimeError('MS-CLAP model not initialized properly')
+    _worker['settings'] = prediction_settings
+    _worker['prompts'] = prompts
+
+def _score(batch):
+    """Encode the files without a stored embedding and score the whole batch.
+
+    Runs in pool workers, which never touch the database: everything they
+    need arrives in ``batch`` or through the initializer.
+    """
+    import numpy as np
+    import torch
+    clap_model = _worker['model']
+    ids = [item[0] for item in batch]
+    vectors = [item[2] for item in batch]
+
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        encoded = clap_model.get_audio_embeddings([batch[i][1] for i in missing])
+        for i, embedding in zip(missing, encoded):
+            vectors[i] = embedding.detach().cpu().numpy()
+
+    audio_emb = torch.from_numpy(np.stack(vectors).astype('float32'))
+    predictions = clap_model.classify_embeddings(audio_emb, _worker['settings'], _worker['prompts'])
+    return ids, vectors, [i in missing for i in range(len(batch))], predictions
+
+def _score_batch(batch):
+    """Like _score, but a batch that fails is retried one file at a time.
+
+    Returns _score's lists for the files that scored plus [(id, error)] for
+    those that didn't, so one corrupt file can't abort the run (and stop
+    every resume at the same place).
+    """
+    try:
+        return (*_score(batch), [])
+    except Exception as e:
+        if len(batch) == 1:
+            return [], [], [], [], [(batch[0][0], str(e) or type(e).__name__)]
+    scored = ([], [], [], [])
+    failed = []
+    for item in batch:
+        *result, item_failed = _score_batch([item])
+        for values, more in zip(scored, result):
+            values.extend(more)
+        failed.extend(item_failed)
+    return (*scored, failed)
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError(f"Invalid date '{value}', expected YYYY-MM-DD")
+
+class Command(BaseCommand):
+    help = 'Classify stored AudioFiles in bulk and save the results as PredictionResults'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Only audio uploaded by this username')
+        parser.add_argument('--since', help='Only audio uploaded on or after this date (YYYY-MM-DD)')
+        parser.add_argument('--until', help='Only audio uploaded on or before this date (YYYY-MM-DD)')
+        parser.add_argument('--batch-size', type=int, default=32,
+                            help='Files per audio-encoder forward pass (default: 32)')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Worker processes, each holding its own model copy (default: 1)')
+        parser.add_argument('--force', action='store_true',
+                            help='Recompute results that already exist for the active configuration')
+
+    def handle(self, *args, **options):
+        audio_files = AudioFile.objects.all()
+        if options['user']:
+            if not User.objects.filter(username=options['user']).exists():
+                raise CommandError(f"User '{options['user']}' does not exist")
+            audio_files = audio_files.filter(user__username=options['user'])
+        if options['since']:
+            audio_files = audio_files.filter(uploaded_at__date__gte=_parse_date(options['since']))
+        if options['until']:
+            audio_files = audio_files.filter(uploaded_at__date__lte=_parse_date(options['until']))
+
+        config = get_prediction_config()
+        prediction_settings, prompts, fingerprint = config.settings, list(config.prompts), config.fingerprint
+        if not prediction_settings or not prompts:
+            raise CommandError('No active prediction settings or classification prompts')
+
+        existing = PredictionResult.objects.filter(settings=prediction_settings, prompt_fingerprint=fingerprint)
+        if options['force']:
+            existing.filter(content_hash__in=audio_files.values('content_hash')).delete()
+        done_hashes = set(existing.values_list('content_hash', flat=True))
+
+        # Resume: skip audio whose content already has a result, and score each
+        # distinct recording only once
+        pending = {}
+        skipped = 0
+        for audio_file in audio_files.order_by('id'):
+            try:
+                content_hash = audio_file.ensure_content_hash()
+            except OSError as e:
+                self.stderr.write(f"Skipping audio file {audio_file.id}: {e}")
+                skipped += 1
+                continue
+            if content_hash not in done_hashes and content_hash not in pending:
+                pending[content_hash] = audio_file
+        pending = list(pending.values())
+        total = len(pending)
+        self.stdout.write(f"{total} recording(s) to score, {len(done_hashes)} already done")
+        if not total:
+            if skipped:
+                self.stdout.write(self.style.WARNING(f"Skipped {skipped} unreadable recording(s)"))
+            return
+
+        workers = max(1, options['workers'])
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        model_version = embedding_version()
+        batches = self.make_batches(pending, options['batch_size'], model_version)
+        by_id = {audio_file.id: audio_file for audio_file in pending}
+
+        if workers == 1:
+            _init_worker(prediction_settings, prompts, threads)
+            results = map(_score_batch, batches)
+        else:
+            # Forked children must not share the parent's database connection
+            connections.close_all()
+            executor = ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_worker,
+                initargs=(prediction_settings, prompts, threads),
+            )
+            results = self.bounded_map(executor, batches, window=workers * 2)
+
+        done = scored = 0
+        started = time.monotonic()
+        try:
+            for ids, vectors, is_new, predictions, failed in results:
+                for audio_file_id, error in failed:
+                    self.stderr.write(f"Skipping audio file {audio_file_id}: {error}")
+                skipped += len(failed)
+                new = [(by_id[i], vector) for i, vector, fresh in zip(ids, vectors, is_new) if fresh]
+                if new:
+                    AudioEmbedding.store([f for f, _ in new], [v for _, v in new], model_version)
+                PredictionResult.objects.bulk_create([
+                    PredictionResult(
+                        audio_file=by_id[i],
+                        content_hash=by_id[i].content_hash,
+                        settings=prediction_settings,
+                        prompt_fingerprint=fingerprint,
+                        result=prediction,
+                    )
+                    for i, prediction in zip(ids, predictions)
+                ], ignore_conflicts=True)
+
+                scored += len(ids)
+                done += len(ids) + len(failed)
+                rate = done / max(time.monotonic() - started, 1e-6)
+                self.stdout.write(f"[{done}/{total}] {rate:.1f} recordings/s")
+        finally:
+            if workers > 1:
+                executor.shutdown(cancel_futures=True)
+
+        if skipped:
+            self.stdout.write(self.style.WARNING(f"Scored {scored} recording(s), skipped {skipped} that failed"))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Scored {scored} recording(s)"))
+
+    def make_batches(self, audio_files, batch_size, model_version):
+        # A generator, so stored embeddings are only loaded as batches are dispatched
+        for start in range(0, len(audio_files), batch_size):
+            chunk = audio_files[start:start + batch_size]
+            stored = AudioEmbedding.load(chunk, model_version)
+            yield [
+                (audio_file.id, audio_file.audio_file.path, stored.get(audio_file.id))
+                for audio_file in chunk
+            ]
+
+    def bounded_map(self, executor, batches, window):
+        """Like executor.map, in order, but with at most ``window`` batches in flight."""
+        in_flight = deque()
+        for batch in batches:
+            in_flight.append(executor.submit(_score_batch, batch))
+            if len(in_flight) >= window:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
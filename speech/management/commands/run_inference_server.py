@@ -0,0 +1,64 @@
+import time
+import signal
+import threading
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from prometheus_client import start_http_server
+from speech.inference import InferenceServer
+from speech.registry import get_clap_model, get_prediction_batcher
+
+class Command(BaseCommand):
+    help = 'Hold one MS-CLAP model and serve predictions to web workers over a Unix socket'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=settings.CLAP_INFERENCE_SOCKET,
+                            help='Socket path (default: CLAP_INFERENCE_SOCKET)')
+        parser.add_argument('--metrics-port', type=int, default=settings.CLAP_INFERENCE_METRICS_PORT,
+                            help='Serve Prometheus metrics on this port, 0 for none '
+                                 '(default: CLAP_INFERENCE_METRICS_PORT)')
+
+    def handle(self, *args, **options):
+        socket_path = options['socket']
+        if not socket_path:
+            raise CommandError('No socket path: pass --socket or set CLAP_INFERENCE_SOCKET')
+
+        clap_model = get_clap_model()
+        prediction_batcher = get_prediction_batcher()
+        if clap_model is None or prediction_batcher is None:
+            raise CommandError('MS-CLAP model not initialized properly')
+
+        self.warm_up(clap_model)
+        server = InferenceServer(socket_path, clap_model, prediction_batcher)
+        if options['metrics_port']:
+            # Not a gunicorn worker, so its metrics aren't in the web tier's /metrics
+            start_http_server(options['metrics_port'])
+            self.stdout.write(f"Serving metrics on port {options['metrics_port']}")
+
+        def stop(signum, frame):
+            # shutdown() blocks until serve_forever() returns, so not from this thread
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        self.stdout.write(f"Inference server listening on {socket_path} "
+                          f"(embedding version {clap_model.embedding_version})")
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            server.cleanup_socket()
+        self.stdout.write("Inference server stopped")
+
+    def warm_up(self, clap_model):
+        # Nothing forks after this, so unlike registry.warm_up() it can run a
+        # prediction: that fills the text-embedding cache and starts torch's
+        # thread pool before the first client is kept waiting
+        started = time.perf_counter()
+        try:
+            clap_model.predict_batch([np.zeros(clap_model.clip_samples, dtype=np.float32)])
+        except Exception as e:
+            self.stderr.write(f"Warm-up prediction failed: {e}")
+            return
+        self.stdout.write(f"Warmed up in {time.perf_counter() - started:.2f}s")
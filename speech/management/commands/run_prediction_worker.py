@@ -0,0 +1,80 @@
+import os
+import socket
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from speech.models import PredictionJob, PredictionResult
+from speech.registry import get_clap_model
+
+class Command(BaseCommand):
+    help = 'Claim queued PredictionJobs from the database and run MS-CLAP on them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=8,
+                            help='Maximum jobs claimed and encoded together (default: 8)')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to sleep when the queue is empty (default: 1.0)')
+        parser.add_argument('--stale-after', type=int, default=600,
+                            help='Requeue running jobs older than this many seconds (default: 600)')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is empty instead of polling')
+
+    def handle(self, *args, **options):
+        clap_model = get_clap_model()
+        if clap_model is None:
+            raise CommandError('MS-CLAP model not initialized properly')
+
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+        stale_after = timedelta(seconds=options['stale_after'])
+        self.stdout.write(f"Prediction worker {worker} started")
+
+        while True:
+            close_old_connections()
+            requeued = PredictionJob.requeue_stale(stale_after)
+            if requeued:
+                self.stdout.write(self.style.WARNING(f"Requeued {requeued} stale job(s)"))
+
+            jobs = PredictionJob.claim(worker, limit=options['batch_size'])
+            if not jobs:
+                if options['once']:
+                    break
+                time.sleep(options['poll_interval'])
+                continue
+
+            self.run_jobs(clap_model, self.serve_cached(jobs))
+
+    def serve_cached(self, jobs):
+        """Complete jobs whose result is already stored; return the rest."""
+        pending = []
+        for job in jobs:
+            job.cache_key = PredictionResult.cache_key(job.audio_file) if job.audio_file else None
+            result = PredictionResult.lookup(job.cache_key) if job.cache_key else None
+            if result is None:
+                pending.append(job)
+            else:
+                job.complete(result)
+                self.stdout.write(f"Job {job.id} served from stored result")
+        return pending
+
+    def run_jobs(self, clap_model, jobs):
+        if not jobs:
+            return
+        try:
+            results = clap_model.predict_batch([job.audio_file or job.full_audio_path for job in jobs])
+        except Exception as e:
+            if len(jobs) > 1:
+                # Fall back to one at a time so a single bad file only fails its own job
+                self.stdout.write(self.style.WARNING(f"Batch failed ({e}), retrying individually"))
+                for job in jobs:
+                    self.run_jobs(clap_model, [job])
+            else:
+                jobs[0].fail(e)
+                self.stdout.write(self.style.ERROR(f"Job {jobs[0].id} failed: {e}"))
+            return
+
+        for job, result in zip(jobs, results):
+            if job.cache_key:
+                PredictionResult.store(job.audio_file, job.cache_key, result)
+            job.complete(result)
+            self.stdout.write(f"Job {job.id} completed: {result['classification']}")
@@ -0,0 +1,101 @@
+import io
+import os
+import time
+import numpy as np
+import torch
+from django.core.management.base import BaseCommand, CommandError
+from speech.benchmark import make_stub_model
+from speech.models import AudioFile
+from speech.utils import load_waveform
+
+AUDIO_EXTENSIONS = ('.wav', '.mp3', '.flac', '.ogg', '.m4a', '.webm')
+
+def serialized_size_mb(module):
+    # Counts int8 packed weights too, which parameters() does not see
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.tell() / (1024 * 1024)
+
+class Command(BaseCommand):
+    help = ('Compare int8-quantized MS-CLAP predictions with the float model on local audio, '
+            'reporting top-1 agreement, confidence drift and latency')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', help='Directory of audio files to use (default: stored AudioFiles)')
+        parser.add_argument('--limit', type=int, default=200, help='Maximum number of files (default: 200)')
+        parser.add_argument('--batch-size', type=int, default=16,
+                            help='Files per encoder pass (default: 16)')
+        parser.add_argument('--model', choices=['real', 'stub'], default='real',
+                            help="'real' msclap weights (default) or the offline stub from speech.benchmark")
+        parser.add_argument('--backend', help='Override CLAP_BACKEND for both models')
+        parser.add_argument('--min-agreement', type=float,
+                            help='Exit with an error if top-1 agreement (in %%) is below this')
+
+    def handle(self, *args, **options):
+        paths = self.sample_paths(options['dir'], options['limit'])
+        if not paths:
+            raise CommandError('No audio files to validate on')
+
+        float_model = self.build(options, quantize=False)
+        int8_model = self.build(options, quantize=True)
+        if not int8_model.quantized:
+            raise CommandError(f"The {int8_model.audio_encoder.backend} backend can't run quantized")
+
+        float_probs, int8_probs, timings = [], [], {'float': 0.0, 'int8': 0.0}
+        for start in range(0, len(paths), options['batch_size']):
+            # No waveform sidecars: --dir may point at someone else's sample set
+            waveforms = [load_waveform(path, float_model.sample_rate, cache=False,
+                                       duration=float_model.clip_duration)
+                         for path in paths[start:start + options['batch_size']]]
+            for name, model, out in [('float', float_model, float_probs), ('int8', int8_model, int8_probs)]:
+                started = time.perf_counter()
+                probabilities, prompt_names = model.score_embeddings(model.encode_waveforms(waveforms))
+                timings[name] += time.perf_counter() - started
+                out.append(probabilities.detach().cpu().numpy())
+            self.stdout.write(f"[{min(start + options['batch_size'], len(paths))}/{len(paths)}]")
+
+        float_probs, int8_probs = np.concatenate(float_probs), np.concatenate(int8_probs)
+        rows = np.arange(len(float_probs))
+        top1 = float_probs.argmax(axis=1)
+        agreement = float((top1 == int8_probs.argmax(axis=1)).mean() * 100)
+        # Change in confidence of the class the float model picked, in percentage points
+        drift = np.abs(float_probs[rows, top1] - int8_probs[rows, top1]) * 100
+        total_variation = 0.5 * np.abs(float_probs - int8_probs).sum(axis=1)
+
+        self.stdout.write(f"Files:                      {len(paths)}")
+        self.stdout.write(f"Top-1 agreement:            {agreement:.1f}%")
+        self.stdout.write(f"Confidence drift (pp):      mean {drift.mean():.2f}, "
+                          f"p95 {np.percentile(drift, 95):.2f}, max {drift.max():.2f}")
+        self.stdout.write(f"Mean total variation:       {total_variation.mean():.4f}")
+        self.stdout.write(f"Latency per file (ms):      float {timings['float'] / len(paths) * 1000:.1f}, "
+                          f"int8 {timings['int8'] / len(paths) * 1000:.1f}")
+        self.stdout.write(f"Serialized weights (MB):    float {serialized_size_mb(float_model.model.clap):.1f}, "
+                          f"int8 {serialized_size_mb(int8_model.model.clap):.1f}")
+
+        for i in np.flatnonzero(top1 != int8_probs.argmax(axis=1))[:10]:
+            self.stdout.write(f"  disagrees: {paths[i]} ({prompt_names[top1[i]]} -> "
+                              f"{prompt_names[int8_probs[i].argmax()]})")
+
+        if options['min_agreement'] is not None and agreement < options['min_agreement']:
+            raise CommandError(f"Top-1 agreement {agreement:.1f}% is below {options['min_agreement']:g}%")
+
+    def build(self, options, quantize):
+        if options['model'] == 'stub':
+            return make_stub_model(backend=options['backend'], quantize=quantize)
+        from speech.ms_clap import MSCLAPModel
+        try:
+            return MSCLAPModel(backend=options['backend'], quantize=quantize)
+        except Exception as e:
+            raise CommandError(f'MS-CLAP model could not be loaded: {e}')
+
+    def sample_paths(self, directory, limit):
+        if directory:
+            if not os.path.isdir(directory):
+                raise CommandError(f"'{directory}' is not a directory")
+            return sorted(
+                os.path.join(root, name)
+                for root, _, names in os.walk(directory)
+                for name in names if name.lower().endswith(AUDIO_EXTENSIONS)
+            )[:limit]
+        audio_files = AudioFile.objects.order_by('-uploaded_at')[:limit]
+        return [a.audio_file.path for a in audio_files if os.path.exists(a.audio_file.path)]
@@ -0,0 +1,105 @@
+"""Prometheus instrumentation for uploads and inference.
+
+Under gunicorn each worker is a separate process, so metric values are kept in
+PROMETHEUS_MULTIPROC_DIR (set by gunicorn.conf.py before anything imports
+prometheus_client) and merged by the /metrics view at scrape time. Without that
+variable, e.g. under runserver, the in-process registry is served directly.
+"""
+import os
+import time
+import logging
+from django.http import HttpResponse
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Gauge, Histogram,
+                               generate_latest)
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+
+logger = logging.getLogger(__name__)
+
+# 1 ms .. ~65 s, enough to tell a cache hit from a cold encoder pass
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+STAGE_SECONDS = Histogram(
+    'stuttersense_stage_seconds',
+    'Time spent in each stage of an upload or prediction',
+    ['stage'],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_SECONDS = Histogram(
+    'stuttersense_request_seconds',
+    'End-to-end API request latency',
+    ['view', 'method', 'status'],
+    buckets=LATENCY_BUCKETS,
+)
+BATCH_SIZE = Histogram(
+    'stuttersense_batch_size',
+    'Inputs per batched model call',
+    ['queue'],
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+QUEUE_DEPTH = Gauge(
+    'stuttersense_queue_depth',
+    'Work waiting in an in-process queue (batcher or request offload pool)',
+    ['queue'],
+    multiprocess_mode='livesum',
+)
+MODEL_LOAD_SECONDS = Gauge(
+    'stuttersense_model_load_seconds',
+    'Time taken to load the MS-CLAP model',
+    multiprocess_mode='max',
+)
+
+
+def timed(stage):
+    """Context manager recording the duration of ``stage`` in STAGE_SECONDS."""
+    return STAGE_SECONDS.labels(stage=stage).time()
+
+
+class TimedAPIViewMixin:
+    """Records request latency and response rendering time for an APIView."""
+
+    def dispatch(self, request, *args, **kwargs):
+        started = time.perf_counter()
+        response = super().dispatch(request, *args, **kwargs)
+        REQUEST_SECONDS.labels(
+            view=type(self).__name__, method=request.method, status=response.status_code
+        ).observe(time.perf_counter() - started)
+        return response
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        # Render here rather than in Django's handler so the time is attributed
+        if hasattr(response, 'render') and not response.is_rendered:
+            with timed('serialize'):
+                response.render()
+        return response
+
+
+class PredictionJobCollector:
+    """Reports the depth of the PredictionJob queue, read from the database at scrape time."""
+
+    def collect(self):
+        from django.db import DatabaseError
+        from django.db.models import Count
+        from .models import PredictionJob
+        try:
+            counts = dict(PredictionJob.objects.values_list('status').annotate(n=Count('id')))
+        except DatabaseError as e:
+            # The rest of the metrics are still worth serving
+            logger.warning(f"Could not count prediction jobs: {e}")
+            return
+        family = GaugeMetricFamily('stuttersense_prediction_jobs', 'PredictionJobs by status', labels=['status'])
+        for value, _ in PredictionJob.STATUS_CHOICES:
+            family.add_metric([value], counts.get(value, 0))
+        yield family
+
+
+def metrics_view(request):
+    """Serve all metrics in the Prometheus text exposition format."""
+    registry = CollectorRegistry()
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        MultiProcessCollector(registry)
+    else:
+        registry.register(REGISTRY)
+    registry.register(PredictionJobCollector())
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
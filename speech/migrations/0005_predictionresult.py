@@ -0,0 +1,35 @@
+# Generated by Django 5.2 on 2026-10-17 14:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('speech', '0004_predictionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audiofile',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, help_text='SHA-256 of the stored audio bytes', max_length=64),
+        ),
+        migrations.CreateModel(
+            name='PredictionResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64)),
+                ('prompt_fingerprint', models.CharField(max_length=64)),
+                ('result', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('audio_file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='prediction_results', to='speech.audiofile')),
+                ('settings', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='speech.predictionsettings')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+                'constraints': [models.UniqueConstraint(fields=('content_hash', 'settings', 'prompt_fingerprint'), name='unique_prediction_per_content_and_config')],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2 on 2026-10-17 14:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('speech', '0005_predictionresult'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AudioEmbedding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_version', models.CharField(max_length=50)),
+                ('dim', models.PositiveIntegerField()),
+                ('vector', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('audio_file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='embeddings', to='speech.audiofile')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('audio_file', 'model_version'), name='unique_embedding_per_model')],
+            },
+        ),
+    ]
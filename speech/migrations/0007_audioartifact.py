@@ -0,0 +1,55 @@
+# Generated by Django 5.2 on 2026-10-17 15:25
+
+import os
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def record_existing_waveforms(apps, schema_editor):
+    # Sidecars written before artifacts were tracked. Each directory is listed
+    # once, rather than once per AudioFile.
+    AudioFile = apps.get_model('speech', 'AudioFile')
+    AudioArtifact = apps.get_model('speech', 'AudioArtifact')
+    by_directory = {}
+    for audio_file_id, name in AudioFile.objects.exclude(audio_file='').values_list('id', 'audio_file'):
+        directory, filename = os.path.split(name)
+        by_directory.setdefault(directory, {})[filename] = audio_file_id
+
+    artifacts = []
+    for directory, audio_files in by_directory.items():
+        try:
+            filenames = os.listdir(os.path.join(settings.MEDIA_ROOT, directory))
+        except FileNotFoundError:
+            continue
+        for filename in filenames:
+            # <audio file>.<sample rate>.npy
+            parts = filename.rsplit('.', 2)
+            if len(parts) == 3 and parts[2] == 'npy' and parts[1].isdigit() and parts[0] in audio_files:
+                artifacts.append(AudioArtifact(audio_file_id=audio_files[parts[0]], kind='waveform',
+                                               path=os.path.join(directory, filename)))
+    AudioArtifact.objects.bulk_create(artifacts, batch_size=500, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('speech', '0006_audioembedding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AudioArtifact',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('waveform', 'Decoded waveform'), ('segment', 'Audio segment')], max_length=20)),
+                ('path', models.CharField(help_text='Path relative to MEDIA_ROOT, or absolute outside it', max_length=500)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('audio_file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='artifacts', to='speech.audiofile')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('audio_file', 'path'), name='unique_artifact_path')],
+            },
+        ),
+        migrations.RunPython(record_existing_waveforms, migrations.RunPython.noop),
+    ]
@@ -1,11 +1,15 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator, MaxValueValidator
 import uuid
 import os
+import hashlib
+import functools
+import numpy as np
 from django.conf import settings
 import logging
-from django.db.models.signals import pre_delete
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
 from django.dispatch import receiver
 
 # Set up logging
@@ -22,6 +26,8 @@ class AudioFile(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     audio_file = models.FileField(upload_to=user_directory_path)
     duration = models.FloatField()  # Duration in seconds
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True,
+                                    help_text="SHA-256 of the stored audio bytes")
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
@@ -30,62 +36,137 @@ class AudioFile(models.Model):
     def __str__(self):
         return f"{self.user.username}'s audio - {self.uploaded_at.strftime('%Y-%m-%d %H:%M')}"
 
-    def delete(self, *args, **kwargs):
-        # Get the file path before deletion
-        file_path = self.audio_file.path if self.audio_file else None
-        logger.info(f"Attempting to delete audio file: {file_path}")
-        
-        # Delete the main audio file
-        if self.audio_file:
-            try:
-                if os.path.isfile(self.audio_file.path):
-                    os.remove(self.audio_file.path)
-                    logger.info(f"Successfully deleted audio file: {self.audio_file.path}")
-                else:
-                    logger.warning(f"File does not exist: {self.audio_file.path}")
-            except Exception as e:
-                logger.error(f"Error deleting audio file: {e}")
-
-        # Delete any temporary files associated with this audio
+    def ensure_content_hash(self):
+        # Rows uploaded before content hashing existed are hashed on first use
+        if not self.content_hash and self.audio_file:
+            digest = hashlib.sha256()
+            with self.audio_file.open('rb') as f:
+                for chunk in f.chunks():
+                    digest.update(chunk)
+            self.content_hash = digest.hexdigest()
+            self.save(update_fields=['content_hash'])
+        return self.content_hash
+
+class AudioArtifact(models.Model):
+    """A file derived from an AudioFile, removed along with it.
+
+    Recording these when they are written means deleting an AudioFile is an
+    indexed lookup instead of a scan of the directories they live in.
+    """
+    KIND_WAVEFORM = 'waveform'
+    KIND_SEGMENT = 'segment'
+    KIND_CHOICES = [
+        (KIND_WAVEFORM, 'Decoded waveform'),
+        (KIND_SEGMENT, 'Audio segment'),
+    ]
+
+    audio_file = models.ForeignKey(AudioFile, on_delete=models.CASCADE, related_name='artifacts')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    path = models.CharField(max_length=500, help_text="Path relative to MEDIA_ROOT, or absolute outside it")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['audio_file', 'path'], name='unique_artifact_path'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} of audio {self.audio_file_id}: {self.path}"
+
+    @property
+    def full_path(self):
+        return os.path.join(settings.MEDIA_ROOT, self.path)
+
+    @staticmethod
+    def storage_path(path):
+        path = os.path.abspath(path)
+        media_root = os.path.abspath(settings.MEDIA_ROOT)
+        if os.path.commonpath([path, media_root]) == media_root:
+            return os.path.relpath(path, media_root)
+        return path
+
+    @classmethod
+    def record(cls, audio_file, path, kind):
+        # get_or_create tolerates another process recording the same file first
+        artifact, _ = cls.objects.get_or_create(
+            audio_file=audio_file, path=cls.storage_path(path), defaults={'kind': kind},
+        )
+        return artifact
+
+def remove_files(paths):
+    for path in paths:
         try:
-            temp_dir = os.path.join(settings.MEDIA_ROOT, 'temp')
-            if os.path.exists(temp_dir):
-                for filename in os.listdir(temp_dir):
-                    if str(self.id) in filename:
-                        file_path = os.path.join(temp_dir, filename)
-                        if os.path.isfile(file_path):
-                            os.remove(file_path)
-                            logger.info(f"Successfully deleted temporary file: {file_path}")
-        except Exception as e:
-            logger.error(f"Error deleting temporary files: {e}")
+            os.remove(path)
+            logger.info(f"Signal: Successfully deleted file: {path}")
+        except FileNotFoundError:
+            logger.warning(f"Signal: File does not exist: {path}")
+        except OSError as e:
+            logger.error(f"Signal: Error deleting file {path}: {e}")
 
-        super().delete(*args, **kwargs)
+def remove_after_commit(path):
+    # Only once the rows are really gone: a rolled back delete keeps its files
+    transaction.on_commit(functools.partial(remove_files, [path]))
 
-# Add signal to ensure file deletion even if model is deleted through queryset
-@receiver(pre_delete, sender=AudioFile)
+# Receivers rather than AudioFile.delete(), so queryset deletes clean up too.
+# Having a receiver for AudioArtifact makes the deletion collector fetch the
+# artifacts of a whole queryset in one query instead of fast-deleting them.
+@receiver(post_delete, sender=AudioFile)
 def delete_audio_file(sender, instance, **kwargs):
     if instance.audio_file:
-        try:
-            if os.path.isfile(instance.audio_file.path):
-                os.remove(instance.audio_file.path)
-                logger.info(f"Signal: Successfully deleted audio file: {instance.audio_file.path}")
-            else:
-                logger.warning(f"Signal: File does not exist: {instance.audio_file.path}")
-        except Exception as e:
-            logger.error(f"Signal: Error deleting audio file: {e}")
-
-    # Delete temporary files
-    try:
-        temp_dir = os.path.join(settings.MEDIA_ROOT, 'temp')
-        if os.path.exists(temp_dir):
-            for filename in os.listdir(temp_dir):
-                if str(instance.id) in filename:
-                    file_path = os.path.join(temp_dir, filename)
-                    if os.path.isfile(file_path):
-                        os.remove(file_path)
-                        logger.info(f"Signal: Successfully deleted temporary file: {file_path}")
-    except Exception as e:
-        logger.error(f"Signal: Error deleting temporary files: {e}")
+        remove_after_commit(instance.audio_file.path)
+
+@receiver(post_delete, sender=AudioArtifact)
+def delete_artifact_file(sender, instance, **kwargs):
+    remove_after_commit(instance.full_path)
+
+class AudioEmbedding(models.Model):
+    """CLAP audio embedding of an AudioFile, stored as a raw float32 blob.
+
+    Prompt and temperature changes only affect the text side and the softmax,
+    so with these stored, re-scoring audio is just a matrix multiply.
+    """
+    audio_file = models.ForeignKey(AudioFile, on_delete=models.CASCADE, related_name='embeddings')
+    model_version = models.CharField(max_length=50)
+    dim = models.PositiveIntegerField()
+    vector = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['audio_file', 'model_version'], name='unique_embedding_per_model'),
+        ]
+
+    def __str__(self):
+        return f"Embedding for audio {self.audio_file_id} ({self.model_version})"
+
+    def as_array(self):
+        return np.frombuffer(self.vector, dtype='<f4', count=self.dim)
+
+    @classmethod
+    def load(cls, audio_files, model_version):
+        """Map audio_file id -> float32 vector for the rows that have one stored."""
+        embeddings = cls.objects.filter(
+            audio_file__in=[audio_file.id for audio_file in audio_files],
+            model_version=model_version,
+        )
+        return {embedding.audio_file_id: embedding.as_array() for embedding in embeddings}
+
+    @classmethod
+    def store(cls, audio_files, vectors, model_version):
+        vectors = np.asarray(vectors, dtype='<f4')
+        cls.objects.bulk_create([
+            cls(audio_file=audio_file, model_version=model_version,
+                dim=vector.shape[0], vector=vector.tobytes())
+            for audio_file, vector in zip(audio_files, vectors)
+        ], ignore_conflicts=True)
+
+def prompt_set_key(prompt_texts, version=None):
+    """Stable hash of the CLAP version and the ordered prompt texts."""
+    digest = hashlib.sha256((version or settings.CLAP_VERSION).encode('utf-8'))
+    for text in prompt_texts:
+        digest.update(b'\0')
+        digest.update(text.encode('utf-8'))
+    return digest.hexdigest()
 
 class ClassificationPrompt(models.Model):
     name = models.CharField(max_length=50, help_text="Short name for the class (e.g., 'repetition')")
@@ -101,6 +182,42 @@ class ClassificationPrompt(models.Model):
     def __str__(self):
         return f"{self.name} ({'active' if self.is_active else 'inactive'})"
 
+    @property
+    def encoder_text(self):
+        """The text actually fed to the CLAP text encoder."""
+        return f"The/audio contains: {self.prompt}"
+
+    @classmethod
+    def get_active(cls):
+        """Active prompts by priority, creating the defaults if there are none.
+
+        Prefer speech.config.get_prediction_config(), which caches this.
+        """
+        try:
+            prompts = list(cls.objects.filter(is_active=True).order_by('-priority'))
+            if not prompts:
+                logger.info("No active prompts found, creating defaults")
+                defaults = [
+                    ('repetition', 'speech with stuttering characterized by repeated sounds or syllables'),
+                    ('prolongation', 'speech with stuttering featuring prolonged sounds'),
+                    ('blocks', 'speech with stuttering marked by silent blocks or pauses'),
+                    ('fillers', 'speech with stuttering including frequent interjections'),
+                    ('restarts', 'speech with stuttering involving phrase restarts or revisions'),
+                ]
+                for priority, (name, prompt) in enumerate(defaults):
+                    cls.objects.create(
+                        name=name,
+                        prompt=prompt,
+                        priority=len(defaults) - priority
+                    )
+                prompts = list(cls.objects.filter(is_active=True).order_by('-priority'))
+            logger.debug("active_prompts count=%d names=%s", len(prompts), ','.join(p.name for p in prompts))
+            return prompts
+
+        except Exception as e:
+            logger.exception(f"Error getting prompts: {e}")
+            return []
+
 class PredictionSettings(models.Model):
     name = models.CharField(max_length=100, unique=True)
     softmax_temperature = models.FloatField(
@@ -133,3 +250,173 @@ class PredictionSettings(models.Model):
 
     def __str__(self):
         return f"{self.name} ({'active' if self.is_active else 'inactive'})"
+
+    @classmethod
+    def get_active(cls):
+        """Prefer speech.config.get_prediction_config(), which caches this."""
+        try:
+            return cls.objects.filter(is_active=True).first() or \
+                   cls.objects.create(
+                       name="Default Settings",
+                       softmax_temperature=0.1,
+                       min_segment_duration=1.0,
+                       max_segment_duration=3.0,
+                       silence_threshold_db=15.0
+                   )
+        except Exception as e:
+            logger.error(f"Error getting settings: {e}")
+            return None
+
+class PredictionJob(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_COMPLETED = 'completed'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_COMPLETED, 'Completed'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    audio_file = models.ForeignKey(AudioFile, on_delete=models.CASCADE, null=True, blank=True)
+    audio_path = models.CharField(max_length=500, help_text="Audio path relative to MEDIA_ROOT")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=100, blank=True, help_text="Worker that claimed the job")
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [models.Index(fields=['status', 'created_at'])]
+
+    def __str__(self):
+        return f"Job {self.id} ({self.status})"
+
+    @property
+    def full_audio_path(self):
+        return os.path.join(settings.MEDIA_ROOT, self.audio_path)
+
+    @classmethod
+    def claim(cls, worker, limit=1):
+        """Atomically move up to ``limit`` of the oldest pending jobs to running.
+
+        The conditional UPDATE means two workers racing for the same row can't
+        both win it, without needing SELECT ... FOR UPDATE (unsupported on SQLite).
+        """
+        candidates = cls.objects.filter(status=cls.STATUS_PENDING).order_by('created_at')
+        claimed = []
+        for job_id in candidates.values_list('id', flat=True)[:limit]:
+            updated = cls.objects.filter(id=job_id, status=cls.STATUS_PENDING).update(
+                status=cls.STATUS_RUNNING,
+                worker=worker,
+                started_at=timezone.now(),
+            )
+            if updated:
+                claimed.append(job_id)
+        return list(cls.objects.filter(id__in=claimed).order_by('created_at'))
+
+    @classmethod
+    def requeue_stale(cls, older_than):
+        """Return jobs stuck in running (e.g. their worker died) to the queue."""
+        cutoff = timezone.now() - older_than
+        return cls.objects.filter(status=cls.STATUS_RUNNING, started_at__lt=cutoff).update(
+            status=cls.STATUS_PENDING,
+            worker='',
+            started_at=None,
+        )
+
+    def complete(self, result):
+        self.status = self.STATUS_COMPLETED
+        self.result = result
+        self.finished_at = timezone.now()
+        self.save(update_fields=['status', 'result', 'finished_at'])
+
+    def fail(self, error):
+        self.status = self.STATUS_FAILED
+        # Some decoder errors have no message; the type still says what went wrong
+        self.error = str(error) or type(error).__name__
+        self.finished_at = timezone.now()
+        self.save(update_fields=['status', 'error', 'finished_at'])
+
+class PredictionResult(models.Model):
+    """A stored classification, reused for any upload with identical audio bytes.
+
+    Results are keyed by what determines the model output: the audio content,
+    the settings row (temperature) and the prompt set. Prompt edits change the
+    fingerprint; settings edits clear that row's results via a signal below.
+    """
+    audio_file = models.ForeignKey(AudioFile, on_delete=models.CASCADE, related_name='prediction_results')
+    content_hash = models.CharField(max_length=64)
+    settings = models.ForeignKey(PredictionSettings, on_delete=models.CASCADE)
+    prompt_fingerprint = models.CharField(max_length=64)
+    result = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['content_hash', 'settings', 'prompt_fingerprint'],
+                name='unique_prediction_per_content_and_config',
+            ),
+        ]
+
+    def __str__(self):
+        return f"Prediction for audio {self.audio_file_id}: {self.result.get('classification')}"
+
+    @classmethod
+    def cache_key(cls, audio_file):
+        """(content_hash, settings, prompt_fingerprint) under the active configuration, or None."""
+        from .config import get_prediction_config
+        config = get_prediction_config()
+        if not config.settings or not config.prompts:
+            return None
+        return audio_file.ensure_content_hash(), config.settings, config.fingerprint
+
+    @classmethod
+    def lookup(cls, key):
+        content_hash, prediction_settings, fingerprint = key
+        return cls.objects.filter(
+            content_hash=content_hash,
+            settings=prediction_settings,
+            prompt_fingerprint=fingerprint,
+        ).values_list('result', flat=True).first()
+
+    @classmethod
+    def lookup_many(cls, keys):
+        """Stored results for several cache keys in one query, as {content_hash: result}.
+
+        All keys must come from the same configuration (see cache_key).
+        """
+        if not keys:
+            return {}
+        _, prediction_settings, fingerprint = keys[0]
+        return dict(cls.objects.filter(
+            content_hash__in={content_hash for content_hash, _, _ in keys},
+            settings=prediction_settings,
+            prompt_fingerprint=fingerprint,
+        ).values_list('content_hash', 'result'))
+
+    @classmethod
+    def store(cls, audio_file, key, result):
+        content_hash, prediction_settings, fingerprint = key
+        # get_or_create tolerates a concurrent request storing the same key first
+        prediction_result, _ = cls.objects.get_or_create(
+            content_hash=content_hash,
+            settings=prediction_settings,
+            prompt_fingerprint=fingerprint,
+            defaults={'audio_file': audio_file, 'result': result},
+        )
+        return prediction_result
+
+@receiver(post_save, sender=PredictionSettings)
+def clear_prediction_results(sender, instance, created, **kwargs):
+    # The settings id stays the same when softmax_temperature is edited, so
+    # results computed under the old values must not be served again.
+    if not created:
+        PredictionResult.objects.filter(settings=instance).delete()
@@ -1,123 +1,365 @@
 import os
+import threading
+import numpy as np
 import torch
 import torch.nn.functional as F
 from msclap import CLAP
-import traceback
-from .models import ClassificationPrompt, PredictionSettings
+import logging
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.conf import settings as django_settings
+from .registry import embedding_version
+from .utils import load_waveform, waveform_cache_path, segment_on_silence, sliding_windows, merge_window_scores
+from .backends import load_audio_encoder, quantize_dynamic_int8
+from .config import get_prediction_config
+from .cpu import ensure_configured as ensure_threads_configured
+from .metrics import timed
+from .models import AudioFile, AudioArtifact, AudioEmbedding, ClassificationPrompt, prompt_set_key
+
+logger = logging.getLogger(__name__)
+
+# Text embeddings keyed by prompt_set_key(); prompts rarely change, so the
+# text encoder only has to run once per distinct prompt set.
+_text_embedding_cache = {}
+_text_embedding_lock = threading.Lock()
+
+@receiver([post_save, post_delete], sender=ClassificationPrompt)
+def clear_text_embedding_cache(sender, **kwargs):
+    # Keys are content hashes, so stale entries can never be served; clearing
+    # just stops superseded prompt sets from piling up in memory.
+    with _text_embedding_lock:
+        _text_embedding_cache.clear()
 
 class MSCLAPModel:
-    def __init__(self):
+    def __init__(self, version=None, clap=None, backend=None, quantize=None, export=True):
+        """Load the msclap CLAP weights, or wrap ``clap`` if given (see speech/benchmark.py).
+
+        ``backend`` (default CLAP_BACKEND) selects how the audio encoder runs
+        and ``quantize`` (default CLAP_QUANTIZE) whether its linear layers run
+        in int8, see speech/backends.py. With ``export`` false a backend whose
+        artifact doesn't exist yet runs eager until load_backend() is called.
+        """
         try:
-            # Force CPU-only operation as in your Flask app
-            os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
-            print("Initializing MS-CLAP model...")
-            self.model = CLAP(version='2023', use_cuda=False)
-            print("MS-CLAP model initialized successfully")
-            
+            self.version = version or django_settings.CLAP_VERSION
+            ensure_threads_configured()
+            if clap is not None:
+                self.model = clap
+            else:
+                # Force CPU-only operation as in your Flask app
+                os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+                logger.info("Initializing MS-CLAP model...")
+                self.model = CLAP(version=self.version, use_cuda=False)
+            self.backend = backend or django_settings.CLAP_BACKEND
+            self.quantized = django_settings.CLAP_QUANTIZE if quantize is None else quantize
+            if self.quantized and self.backend == 'onnx':
+                logger.warning("CLAP_QUANTIZE is not supported by the onnx backend, running in float")
+                self.quantized = False
+            if self.quantized:
+                # Covers both the audio and the text encoder
+                quantize_dynamic_int8(self.model.clap)
+            self.load_backend(export=export)
+            logger.info(f"MS-CLAP model initialized successfully ({self.audio_encoder.backend} backend"
+                        f"{', int8' if self.quantized else ''})")
+
         except Exception as e:
-            print(f"Error initializing MS-CLAP model: {e}")
-            traceback.print_exc()
+            logger.exception(f"Error initializing MS-CLAP model: {e}")
             raise
 
+    def load_backend(self, export=True):
+        self.audio_encoder = load_audio_encoder(
+            self.model.clap.audio_encoder, self.backend, self.version, self.clip_samples, self.quantized,
+            export=export,
+        )
+        # Set when the artifact is still to be exported, see registry.load_pending_backend()
+        self.backend_pending = not export and self.audio_encoder.backend != self.backend
+
     def get_active_settings(self):
-        try:
-            return PredictionSettings.objects.filter(is_active=True).first() or \
-                   PredictionSettings.objects.create(
-                       name="Default Settings",
-                       softmax_temperature=0.1,
-                       min_segment_duration=1.0,
-                       max_segment_duration=3.0,
-                       silence_threshold_db=15.0
-                   )
-        except Exception as e:
-            print(f"Error getting settings: {e}")
-            return None
+        return get_prediction_config().settings
 
     def get_active_prompts(self):
-        try:
-            prompts = ClassificationPrompt.objects.filter(is_active=True).order_by('-priority')
-            print(f"Found {prompts.count()} active prompts in database")  # Debug log
-            
-            if prompts.exists():
-                # Log the prompts we're using
-                for p in prompts:
-                    print(f"Using prompt: {p.name} - {p.prompt} (priority: {p.priority})")
-                return prompts
-                
+        return get_prediction_config().prompts
+
+    def get_text_embeddings(self, prompt_texts):
+        # Keyed by embedding_version so a float and an int8 model never share entries
+        key = prompt_set_key(prompt_texts, self.embedding_version)
+        with _text_embedding_lock:
+            text_emb = _text_embedding_cache.get(key)
+        if text_emb is None:
+            with timed('text_embedding'):
+                text_emb = self.model.get_text_embeddings(prompt_texts)
+            with _text_embedding_lock:
+                _text_embedding_cache[key] = text_emb
+        return text_emb
+
+    def format_prediction(self, probabilities, prompt_names):
+        values, indices = probabilities.topk(min(3, len(prompt_names)))
+        return {
+            'classification': prompt_names[indices[0].item()],
+            'confidence': float(values[0].item() * 100),
+            'details': [
+                {
+                    'class': prompt_names[indices[i].item()],
+                    'confidence': float(values[i].item() * 100)
+                }
+                for i in range(len(indices))
+            ]
+        }
+
+    @property
+    def embedding_version(self):
+        """Identifies the encoder that produced a stored AudioEmbedding."""
+        return embedding_version(self.version, self.audio_encoder.backend, self.quantized)
+
+    @property
+    def sample_rate(self):
+        """Sample rate the audio encoder was trained on (44.1 kHz for CLAP 2023)."""
+        return self.model.args.sampling_rate
+
+    @property
+    def clip_duration(self):
+        """Seconds of audio the encoder sees per clip; the rest of a file is never read."""
+        return self.model.args.duration
+
+    @property
+    def clip_samples(self):
+        return int(self.clip_duration * self.sample_rate)
+
+    def fit_to_clip(self, waveform):
+        """Repeat-pad or trim a waveform to the encoder's fixed input length.
+
+        Mirrors msclap's own preprocessing, except that long clips are trimmed
+        from the start rather than at a random offset so results are repeatable.
+        """
+        if len(waveform) == 0:
+            raise ValueError("Audio contains no samples")
+        if len(waveform) < self.clip_samples:
+            waveform = np.tile(waveform, int(np.ceil(self.clip_samples / len(waveform))))
+        return waveform[:self.clip_samples]
+
+    def encode_waveforms(self, waveforms):
+        """Run the audio encoder on in-memory mono float32 waveforms at self.sample_rate.
+
+        Inputs are encoded CLAP_ENCODER_MAX_BATCH at a time so a long list of
+        segments can't allocate one enormous input tensor.
+        """
+        max_batch = django_settings.CLAP_ENCODER_MAX_BATCH
+        embeddings = []
+        for start in range(0, len(waveforms), max_batch):
+            chunk = waveforms[start:start + max_batch]
+            batch = torch.from_numpy(np.stack([self.fit_to_clip(w) for w in chunk]).astype(np.float32))
+            with timed('audio_embedding'):
+                embeddings.append(self.audio_encoder(batch))
+        return torch.cat(embeddings)
+
+    def load_waveform(self, audio_source, duration=None):
+        """Waveform of a path, AudioFile or array; only the first ``duration`` seconds if given."""
+        if isinstance(audio_source, np.ndarray):
+            return audio_source
+        if not isinstance(audio_source, AudioFile):
+            # Only an AudioFile's sidecar is recorded, and so removed with it:
+            # a bare path reuses an existing sidecar but never writes one
+            cached = os.path.exists(waveform_cache_path(audio_source, self.sample_rate))
+            with timed('audio_load'):
+                return load_waveform(audio_source, self.sample_rate, cache=cached, duration=duration)
+
+        path = audio_source.audio_file.path
+        cache_path = waveform_cache_path(path, self.sample_rate)
+        cached = os.path.exists(cache_path)
+        with timed('audio_load'):
+            waveform = load_waveform(path, self.sample_rate, duration=duration)
+        if not cached and os.path.exists(cache_path):
+            # So the sidecar is removed along with the AudioFile
+            AudioArtifact.record(audio_source, cache_path, AudioArtifact.KIND_WAVEFORM)
+        return waveform
+
+    def get_audio_embeddings(self, audio_sources):
+        """Audio embeddings for paths, AudioFile rows or waveforms, in input order.
+
+        AudioFile rows reuse embeddings stored by earlier predictions. For
+        everything else only the first clip is decoded (see utils.load_waveform),
+        CLAP_ENCODER_MAX_BATCH files at a time, so a large batch never holds
+        more than one encoder pass worth of audio. New embeddings of AudioFile
+        rows are stored for next time.
+        """
+        audio_files = [source for source in audio_sources if isinstance(source, AudioFile)]
+        stored = AudioEmbedding.load(audio_files, self.embedding_version) if audio_files else {}
+
+        rows = [None] * len(audio_sources)
+        missing = []
+        for i, source in enumerate(audio_sources):
+            if isinstance(source, AudioFile) and source.id in stored:
+                rows[i] = torch.from_numpy(stored[source.id].copy())
             else:
-                print("No prompts found, creating defaults...")  # Debug log
-                # Create default prompts if none exist
-                defaults = [
-                    ('repetition', 'speech with stuttering characterized by repeated sounds or syllables'),
-                    ('prolongation', 'speech with stuttering featuring prolonged sounds'),
-                    ('blocks', 'speech with stuttering marked by silent blocks or pauses'),
-                    ('fillers', 'speech with stuttering including frequent interjections'),
-                    ('restarts', 'speech with stuttering involving phrase restarts or revisions'),
-                ]
-                for priority, (name, prompt) in enumerate(defaults):
-                    ClassificationPrompt.objects.create(
-                        name=name,
-                        prompt=prompt,
-                        priority=len(defaults) - priority
-                    )
-                return ClassificationPrompt.objects.filter(is_active=True)
-                
-        except Exception as e:
-            print(f"Error getting prompts: {e}")
-            traceback.print_exc()  # Add full traceback for debugging
-            return []
+                missing.append(i)
 
-    def predict(self, audio_path):
-        try:
-            settings = self.get_active_settings()
-            if not settings:
-                raise ValueError("No active prediction settings found")
+        if missing:
+            new_files, new_vectors = [], []
+            max_batch = django_settings.CLAP_ENCODER_MAX_BATCH
+            for start in range(0, len(missing), max_batch):
+                chunk = missing[start:start + max_batch]
+                encoded = self.encode_waveforms(
+                    [self.load_waveform(audio_sources[i], self.clip_duration) for i in chunk]
+                )
+                for i, embedding in zip(chunk, encoded):
+                    rows[i] = embedding
+                    if isinstance(audio_sources[i], AudioFile):
+                        new_files.append(audio_sources[i])
+                        new_vectors.append(embedding.detach().cpu().numpy())
+            if new_files:
+                AudioEmbedding.store(new_files, new_vectors, self.embedding_version)
+
+        return torch.stack(rows)
 
-            prompts = self.get_active_prompts()
-            if not prompts:
-                raise ValueError("No active classification prompts found")
+    def score_embeddings(self, audio_emb, settings=None, prompts=None):
+        """Class probabilities (one row per embedding) and the matching class names.
 
-            # Debug logging
-            print(f"\nMaking prediction with {prompts.count()} prompts:")
-            for p in prompts:
-                print(f"- {p.name}: {p.prompt}")
+        Uses the given prompts and settings, or the active ones by default.
+        """
+        config = get_prediction_config()
+        settings = settings or config.settings
+        if not settings:
+            raise ValueError("No active prediction settings found")
 
-            # Generate prompts
-            prompt_texts = [f"The/audio contains: {p.prompt}" for p in prompts]
+        if prompts:
+            prompt_texts = [p.encoder_text for p in prompts]
             prompt_names = [p.name for p in prompts]
-            
-            # Get embeddings
-            audio_emb = self.model.get_audio_embeddings([audio_path], resample=True)
-            text_emb = self.model.get_text_embeddings(prompt_texts)
-            
-            # Compute similarity with dynamic temperature
+        else:
+            prompt_texts, prompt_names = config.prompt_texts, config.prompt_names
+        if not prompt_texts:
+            raise ValueError("No active classification prompts found")
+
+        logger.debug("score_embeddings batch=%d prompts=%d temperature=%s",
+                     len(audio_emb), len(prompt_texts), settings.softmax_temperature)
+        text_emb = self.get_text_embeddings(prompt_texts)
+
+        # Compute similarity with dynamic temperature
+        with timed('similarity'):
             similarity = self.model.compute_similarity(audio_emb, text_emb)
-            similarity = F.softmax(similarity / settings.softmax_temperature, dim=1)
-            values, indices = similarity[0].topk(min(3, len(prompts)))
-            
-            # Format results (removed settings_used and prompts_used)
-            return {
-                'classification': prompt_names[indices[0].item()],
-                'confidence': float(values[0].item() * 100),
-                'details': [
-                    {
-                        'class': prompt_names[indices[i].item()],
-                        'confidence': float(values[i].item() * 100)
-                    }
-                    for i in range(len(indices))
-                ]
-            }
-            
+            probabilities = F.softmax(similarity / settings.softmax_temperature, dim=1)
+        return probabilities, prompt_names
+
+    def classify_embeddings(self, audio_emb, settings=None, prompts=None):
+        """Score audio embeddings against the given (default: active) prompts and settings."""
+        probabilities, prompt_names = self.score_embeddings(audio_emb, settings, prompts)
+        return [self.format_prediction(row, prompt_names) for row in probabilities]
+
+    def predict_batch(self, audio_sources):
+        """Classify several files with a single audio-encoder forward pass.
+
+        Each source is a file path, an AudioFile or a waveform array; AudioFile
+        sources with a stored embedding skip the encoder entirely. Unlike predict(), errors
+        are raised rather than swallowed so that a batching caller can decide
+        how to report them per item.
+        """
+        return self.classify_embeddings(self.get_audio_embeddings(list(audio_sources)))
+
+    def predict_many(self, audio_sources):
+        """Like predict_batch, but one bad input only fails its own item.
+
+        Returns a prediction or the raised exception for each source, in order.
+        """
+        try:
+            return self.predict_batch(audio_sources)
         except Exception as e:
-            print(f"MS-CLAP prediction error: {e}")
-            traceback.print_exc()
-            return None
+            if len(audio_sources) == 1:
+                return [e]
+            logger.warning(f"Batch of {len(audio_sources)} failed ({e}), retrying items individually")
+        results = []
+        for audio_source in audio_sources:
+            try:
+                results.append(self.predict_batch([audio_source])[0])
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def predict_segments(self, audio_source):
+        """Classify a recording segment by segment.
+
+        The recording is decoded once and cut at silences into views of the
+        waveform, within the active PredictionSettings' segment bounds; silent
+        stretches never reach the encoder. All segments are then encoded
+        together and scored against the prompts in one pass. Each result
+        matches PredictionResultSerializer; a silent recording yields [].
+        """
+        settings = self.get_active_settings()
+        if not settings:
+            raise ValueError("No active prediction settings found")
+
+        waveform = self.load_waveform(audio_source)
+        segments = segment_on_silence(
+            waveform,
+            self.sample_rate,
+            min_duration=settings.min_segment_duration,
+            max_duration=settings.max_segment_duration,
+            silence_threshold_db=settings.silence_threshold_db,
+        )
+        if not segments:
+            return []
+
+        predictions = self.classify_embeddings(
+            self.encode_waveforms([samples for _, _, samples in segments]), settings
+        )
+        return [
+            {'segment_start': start, 'segment_end': end, **prediction}
+            for (start, end, _), prediction in zip(segments, predictions)
+        ]
+
+    def predict_timeline(self, audio_source, window=None, hop=None):
+        """Disfluency timeline from overlapping windows.
+
+        Every window goes through the audio encoder in one batch and is scored
+        against the prompt embeddings (computed once) in a single matrix
+        multiply. Window scores are averaged per hop-sized slot, and runs of
+        slots sharing a top class are merged into events.
+        """
+        window = window or django_settings.TIMELINE_WINDOW_SECONDS
+        hop = hop or django_settings.TIMELINE_HOP_SECONDS
+
+        waveform = self.load_waveform(audio_source)
+        windows = sliding_windows(waveform, self.sample_rate, window, hop)
+        if not windows:
+            raise ValueError("Audio contains no samples")
+        if len(windows) > django_settings.TIMELINE_MAX_WINDOWS:
+            raise ValueError(f"Timeline would need {len(windows)} windows, "
+                             f"at most {django_settings.TIMELINE_MAX_WINDOWS} are allowed")
+
+        probabilities, prompt_names = self.score_embeddings(
+            self.encode_waveforms([samples for _, _, samples in windows])
+        )
+        duration = len(waveform) / self.sample_rate
+        slot_starts, slot_ends, slot_scores = merge_window_scores(
+            [start for start, _, _ in windows],
+            [end for _, end, _ in windows],
+            probabilities.cpu().numpy(),
+            hop,
+            duration,
+        )
+
+        labels = slot_scores.argmax(axis=1)
+        confidences = slot_scores.max(axis=1) * 100
+        timeline = [
+            {'start': float(start), 'end': float(end),
+             'class': prompt_names[label], 'confidence': float(confidence)}
+            for start, end, label, confidence in zip(slot_starts, slot_ends, labels, confidences)
+        ]
 
-# Initialize the model when the module is loaded
-print("Initializing MS-CLAP model...")
-try:
-    clap_model = MSCLAPModel()
-    print("MS-CLAP model initialized successfully")
-except Exception as e:
-    print(f"Failed to initialize MS-CLAP model: {e}")
-    clap_model = None 
\ No newline at end of file
+        events = []
+        for slot in timeline:
+            if events and events[-1]['class'] == slot['class']:
+                event = events[-1]
+                event['end'] = slot['end']
+                event['slots'] += 1
+                event['confidence'] += (slot['confidence'] - event['confidence']) / event['slots']
+            else:
+                events.append(dict(slot, slots=1))
+        for event in events:
+            del event['slots']
+
+        return {'window': window, 'hop': hop, 'duration': duration, 'timeline': timeline, 'events': events}
+
+    def predict(self, audio_path):
+        try:
+            return self.predict_batch([audio_path])[0]
+        except Exception as e:
+            logger.exception(f"MS-CLAP prediction error: {e}")
+            return None
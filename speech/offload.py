@@ -0,0 +1,115 @@
+"""Async entry points for the upload and inference views.
+
+Under ASGI (opt-in uvicorn workers, see gunicorn.conf.py) a request body is
+read on the event loop, so slow clients cost no threads. The view body itself
+(decoding, hashing, the CLAP call) is CPU-bound and runs on a bounded
+thread pool: OFFLOAD_MAX_WORKERS requests run at once and at most
+OFFLOAD_MAX_PENDING more wait for a thread. Past that the request is turned
+away with 503 and a Retry-After header instead of joining an ever-growing
+queue.
+"""
+import os
+import asyncio
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from .metrics import QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+
+class Saturated(Exception):
+    """Raised by BoundedExecutor.submit when every thread and queue slot is taken."""
+
+
+class BoundedExecutor:
+    """Thread pool that refuses work instead of queueing it without limit."""
+
+    def __init__(self, max_workers, max_pending, name='offload'):
+        self.max_workers = max(1, int(max_workers))
+        self.max_pending = max(0, int(max_pending))
+        self.name = name
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+        self._slots = None
+        self._in_use = 0
+
+    def _ensure_pool(self):
+        # Threads don't survive fork, so a pool created in the gunicorn master
+        # is rebuilt in each worker
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+                self._slots = threading.BoundedSemaphore(self.max_workers + self.max_pending)
+                self._in_use = 0
+        return self._pool
+
+    def _run(self, fn, args, kwargs):
+        close_old_connections()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    def _release(self, future):
+        with self._lock:
+            self._in_use -= 1
+            QUEUE_DEPTH.labels(queue=self.name).set(max(0, self._in_use - self.max_workers))
+        self._slots.release()
+
+    def submit(self, fn, *args, **kwargs):
+        pool = self._ensure_pool()
+        if not self._slots.acquire(blocking=False):
+            raise Saturated(f'{self.name}: {self.max_workers} running and {self.max_pending} waiting')
+        with self._lock:
+            self._in_use += 1
+            QUEUE_DEPTH.labels(queue=self.name).set(max(0, self._in_use - self.max_workers))
+        try:
+            future = pool.submit(self._run, fn, args, kwargs)
+        except Exception:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = BoundedExecutor(settings.OFFLOAD_MAX_WORKERS, settings.OFFLOAD_MAX_PENDING)
+    return _executor
+
+
+def busy_response():
+    response = JsonResponse({
+        'error': 'Server busy',
+        'details': 'Too many requests in progress, please retry later'
+    }, status=503)
+    response['Retry-After'] = str(settings.OFFLOAD_RETRY_AFTER)
+    return response
+
+
+def offloaded(view):
+    """Async view running the synchronous ``view`` on the shared bounded executor."""
+
+    async def async_view(request, *args, **kwargs):
+        try:
+            return await get_executor().run(view, request, *args, **kwargs)
+        except Saturated as e:
+            logger.warning(f"Rejecting {request.method} {request.path}: {e}")
+            return busy_response()
+
+    async_view.__name__ = getattr(view, '__name__', 'async_view')
+    return csrf_exempt(async_view)
@@ -0,0 +1,130 @@
+"""Process-wide access to the MS-CLAP model.
+
+Nothing heavy is imported here: torch and msclap are only pulled in the first
+time get_clap_model() or warm_up() runs, so management commands and the URL
+conf stay as cheap to import as plain Django. Under ``gunicorn --preload`` the
+master calls warm_up() before forking, and workers then share the weights
+copy-on-write instead of each loading their own copy.
+"""
+import gc
+import time
+import threading
+import logging
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_clap_model = None
+_load_error = None
+_prediction_batcher = None
+
+
+def get_clap_model(export=True):
+    """Return the shared MSCLAPModel, loading it on first use.
+
+    Returns None if loading failed; the failure is remembered so a broken
+    install doesn't retry the load on every request. ``export`` is passed to
+    MSCLAPModel on that first load.
+    """
+    global _clap_model, _load_error
+    if _clap_model is None and _load_error is None:
+        with _lock:
+            if _clap_model is None and _load_error is None:
+                from .metrics import MODEL_LOAD_SECONDS
+                from .ms_clap import MSCLAPModel
+                started = time.perf_counter()
+                try:
+                    _clap_model = MSCLAPModel(export=export)
+                    MODEL_LOAD_SECONDS.set(time.perf_counter() - started)
+                except Exception as e:
+                    logger.error(f"Failed to initialize MS-CLAP model: {e}")
+                    _load_error = e
+    return _clap_model
+
+
+def get_prediction_batcher():
+    """Return the BatchScheduler that coalesces concurrent predictions."""
+    global _prediction_batcher
+    if _prediction_batcher is None:
+        clap_model = get_clap_model()
+        if clap_model is None:
+            return None
+        with _lock:
+            if _prediction_batcher is None:
+                from .batching import BatchScheduler
+                _prediction_batcher = BatchScheduler(
+                    clap_model.predict_batch,
+                    max_batch_size=settings.CLAP_BATCH_MAX_SIZE,
+                    max_wait_ms=settings.CLAP_BATCH_MAX_WAIT_MS,
+                    name='predict',
+                )
+    return _prediction_batcher
+
+
+def use_clap_model(clap_model):
+    """Replace the shared model, e.g. with a stub for benchmarks. Returns the previous one."""
+    global _clap_model, _load_error, _prediction_batcher
+    with _lock:
+        previous = _clap_model
+        _clap_model, _load_error, _prediction_batcher = clap_model, None, None
+    return previous
+
+
+def get_predictor():
+    """Callable that classifies one audio source: the inference daemon's client
+    when CLAP_INFERENCE_SOCKET is set, else the in-process batcher (None if
+    the model failed to load)."""
+    from .inference import get_inference_client
+    return get_inference_client() or get_prediction_batcher()
+
+
+def get_inference_model():
+    """Object providing predict_many(), predict_segments() and predict_timeline():
+    the inference daemon's client or the local model."""
+    from .inference import get_inference_client
+    return get_inference_client() or get_clap_model()
+
+
+def embedding_version(version=None, backend=None, quantized=None):
+    """Key under which AudioEmbeddings from the configured encoder are stored.
+
+    Exported backends and int8 weights round differently from eager float
+    PyTorch, so their embeddings are kept apart, e.g. ``2023+torchscript+int8``.
+    """
+    version = version or settings.CLAP_VERSION
+    backend = backend or settings.CLAP_BACKEND
+    if quantized is None:
+        quantized = settings.CLAP_QUANTIZE and backend != 'onnx'
+    if backend != 'eager':
+        version = f'{version}+{backend}'
+    return f'{version}+int8' if quantized else version
+
+
+def load_pending_backend():
+    """In a forked worker, export and switch to the backend warm_up() had to skip."""
+    if _clap_model is not None and getattr(_clap_model, 'backend_pending', False):
+        with _lock:
+            if _clap_model.backend_pending:
+                _clap_model.load_backend()
+    return _clap_model
+
+
+def is_loaded():
+    return _clap_model is not None
+
+
+def warm_up():
+    """Load the model eagerly, e.g. in the gunicorn master before forking.
+
+    No inference is run here: exercising torch's thread pool before fork can
+    leave the children deadlocked on OpenMP locks. That includes exporting the
+    audio encoder, so only an existing artifact is opened; otherwise workers
+    export it after fork (load_pending_backend). With an inference daemon
+    configured the web tier never loads the model.
+    """
+    clap_model = None if settings.CLAP_INFERENCE_SOCKET else get_clap_model(export=False)
+    # Move everything allocated so far into the permanent generation so the
+    # cyclic GC in forked workers never writes to (and so un-shares) its pages.
+    gc.freeze()
+    return clap_model
@@ -1,5 +1,6 @@
+from django.conf import settings
 from rest_framework import serializers
-from .models import AudioFile
+from .models import AudioFile, PredictionJob
 
 class AudioFileSerializer(serializers.ModelSerializer):
     class Meta:
@@ -16,4 +17,18 @@ class PredictionResultSerializer(serializers.Serializer):
 
 class AudioPredictionSerializer(serializers.Serializer):
     audio_url = serializers.URLField()
-    segments = PredictionResultSerializer(many=True) 
\ No newline at end of file
+    segments = PredictionResultSerializer(many=True)
+
+class BatchPredictionRequestSerializer(serializers.Serializer):
+    audio_file_ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        min_length=1,
+        max_length=settings.PREDICTION_BATCH_MAX_ITEMS,
+    )
+
+class PredictionJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PredictionJob
+        fields = ['id', 'audio_file', 'audio_path', 'status', 'result', 'error',
+                  'created_at', 'started_at', 'finished_at']
+        read_only_fields = fields
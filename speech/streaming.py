@@ -0,0 +1,230 @@
+"""Live disfluency detection over a WebSocket (ASGI only, see stuttersense_v1/asgi.py).
+
+A client connects to ``/ws/stream/?token=<JWT access token>`` and sends
+binary messages of mono PCM audio: 16-bit little-endian by default, or
+float32 with ``format=f32``. The ``sample_rate`` query parameter (default
+16000) gives the rate of that audio. Each connection keeps the most recent
+``window`` seconds in a ring buffer. Every ``hop`` seconds of new audio the
+window is classified, and the result is pushed back as JSON::
+
+    {"type": "prediction", "start": 12.0, "end": 15.0, "classification": ..., "confidence": ..., "details": [...]}
+
+Model calls run on a shared pool of STREAM_MAX_WORKERS threads, so the
+event loop never blocks. A connection never has more than one window in
+flight, and there are at most STREAM_MAX_CONNECTIONS connections per
+process, so the pool's queue is bounded too. If the model falls behind,
+newer windows replace older ones rather than queueing up, and a
+``{"type": "dropped"}`` message says how many were skipped.
+"""
+import json
+import asyncio
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .utils import SILENCE_FLOOR_DB
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+_connections = 0
+
+# Close codes in the 4000-4999 range reserved for applications
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_BAD_REQUEST = 4400
+CLOSE_TRY_AGAIN_LATER = 1013
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.STREAM_MAX_WORKERS,
+                                           thread_name_prefix='stream-inference')
+    return _executor
+
+
+class RingBuffer:
+    """Fixed-size buffer holding the most recent ``capacity`` samples."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._data = np.zeros(capacity, dtype=np.float32)
+        self._end = 0
+        self.total = 0
+
+    def write(self, samples):
+        samples = samples[-self.capacity:]
+        first = min(len(samples), self.capacity - self._end)
+        self._data[self._end:self._end + first] = samples[:first]
+        self._data[:len(samples) - first] = samples[first:]
+        self._end = (self._end + len(samples)) % self.capacity
+        self.total += len(samples)
+
+    def latest(self):
+        """Copy of the buffered samples, oldest first."""
+        if self.total < self.capacity:
+            return self._data[:self.total].copy()
+        return np.concatenate([self._data[self._end:], self._data[:self._end]])
+
+
+SAMPLE_WIDTHS = {'pcm16': 2, 'f32': 4}
+
+
+def decode_samples(data, sample_format):
+    if sample_format == 'f32':
+        return np.frombuffer(data, dtype='<f4').astype(np.float32)
+    return np.frombuffer(data, dtype='<i2').astype(np.float32) / 32768.0
+
+
+def classify_window(window, sample_rate):
+    """Runs on the executor: resample one window to the model's rate and classify it."""
+    import librosa
+    from .registry import get_inference_model, get_predictor
+    if window.size == 0 or 10 * np.log10(np.mean(window ** 2) + 1e-12) < SILENCE_FLOOR_DB:
+        return None
+    model = get_inference_model()
+    predictor = get_predictor()
+    if model is None or predictor is None:
+        raise RuntimeError('MS-CLAP model not initialized properly')
+    if sample_rate != model.sample_rate:
+        window = librosa.resample(window, orig_sr=sample_rate, target_sr=model.sample_rate)
+    return predictor(np.ascontiguousarray(window, dtype=np.float32))
+
+
+@sync_to_async
+def authenticate(token):
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+    from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+    authentication = JWTAuthentication()
+    try:
+        return authentication.get_user(authentication.get_validated_token(token))
+    except (InvalidToken, TokenError):
+        return None
+
+
+class StreamSession:
+    def __init__(self, send, sample_rate, sample_format, window, hop):
+        self.send = send
+        self.sample_rate = sample_rate
+        self.sample_format = sample_format
+        self.window = int(window * sample_rate)
+        self.hop = int(hop * sample_rate)
+        self.buffer = RingBuffer(self.window)
+        self.next_at = self.window
+        self.pending = None
+        self.in_flight = None
+        self.dropped = 0
+        # Trailing bytes of a sample split across two messages
+        self.partial = b''
+
+    async def receive_audio(self, data):
+        data = self.partial + data
+        usable = len(data) - len(data) % SAMPLE_WIDTHS[self.sample_format]
+        self.partial = data[usable:]
+        self.buffer.write(decode_samples(data[:usable], self.sample_format))
+        if self.buffer.total < self.next_at:
+            return
+        # Skip ahead rather than emitting one window per hop we fell behind by
+        behind = (self.buffer.total - self.next_at) // self.hop
+        self.next_at += (behind + 1) * self.hop
+        end = self.buffer.total
+        if self.pending is not None:
+            self.dropped += 1
+        self.pending = (self.buffer.latest(), end)
+        if self.in_flight is None:
+            self.in_flight = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while self.pending is not None:
+            window, end = self.pending
+            self.pending = None
+            if self.dropped:
+                await self.send_json({'type': 'dropped', 'count': self.dropped})
+                self.dropped = 0
+            try:
+                prediction = await loop.run_in_executor(get_executor(), classify_window, window, self.sample_rate)
+            except Exception as e:
+                logger.exception(f"Streaming prediction failed: {e}")
+                await self.send_json({'type': 'error', 'error': str(e)})
+                continue
+            start = (end - len(window)) / self.sample_rate
+            if prediction is None:
+                await self.send_json({'type': 'silence', 'start': start, 'end': end / self.sample_rate})
+            else:
+                await self.send_json({'type': 'prediction', 'start': start, 'end': end / self.sample_rate,
+                                      **prediction})
+        self.in_flight = None
+
+    async def send_json(self, message):
+        await self.send({'type': 'websocket.send', 'text': json.dumps(message)})
+
+    async def close(self):
+        if self.in_flight is not None:
+            self.in_flight.cancel()
+
+
+def parse_options(scope):
+    params = {key: values[-1] for key, values in parse_qs(scope.get('query_string', b'').decode()).items()}
+    sample_rate = int(params.get('sample_rate', 16000))
+    window = float(params.get('window', settings.TIMELINE_WINDOW_SECONDS))
+    hop = float(params.get('hop', settings.TIMELINE_HOP_SECONDS))
+    sample_format = params.get('format', 'pcm16')
+    if not 8000 <= sample_rate <= 48000:
+        raise ValueError('sample_rate must be between 8000 and 48000')
+    if not 0.1 <= hop <= window <= 30:
+        raise ValueError('Expected 0.1 <= hop <= window <= 30 seconds')
+    if sample_format not in ('pcm16', 'f32'):
+        raise ValueError("format must be 'pcm16' or 'f32'")
+    return params.get('token'), sample_rate, sample_format, window, hop
+
+
+async def reject(send, code, reason):
+    # Closing before the handshake completes shows up as a bare HTTP 403, so
+    # accept first to let the client see why
+    await send({'type': 'websocket.accept'})
+    await send({'type': 'websocket.close', 'code': code, 'reason': reason})
+
+
+async def stream_application(scope, receive, send):
+    """ASGI application for one WebSocket connection."""
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+
+    try:
+        token, sample_rate, sample_format, window, hop = parse_options(scope)
+    except ValueError as e:
+        await reject(send, CLOSE_BAD_REQUEST, str(e))
+        return
+    user = await authenticate(token) if token else None
+    if user is None:
+        await reject(send, CLOSE_UNAUTHORIZED, 'Authentication required')
+        return
+
+    global _connections
+    if _connections >= settings.STREAM_MAX_CONNECTIONS:
+        await reject(send, CLOSE_TRY_AGAIN_LATER, 'Too many live streams')
+        return
+    _connections += 1
+
+    try:
+        await send({'type': 'websocket.accept'})
+        session = StreamSession(send, sample_rate, sample_format, window, hop)
+        await session.send_json({'type': 'ready', 'window': window, 'hop': hop, 'sample_rate': sample_rate})
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'websocket.disconnect':
+                    break
+                if message.get('bytes'):
+                    await session.receive_audio(message['bytes'])
+        finally:
+            await session.close()
+    finally:
+        _connections -= 1
@@ -1,3 +1,966 @@
-from django.test import TestCase
+import io
+import json
+import asyncio
+import hashlib
+import threading
+import time
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock
+import numpy as np
+import soundfile as sf
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from . import config, janitor, registry
+from .registry import embedding_version
+from .admission import AdmissionStore, get_admission_store
+from .batching import BatchScheduler
+from .benchmark import make_stub_model
+from .streaming import RingBuffer, StreamSession, stream_application
+from .models import (AudioArtifact, AudioFile, AudioEmbedding, ClassificationPrompt, PredictionJob, PredictionResult,
+                     PredictionSettings)
+from .utils import (load_waveform, preprocess_and_split_audio, waveform_cache_path, segment_on_silence, sliding_windows, count_windows,
+                    merge_window_scores)
+from .views import (AudioFileUploadView, BatchPredictionView, PredictionView, SegmentPredictionView,
+                    TimelinePredictionView)
 
-# Create your tests here.
+SAMPLE_RATE = 16000
+
+
+def tone(seconds, sample_rate=SAMPLE_RATE, amplitude=0.5):
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    return (amplitude * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+
+
+def silence(seconds, sample_rate=SAMPLE_RATE):
+    return np.zeros(int(seconds * sample_rate), dtype=np.float32)
+
+
+class SpeechTestCase(TestCase):
+    """Runs with MEDIA_ROOT, TEMP_ROOT and the files shared between processes in a temp directory."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        overrides = override_settings(
+            MEDIA_ROOT=os.path.join(self.directory, 'media'),
+            TEMP_ROOT=os.path.join(self.directory, 'media', 'temp'),
+            SPEECH_CONFIG_VERSION_FILE=os.path.join(self.directory, '.speech_config_version'),
+            ADMISSION_DB_PATH=os.path.join(self.directory, 'admission.sqlite3'),
+            CLAP_ARTIFACT_DIR=os.path.join(self.directory, 'artifacts'),
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        # Each test has its own database rows, so never a snapshot of another's
+        config._snapshot = None
+        self.addCleanup(setattr, config, '_snapshot', None)
+
+    def use_stub_model(self, **kwargs):
+        model = make_stub_model(**kwargs)
+        self.addCleanup(registry.use_clap_model, registry.use_clap_model(model))
+        return model
+
+    def make_user(self, username):
+        return User.objects.create(username=username)
+
+    def make_audio_file(self, user, seconds=1.0, name=None, seed=0):
+        name = name or f'{user.username}-{AudioFile.objects.count()}.wav'
+        path = os.path.join(self.directory, 'media', 'audio_files', name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        rng = np.random.default_rng(seed)
+        sf.write(path, (0.1 * rng.standard_normal(int(seconds * SAMPLE_RATE))).astype(np.float32), SAMPLE_RATE)
+        return AudioFile.objects.create(user=user, audio_file=f'audio_files/{name}', duration=seconds)
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def call_view(self, view_class, user, method, path, data=None, format=None):
+        """Call a view directly, for those urls.py runs on the offload pool's threads.
+
+        The test database lives in this thread's transaction, which other
+        threads' connections can't see.
+        """
+        request = getattr(APIRequestFactory(), method)(path, data, format=format)
+        force_authenticate(request, user)
+        return view_class.as_view()(request)
+
+
+class PredictionJobTests(SpeechTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = self.make_user('owner')
+        self.other = self.make_user('other')
+        self.audio_file = self.make_audio_file(self.owner)
+
+    def test_owner_can_queue_a_job(self):
+        response = self.client_for(self.owner).post(
+            '/api/predict/jobs/', {'audio_url': f'/media/{self.audio_file.audio_file.name}'}, format='json')
+        self.assertEqual(response.status_code, 202)
+        job = PredictionJob.objects.get()
+        self.assertEqual(job.audio_file, self.audio_file)
+        self.assertEqual(job.user, self.owner)
+
+    def test_other_users_recordings_are_not_found(self):
+        response = self.client_for(self.other).post(
+            '/api/predict/jobs/', {'audio_url': f'/media/{self.audio_file.audio_file.name}'}, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(PredictionJob.objects.exists())
+
+    def test_paths_outside_media_root_are_rejected(self):
+        for audio_url in ['/media/../manage.py', '/media//etc/passwd', '/media/audio_files/../../x.wav']:
+            response = self.client_for(self.owner).post('/api/predict/jobs/', {'audio_url': audio_url}, format='json')
+            self.assertEqual(response.status_code, 400, audio_url)
+        self.assertFalse(PredictionJob.objects.exists())
+
+    def test_jobs_are_only_visible_to_their_owner(self):
+        job = PredictionJob.objects.create(user=self.owner, audio_file=self.audio_file,
+                                           audio_path=self.audio_file.audio_file.name)
+        self.assertEqual(self.client_for(self.owner).get(f'/api/predict/jobs/{job.id}/').status_code, 200)
+        self.assertEqual(self.client_for(self.other).get(f'/api/predict/jobs/{job.id}/').status_code, 404)
+
+    def test_claim_takes_the_oldest_pending_jobs_once(self):
+        jobs = [PredictionJob.objects.create(user=self.owner, audio_path=f'audio_files/{i}.wav') for i in range(3)]
+        first = PredictionJob.claim('worker-1', limit=2)
+        self.assertEqual([job.id for job in first], [jobs[0].id, jobs[1].id])
+        self.assertTrue(all(job.status == PredictionJob.STATUS_RUNNING and job.worker == 'worker-1'
+                            for job in first))
+        second = PredictionJob.claim('worker-2', limit=2)
+        self.assertEqual([job.id for job in second], [jobs[2].id])
+        self.assertEqual(PredictionJob.claim('worker-3'), [])
+
+    def run_worker(self):
+        self.use_stub_model()
+        stdout = io.StringIO()
+        call_command('run_prediction_worker', '--once', stdout=stdout)
+        return stdout.getvalue()
+
+    def test_worker_completes_jobs_and_fails_only_bad_ones(self):
+        broken = self.make_audio_file(self.owner, name='broken.wav')
+        with open(broken.audio_file.path, 'wb') as f:
+            f.write(b'not audio')
+        good, bad = [PredictionJob.objects.create(user=self.owner, audio_file=audio_file,
+                                                  audio_path=audio_file.audio_file.name)
+                     for audio_file in (self.audio_file, broken)]
+        self.run_worker()
+        good.refresh_from_db()
+        bad.refresh_from_db()
+        self.assertEqual(good.status, PredictionJob.STATUS_COMPLETED)
+        self.assertIn(good.result['classification'], config.get_prediction_config().prompt_names)
+        self.assertEqual(bad.status, PredictionJob.STATUS_FAILED)
+        self.assertTrue(bad.error)
+
+        repeat = PredictionJob.objects.create(user=self.owner, audio_file=self.audio_file,
+                                              audio_path=self.audio_file.audio_file.name)
+        self.assertIn(f'Job {repeat.id} served from stored result', self.run_worker())
+
+    def test_worker_requeues_jobs_of_dead_workers(self):
+        job = PredictionJob.objects.create(user=self.owner, audio_file=self.audio_file,
+                                           audio_path=self.audio_file.audio_file.name)
+        PredictionJob.claim('dead-worker')
+        PredictionJob.objects.filter(id=job.id).update(started_at=job.created_at - timedelta(hours=1))
+        self.assertIn('Requeued 1 stale job(s)', self.run_worker())
+        job.refresh_from_db()
+        self.assertEqual(job.status, PredictionJob.STATUS_COMPLETED)
+        self.assertNotEqual(job.worker, 'dead-worker')
+
+
+class PredictionConfigTests(SpeechTestCase):
+    def test_snapshot_is_reused_until_the_config_changes(self):
+        first = config.get_prediction_config()
+        self.assertIs(config.get_prediction_config(), first)
+
+        prompt = first.prompts[0]
+        with self.captureOnCommitCallbacks(execute=True):
+            prompt.prompt = 'speech with many repeated words'
+            prompt.save()
+        second = config.get_prediction_config()
+        self.assertIsNot(second, first)
+        self.assertNotEqual(second.fingerprint, first.fingerprint)
+        self.assertIn('The/audio contains: speech with many repeated words', second.prompt_texts)
+
+    def test_version_file_bump_from_another_process_reloads(self):
+        first = config.get_prediction_config()
+        config.bump_version()
+        self.assertIsNot(config.get_prediction_config(), first)
+
+    def test_failed_query_is_not_cached(self):
+        with mock.patch.object(ClassificationPrompt, 'get_active', return_value=[]):
+            self.assertEqual(config.get_prediction_config().prompts, ())
+        self.assertEqual(len(config.get_prediction_config().prompts), 5)
+
+
+class WaveformLoadingTests(SpeechTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user('owner')
+
+    def test_sidecar_is_written_once_and_reused(self):
+        path = self.make_audio_file(self.user, seconds=2).audio_file.path
+        waveform = load_waveform(path, SAMPLE_RATE)
+        self.assertEqual(len(waveform), 2 * SAMPLE_RATE)
+        self.assertTrue(os.path.exists(waveform_cache_path(path, SAMPLE_RATE)))
+        with mock.patch('librosa.load') as decode:
+            self.assertEqual(len(load_waveform(path, SAMPLE_RATE)), 2 * SAMPLE_RATE)
+            self.assertEqual(len(load_waveform(path, SAMPLE_RATE, duration=0.5)), SAMPLE_RATE // 2)
+        decode.assert_not_called()
+
+    def test_duration_decodes_only_the_start_and_writes_nothing(self):
+        path = self.make_audio_file(self.user, seconds=3).audio_file.path
+        self.assertEqual(len(load_waveform(path, SAMPLE_RATE, duration=1)), SAMPLE_RATE)
+        self.assertFalse(os.path.exists(waveform_cache_path(path, SAMPLE_RATE)))
+
+    @override_settings(WAVEFORM_CACHE_MAX_SECONDS=1)
+    def test_long_recordings_are_not_cached(self):
+        path = self.make_audio_file(self.user, seconds=2).audio_file.path
+        self.assertEqual(len(load_waveform(path, SAMPLE_RATE)), 2 * SAMPLE_RATE)
+        self.assertFalse(os.path.exists(waveform_cache_path(path, SAMPLE_RATE)))
+
+    @override_settings(CLAP_ENCODER_MAX_BATCH=2)
+    def test_audio_embeddings_read_one_clip_per_file_a_chunk_at_a_time(self):
+        model = make_stub_model(duration=1)
+        audio_files = [self.make_audio_file(self.user, seconds=3, seed=i) for i in range(5)]
+        with mock.patch.object(model, 'encode_waveforms', wraps=model.encode_waveforms) as encode:
+            embeddings = model.get_audio_embeddings(audio_files)
+        self.assertEqual(embeddings.shape[0], 5)
+        self.assertEqual([len(call.args[0]) for call in encode.call_args_list], [2, 2, 1])
+        for call in encode.call_args_list:
+            self.assertTrue(all(len(waveform) == model.clip_samples for waveform in call.args[0]))
+        self.assertFalse(any(os.path.exists(waveform_cache_path(f.audio_file.path, model.sample_rate))
+                             for f in audio_files))
+
+
+class RescoreAudioTests(SpeechTestCase):
+    def test_a_corrupt_file_is_skipped_not_fatal(self):
+        self.use_stub_model()
+        user = self.make_user('owner')
+        audio_files = [self.make_audio_file(user, seed=i) for i in range(3)]
+        with open(audio_files[1].audio_file.path, 'wb') as f:
+            f.write(b'not audio at all')
+
+        out, err = io.StringIO(), io.StringIO()
+        call_command('rescore_audio', batch_size=3, stdout=out, stderr=err)
+        self.assertIn(f'Skipping audio file {audio_files[1].id}', err.getvalue())
+        self.assertIn('Scored 2 recording(s), skipped 1', out.getvalue())
+        self.assertEqual(set(PredictionResult.objects.values_list('audio_file_id', flat=True)),
+                         {audio_files[0].id, audio_files[2].id})
+        self.assertEqual(AudioEmbedding.objects.count(), 2)
+
+        # A resume only retries the file that failed
+        out = io.StringIO()
+        call_command('rescore_audio', stdout=out, stderr=io.StringIO())
+        self.assertIn('1 recording(s) to score, 2 already done', out.getvalue())
+
+
+class InferenceServerWarmUpTests(SpeechTestCase):
+    def test_warm_up_fills_the_text_embedding_cache(self):
+        from .management.commands.run_inference_server import Command
+        from . import ms_clap
+        model = self.use_stub_model()
+        ms_clap._text_embedding_cache.clear()
+        out = io.StringIO()
+        Command(stdout=out, stderr=io.StringIO()).warm_up(model)
+        self.assertIn('Warmed up', out.getvalue())
+        self.assertEqual(len(ms_clap._text_embedding_cache), 1)
+
+
+class AudioUploadTests(SpeechTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user('owner')
+
+    def wav_bytes(self, seconds):
+        buffer = io.BytesIO()
+        sf.write(buffer, np.zeros(int(seconds * SAMPLE_RATE), dtype=np.float32), SAMPLE_RATE, format='WAV')
+        buffer.seek(0)
+        buffer.name = 'clip.wav'
+        return buffer
+
+    def upload_directory(self):
+        return os.path.join(self.directory, 'media', 'audio_files')
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=0)
+    def test_upload_is_written_in_place_without_a_temp_copy(self):
+        upload = self.wav_bytes(2)
+        content = upload.getvalue()
+        with mock.patch('django.core.files.uploadedfile.TemporaryUploadedFile.__init__') as spooled:
+            response = self.call_view(AudioFileUploadView, self.user, 'post', '/api/upload/',
+                                      {'audio_file': upload}, format='multipart')
+        spooled.assert_not_called()
+        self.assertEqual(response.status_code, 201, response.content)
+
+        audio_file = AudioFile.objects.get()
+        self.assertAlmostEqual(audio_file.duration, 2.0)
+        self.assertEqual(audio_file.content_hash, hashlib.sha256(content).hexdigest())
+        with open(audio_file.audio_file.path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(os.listdir(self.upload_directory()), [os.path.basename(audio_file.audio_file.name)])
+
+    @override_settings(AUDIO_MAX_DURATION=1)
+    def test_rejected_upload_leaves_nothing_behind(self):
+        response = self.call_view(AudioFileUploadView, self.user, 'post', '/api/upload/',
+                                  {'audio_file': self.wav_bytes(2)}, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(AudioFile.objects.exists())
+        self.assertEqual(os.listdir(self.upload_directory()), [])
+
+
+class SegmentOnSilenceTests(TestCase):
+    # 1024-sample frames are exactly 1/16 s at this rate
+    rate = 16384
+
+    def segment(self, waveform, min_duration=0.5, max_duration=4.0):
+        return segment_on_silence(waveform, self.rate, min_duration, max_duration, silence_threshold_db=30)
+
+    def test_silent_input_has_no_segments(self):
+        self.assertEqual(self.segment(silence(3, self.rate)), [])
+        self.assertEqual(self.segment(tone(0.01, self.rate)), [])
+
+    def test_short_pause_is_merged(self):
+        waveform = np.concatenate([silence(1, self.rate), tone(1, self.rate), silence(0.25, self.rate),
+                                   tone(1, self.rate), silence(1, self.rate)])
+        segments = self.segment(waveform)
+        self.assertEqual([(start, end) for start, end, _ in segments], [(1.0, 3.25)])
+
+    def test_long_pause_splits_utterances(self):
+        waveform = np.concatenate([silence(1, self.rate), tone(1, self.rate), silence(1, self.rate),
+                                   tone(1, self.rate), silence(1, self.rate)])
+        segments = self.segment(waveform)
+        self.assertEqual([(start, end) for start, end, _ in segments], [(1.0, 2.0), (3.0, 4.0)])
+
+    def test_short_run_is_widened_to_min_duration(self):
+        waveform = np.concatenate([silence(2, self.rate), tone(0.125, self.rate), silence(2, self.rate)])
+        [(start, end, samples)] = self.segment(waveform, min_duration=1.0)
+        self.assertAlmostEqual(end - start, 1.0)
+        self.assertLessEqual(start, 2.0)
+        self.assertGreaterEqual(end, 2.125)
+        self.assertEqual(len(samples), self.rate)
+
+    def test_short_run_at_the_edge_stays_inside_the_audio(self):
+        waveform = np.concatenate([tone(0.125, self.rate), silence(2, self.rate)])
+        [(start, end, _)] = self.segment(waveform, min_duration=1.0)
+        self.assertEqual((start, end), (0.0, 1.0))
+
+    def test_long_run_is_split_evenly(self):
+        waveform = np.concatenate([silence(1, self.rate), tone(9, self.rate), silence(1, self.rate)])
+        segments = self.segment(waveform, max_duration=4.0)
+        self.assertEqual(len(segments), 3)
+        self.assertEqual(segments[0][0], 1.0)
+        self.assertEqual(segments[-1][1], 10.0)
+        for (_, end, _), (start, _, _) in zip(segments, segments[1:]):
+            self.assertEqual(end, start)
+        for start, end, samples in segments:
+            self.assertLessEqual(end - start, 4.0)
+            self.assertEqual(len(samples), round((end - start) * self.rate))
+
+    def test_trailing_partial_frame_is_kept(self):
+        waveform = tone(2.01, self.rate)
+        [(start, end, samples)] = self.segment(waveform)
+        self.assertEqual(start, 0.0)
+        self.assertEqual(len(samples), len(waveform))
+
+
+class PredictSegmentsTests(SpeechTestCase):
+    def setUp(self):
+        super().setUp()
+        self.model = self.use_stub_model()
+        self.rate = self.model.sample_rate
+
+    def test_segments_follow_the_active_prediction_settings(self):
+        PredictionSettings.objects.create(name='Short segments', min_segment_duration=0.5,
+                                          max_segment_duration=2.0, silence_threshold_db=30)
+        waveform = np.concatenate([silence(1, self.rate), tone(5, self.rate), silence(1, self.rate)])
+        segments = self.model.predict_segments(waveform)
+        self.assertEqual(len(segments), 3)
+        self.assertAlmostEqual(segments[0]['segment_start'], 1.0, delta=0.05)
+        self.assertAlmostEqual(segments[-1]['segment_end'], 6.0, delta=0.05)
+        for segment in segments:
+            self.assertLessEqual(segment['segment_end'] - segment['segment_start'], 2.0)
+            self.assertIn(segment['classification'], config.get_prediction_config().prompt_names)
+
+        config._snapshot = None
+        PredictionSettings.objects.update(max_segment_duration=6.0)
+        self.assertEqual(len(self.model.predict_segments(waveform)), 1)
+
+    def test_silent_recording_has_no_segments(self):
+        self.assertEqual(self.model.predict_segments(silence(3, self.rate)), [])
+
+
+class SlidingWindowTests(TestCase):
+    def test_windows_cover_the_tail(self):
+        windows = sliding_windows(np.arange(10, dtype=np.float32), 1, window=4, hop=3)
+        self.assertEqual([(start, end) for start, end, _ in windows], [(0, 4), (3, 7), (6, 10)])
+        self.assertEqual(windows[-1][2].tolist(), [6, 7, 8, 9])
+
+    def test_end_aligned_window_is_added(self):
+        windows = sliding_windows(np.arange(11, dtype=np.float32), 1, window=4, hop=3)
+        self.assertEqual([(start, end) for start, end, _ in windows], [(0, 4), (3, 7), (6, 10), (7, 11)])
+
+    def test_audio_shorter_than_a_window(self):
+        windows = sliding_windows(np.arange(3, dtype=np.float32), 1, window=4, hop=2)
+        self.assertEqual([(start, end) for start, end, _ in windows], [(0, 3)])
+        self.assertEqual(sliding_windows(np.zeros(0, dtype=np.float32), 1, window=4, hop=2), [])
+
+    def test_count_windows_matches(self):
+        for samples in range(1, 40):
+            for window, hop in [(4, 1), (4, 3), (5, 5), (2, 0.5)]:
+                waveform = np.zeros(samples, dtype=np.float32)
+                self.assertEqual(count_windows(samples / 4, window, hop),
+                                 len(sliding_windows(waveform, 4, window, hop)), (samples, window, hop))
+
+
+class MergeWindowScoresTests(TestCase):
+    def test_overlapping_windows_are_averaged(self):
+        scores = np.array([[1.0, 0.0], [3.0, 2.0]])
+        starts, ends, slot_scores = merge_window_scores([0, 1], [2, 3], scores, hop=1, duration=3)
+        self.assertEqual(starts.tolist(), [0, 1, 2])
+        self.assertEqual(ends.tolist(), [1, 2, 3])
+        self.assertEqual(slot_scores.tolist(), [[1.0, 0.0], [2.0, 1.0], [3.0, 2.0]])
+
+    def test_last_slot_ends_with_the_audio(self):
+        scores = np.array([[1.0], [2.0]])
+        _, ends, slot_scores = merge_window_scores([0, 1.5], [2, 2.5], scores, hop=1, duration=2.5)
+        self.assertEqual(ends.tolist(), [1, 2, 2.5])
+        self.assertEqual(slot_scores[:, 0].tolist(), [1.0, 1.5, 2.0])
+
+    def test_slot_without_windows_scores_zero(self):
+        scores = np.array([[1.0], [2.0]])
+        _, _, slot_scores = merge_window_scores([0, 3], [1, 4], scores, hop=1, duration=4)
+        self.assertEqual(slot_scores[:, 0].tolist(), [1.0, 0.0, 0.0, 2.0])
+
+
+class TimelinePredictionTests(SpeechTestCase):
+    def setUp(self):
+        super().setUp()
+        self.model = self.use_stub_model()
+        self.owner = self.make_user('owner')
+        self.audio_file = self.make_audio_file(self.owner, seconds=5)
+        self.audio_url = f'/media/{self.audio_file.audio_file.name}'
+
+    def get_timeline(self, user, **params):
+        return self.call_view(TimelinePredictionView, user, 'get', '/api/predict/timeline/',
+                              {'audio_url': self.audio_url, **params})
+
+    def test_timeline_has_a_slot_per_hop(self):
+        response = self.get_timeline(self.owner, window=2, hop=1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['duration'], 5)
+        self.assertEqual([slot['start'] for slot in response.data['timeline']], [0, 1, 2, 3, 4])
+        self.assertEqual(response.data['timeline'][-1]['end'], 5)
+        events = response.data['events']
+        self.assertEqual((events[0]['start'], events[-1]['end']), (0, 5))
+        for event, following in zip(events, events[1:]):
+            self.assertEqual(event['end'], following['start'])
+            self.assertNotEqual(event['class'], following['class'])
+
+    def test_windows_are_encoded_in_one_batch(self):
+        with mock.patch.object(self.model, 'encode_waveforms', wraps=self.model.encode_waveforms) as encode:
+            self.assertEqual(self.get_timeline(self.owner, window=2, hop=1).status_code, 200)
+        encode.assert_called_once()
+        self.assertEqual(len(encode.call_args.args[0]), count_windows(5, 2, 1))
+
+    def test_other_users_recordings_are_not_found(self):
+        self.assertEqual(self.get_timeline(self.make_user('other')).status_code, 404)
+
+    def test_invalid_window_and_hop_are_rejected(self):
+        for params in [{'window': 'long'}, {'window': 1, 'hop': 2}, {'hop': 0.01}, {'window': 60}]:
+            self.assertEqual(self.get_timeline(self.owner, **params).status_code, 400, params)
+
+    @override_settings(TIMELINE_MAX_WINDOWS=3)
+    def test_too_many_windows_are_refused_before_encoding(self):
+        with mock.patch.object(self.model, 'encode_waveforms') as encode:
+            response = self.get_timeline(self.owner, window=2, hop=1)
+        self.assertEqual(response.status_code, 400)
+        encode.assert_not_called()
+
+
+class RingBufferTests(TestCase):
+    def test_keeps_everything_until_full(self):
+        buffer = RingBuffer(5)
+        buffer.write(np.array([1, 2], dtype=np.float32))
+        buffer.write(np.array([3], dtype=np.float32))
+        self.assertEqual(buffer.latest().tolist(), [1, 2, 3])
+        self.assertEqual(buffer.total, 3)
+
+    def test_wraps_around_keeping_the_newest(self):
+        buffer = RingBuffer(5)
+        for chunk in ([1, 2, 3], [4, 5, 6], [7]):
+            buffer.write(np.array(chunk, dtype=np.float32))
+        self.assertEqual(buffer.latest().tolist(), [3, 4, 5, 6, 7])
+        self.assertEqual(buffer.total, 7)
+
+    def test_write_larger_than_capacity(self):
+        buffer = RingBuffer(4)
+        buffer.write(np.array([1], dtype=np.float32))
+        buffer.write(np.arange(2, 12, dtype=np.float32))
+        self.assertEqual(buffer.latest().tolist(), [8, 9, 10, 11])
+
+    def test_latest_is_a_copy(self):
+        buffer = RingBuffer(3)
+        buffer.write(np.array([1, 2], dtype=np.float32))
+        buffer.latest()[0] = 9
+        self.assertEqual(buffer.latest().tolist(), [1, 2])
+
+
+class StreamSessionTests(TestCase):
+    rate = 8000
+
+    def pcm16(self, seconds):
+        return (tone(seconds, self.rate) * 32767).astype('<i2').tobytes()
+
+    def stream(self, *chunks):
+        """Feed ``chunks`` to a session with a 1 s window and 0.5 s hop, returning the messages sent.
+
+        Chunks inside one tuple arrive without the event loop running in between.
+        """
+        async def scenario():
+            messages = []
+
+            async def send(message):
+                messages.append(json.loads(message['text']))
+            session = StreamSession(send, self.rate, 'pcm16', window=1.0, hop=0.5)
+            for burst in chunks:
+                for data in burst:
+                    await session.receive_audio(data)
+                if session.in_flight is not None:
+                    await session.in_flight
+            return messages
+
+        prediction = {'classification': 'Fluent', 'confidence': 90.0, 'details': []}
+        with mock.patch('speech.streaming.classify_window', return_value=prediction) as classify:
+            messages = asyncio.run(scenario())
+        return messages, classify
+
+    def test_a_window_is_classified_every_hop(self):
+        messages, classify = self.stream((self.pcm16(1.0),), (self.pcm16(0.25),), (self.pcm16(0.25),))
+        self.assertEqual([(m['type'], m['start'], m['end']) for m in messages],
+                         [('prediction', 0.0, 1.0), ('prediction', 0.5, 1.5)])
+        for call in classify.call_args_list:
+            self.assertEqual(len(call.args[0]), self.rate)
+
+    def test_samples_split_across_messages_are_reassembled(self):
+        data = self.pcm16(1.0)
+        messages, classify = self.stream((data[:1001], data[1001:]))
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(len(classify.call_args.args[0]), self.rate)
+
+    def test_windows_arriving_while_busy_replace_each_other(self):
+        messages, classify = self.stream((self.pcm16(1.0), self.pcm16(0.5), self.pcm16(0.5)))
+        self.assertEqual(messages[0], {'type': 'dropped', 'count': 2})
+        self.assertEqual([(m['start'], m['end']) for m in messages[1:]], [(1.0, 2.0)])
+        classify.assert_called_once()
+
+
+class StreamApplicationTests(TestCase):
+    def connect(self, query_string):
+        async def scenario():
+            sent = []
+
+            async def receive():
+                return {'type': 'websocket.connect'}
+
+            async def send(message):
+                sent.append(message)
+            await stream_application({'type': 'websocket', 'query_string': query_string}, receive, send)
+            return sent
+        return asyncio.run(scenario())
+
+    def test_missing_token_is_unauthorized(self):
+        sent = self.connect(b'')
+        self.assertEqual(sent[-1]['type'], 'websocket.close')
+        self.assertEqual(sent[-1]['code'], 4401)
+
+    def test_bad_options_are_rejected(self):
+        for query_string in [b'sample_rate=100', b'window=1&hop=2', b'format=mp3']:
+            sent = self.connect(query_string + b'&token=x')
+            self.assertEqual(sent[-1]['code'], 4400, query_string)
+
+
+class AdmissionStoreTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.store = AdmissionStore(os.path.join(self.directory, 'admission.sqlite3'))
+
+    def test_take_spends_the_burst_then_waits(self):
+        for _ in range(3):
+            self.assertEqual(self.store.take('user:1', rate=1.0, burst=3), 0)
+        wait = self.store.take('user:1', rate=1.0, burst=3)
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 1.0)
+
+    def test_take_charges_cost_and_keys_separately(self):
+        self.assertEqual(self.store.take('user:1', rate=0.5, burst=4, cost=3), 0)
+        self.assertAlmostEqual(self.store.take('user:1', rate=0.5, burst=4, cost=3), 4.0, delta=0.1)
+        self.assertEqual(self.store.take('user:2', rate=0.5, burst=4, cost=3), 0)
+
+    def test_acquire_caps_concurrency_until_released(self):
+        leases = [self.store.acquire(2) for _ in range(2)]
+        self.assertNotIn(None, leases)
+        self.assertIsNone(self.store.acquire(2))
+        self.assertEqual(self.store.in_progress(), 2)
+        self.store.release(leases[0])
+        self.assertIsNotNone(self.store.acquire(2))
+
+    def test_acquire_reclaims_slots_of_dead_processes(self):
+        conn = self.store._connection()
+        # A pid past the kernel's maximum can't belong to a live process
+        conn.execute('INSERT INTO leases (pid, started) VALUES (?, 0)', (2 ** 22 + 1,))
+        self.assertIsNotNone(self.store.acquire(1))
+        self.assertEqual(self.store.in_progress(), 1)
+
+
+class AdmissionControlTests(SpeechTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = self.make_user('owner')
+        self.audio_file = self.make_audio_file(self.owner)
+
+    def queue_job(self, user):
+        return self.client_for(user).post(
+            '/api/predict/jobs/', {'audio_url': f'/media/{self.audio_file.audio_file.name}'}, format='json')
+
+    @override_settings(ADMISSION_USER_RATE=0.01, ADMISSION_USER_BURST=2)
+    def test_each_user_is_throttled_after_their_burst(self):
+        self.assertEqual([self.queue_job(self.owner).status_code for _ in range(3)], [202, 202, 429])
+        self.assertEqual(self.queue_job(self.make_user('other')).status_code, 404)
+        # Polling a job's status is never throttled
+        job = PredictionJob.objects.first()
+        self.assertEqual(self.client_for(self.owner).get(f'/api/predict/jobs/{job.id}/').status_code, 200)
+
+    @override_settings(ADMISSION_MAX_CONCURRENT=1)
+    def test_requests_past_the_concurrency_limit_get_503(self):
+        lease = get_admission_store().acquire(1)
+        response = self.queue_job(self.owner)
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+        get_admission_store().release(lease)
+        self.assertEqual(self.queue_job(self.owner).status_code, 202)
+        self.assertEqual(get_admission_store().in_progress(), 0)
+
+    @override_settings(ADMISSION_MAX_CONCURRENT=1)
+    def test_unavailable_store_admits_requests(self):
+        # A regular file where the store's directory should be
+        not_a_directory = os.path.join(self.directory, 'admission')
+        open(not_a_directory, 'w').close()
+        with override_settings(ADMISSION_DB_PATH=os.path.join(not_a_directory, 'admission.sqlite3')):
+            with self.assertLogs('speech.admission', 'WARNING'):
+                self.assertEqual(self.queue_job(self.owner).status_code, 202)
+
+
+class BatchSchedulerTests(TestCase):
+    def scheduler(self, batch_fn, max_batch_size=4):
+        """A scheduler whose first batch blocks until ``release`` is set, so later items queue up."""
+        self.batches = []
+        self.started, self.release = threading.Event(), threading.Event()
+
+        def run(items):
+            self.batches.append(list(items))
+            if len(self.batches) == 1:
+                self.started.set()
+                self.release.wait(5)
+            return batch_fn(items)
+        return BatchScheduler(run, max_batch_size=max_batch_size, max_wait_ms=50, name='test')
+
+    def submit_while_busy(self, scheduler, first, *items):
+        futures = [scheduler.submit(first)]
+        self.assertTrue(self.started.wait(5))
+        futures += [scheduler.submit(item) for item in items]
+        self.release.set()
+        return futures
+
+    def test_waiting_items_share_a_batch(self):
+        scheduler = self.scheduler(lambda items: [item * 2 for item in items])
+        futures = self.submit_while_busy(scheduler, *range(6))
+        self.assertEqual([future.result(5) for future in futures], [0, 2, 4, 6, 8, 10])
+        self.assertEqual(self.batches, [[0], [1, 2, 3, 4], [5]])
+
+    def test_a_failing_item_doesnt_fail_its_batch(self):
+        def double(items):
+            if any(item < 0 for item in items):
+                raise ValueError('negative')
+            return [item * 2 for item in items]
+        scheduler = self.scheduler(double)
+        futures = self.submit_while_busy(scheduler, 0, 1, -1, 2)
+        self.assertEqual(futures[0].result(5), 0)
+        self.assertEqual([futures[1].result(5), futures[3].result(5)], [2, 4])
+        with self.assertRaisesMessage(ValueError, 'negative'):
+            futures[2].result(5)
+        self.assertEqual(self.batches[1], [1, -1, 2])
+
+    def test_call_returns_the_result_or_raises(self):
+        scheduler = BatchScheduler(lambda items: [1 / item for item in items], max_wait_ms=0)
+        self.assertEqual(scheduler(4, timeout=5), 0.25)
+        with self.assertRaises(ZeroDivisionError):
+            scheduler(0, timeout=5)
+
+
+class EmbeddingVersionTests(SpeechTestCase):
+    def test_backend_and_quantization_are_part_of_the_version(self):
+        with override_settings(CLAP_VERSION='2023', CLAP_BACKEND='eager', CLAP_QUANTIZE=False):
+            self.assertEqual(embedding_version(), '2023')
+            self.assertEqual(embedding_version(quantized=True), '2023+int8')
+            self.assertEqual(embedding_version(backend='torchscript'), '2023+torchscript')
+        with override_settings(CLAP_VERSION='2023', CLAP_BACKEND='onnx', CLAP_QUANTIZE=True):
+            # ONNX export stays float, see registry.embedding_version
+            self.assertEqual(embedding_version(), '2023+onnx')
+
+    def test_cached_results_are_not_shared_across_versions(self):
+        user = self.make_user('owner')
+        audio_file = self.make_audio_file(user)
+        float_key = PredictionResult.cache_key(audio_file)
+        PredictionResult.store(audio_file, float_key, {'classification': 'Fluent'})
+        self.assertEqual(PredictionResult.lookup(float_key), {'classification': 'Fluent'})
+
+        with override_settings(CLAP_QUANTIZE=True):
+            config._snapshot = None
+            int8_key = PredictionResult.cache_key(audio_file)
+        self.assertEqual(int8_key[0], float_key[0])
+        self.assertNotEqual(int8_key[2], float_key[2])
+        self.assertIsNone(PredictionResult.lookup(int8_key))
+        self.assertEqual(PredictionResult.lookup_many([int8_key]), {})
+
+    def test_embeddings_are_stored_per_version(self):
+        audio_file = self.make_audio_file(self.make_user('owner'))
+        for model in (make_stub_model(), make_stub_model(quantize=True)):
+            model.get_audio_embeddings([audio_file])
+        self.assertEqual(sorted(AudioEmbedding.objects.values_list('model_version', flat=True)),
+                         ['stub', 'stub+int8'])
+
+
+class JanitorPlanTests(TestCase):
+    now = 100000
+
+    def candidate(self, name, age, size=1):
+        return janitor.Candidate(name, self.now - age, size, [name])
+
+    def plan(self, candidates, budget_bytes=100):
+        return [c.path for c in janitor.plan(candidates, self.now, max_age=1000, min_age=10,
+                                             budget_bytes=budget_bytes)]
+
+    def test_expired_candidates_go_regardless_of_budget(self):
+        candidates = [self.candidate('fresh', 5), self.candidate('old', 2000), self.candidate('older', 3000)]
+        self.assertEqual(self.plan(candidates), ['older', 'old'])
+
+    def test_oldest_are_evicted_until_the_rest_fit(self):
+        candidates = [self.candidate('a', 500, 60), self.candidate('b', 400, 60), self.candidate('c', 300, 60)]
+        self.assertEqual(self.plan(candidates, budget_bytes=100), ['a', 'b'])
+        self.assertEqual(self.plan(candidates, budget_bytes=200), [])
+
+    def test_recent_candidates_are_never_evicted(self):
+        candidates = [self.candidate('a', 500, 60), self.candidate('b', 5, 60), self.candidate('c', 1, 60)]
+        self.assertEqual(self.plan(candidates, budget_bytes=0), ['a'])
+
+
+class MediaJanitorTests(SpeechTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = self.make_user('owner')
+        self.audio_file = self.make_audio_file(self.owner, name='kept.wav')
+        self.media = os.path.join(self.directory, 'media')
+
+    def touch(self, *parts, age=0):
+        path = os.path.join(self.media, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x' * 10)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_candidates_are_only_what_nothing_will_read(self):
+        expected = {
+            self.touch('temp', 'request-abc', 'segment_0.wav'),
+            self.touch('audio_files', '.upload-123.wav'),
+            self.touch('predictions', 'deleted', 'segment_0.wav'),
+            self.touch('audio_files', 'deleted.wav.16000.npy'),
+            self.touch('audio_files', 'kept.wav.16000.npy.42.tmp'),
+        }
+        self.touch('predictions', 'kept', 'segment_0.wav')
+        self.touch('audio_files', 'kept.wav.16000.npy')
+        paths = {path for candidate in janitor.find_candidates() for path in candidate.files}
+        self.assertEqual(paths, expected)
+        self.assertIn(os.path.join(self.media, 'temp', 'request-abc'),
+                      [candidate.path for candidate in janitor.find_candidates()])
+
+    def test_clean_media_removes_stale_files_and_their_artifacts(self):
+        stale = self.touch('temp', 'request-old', 'segment_0.wav', age=7200)
+        recent = self.touch('temp', 'request-new', 'segment_0.wav', age=60)
+        AudioArtifact.record(self.audio_file, stale, AudioArtifact.KIND_SEGMENT)
+        summary = janitor.clean_media(max_age=3600, min_age=600, budget_bytes=10 ** 6, dry_run=True)
+        self.assertEqual(summary['removed'], 1)
+        self.assertTrue(os.path.exists(stale))
+
+        summary = janitor.clean_media(max_age=3600, min_age=600, budget_bytes=10 ** 6)
+        self.assertEqual((summary['removed'], summary['freed_bytes']), (1, 10))
+        self.assertFalse(os.path.exists(os.path.dirname(stale)))
+        self.assertTrue(os.path.exists(recent))
+        self.assertFalse(AudioArtifact.objects.exists())
+
+
+class AudioArtifactTests(SpeechTestCase):
+    def setUp(self):
+        super().setUp()
+        self.model = self.use_stub_model()
+        self.owner = self.make_user('owner')
+
+    def make_recording_with_artifacts(self, **kwargs):
+        """An AudioFile whose sidecar and segments have been written, and all their paths."""
+        audio_file = self.make_audio_file(self.owner, seconds=7, **kwargs)
+        self.model.load_waveform(audio_file)
+        segments = preprocess_and_split_audio(audio_file.audio_file.path, audio_file=audio_file)
+        paths = [audio_file.audio_file.path, waveform_cache_path(audio_file.audio_file.path, self.model.sample_rate)]
+        paths += [segment['path'] for segment in segments]
+        for path in paths:
+            self.assertTrue(os.path.exists(path), path)
+        return audio_file, paths
+
+    def test_artifacts_are_recorded_when_written(self):
+        audio_file, paths = self.make_recording_with_artifacts()
+        artifacts = AudioArtifact.objects.filter(audio_file=audio_file)
+        self.assertEqual(sorted(artifacts.values_list('kind', flat=True)),
+                         [AudioArtifact.KIND_SEGMENT] * 3 + [AudioArtifact.KIND_WAVEFORM])
+        self.assertEqual(sorted(artifact.full_path for artifact in artifacts), sorted(paths[1:]))
+
+    def test_deleting_recordings_removes_their_files(self):
+        recordings = [self.make_recording_with_artifacts(seed=seed) for seed in range(2)]
+        with self.captureOnCommitCallbacks(execute=True):
+            AudioFile.objects.filter(user=self.owner).delete()
+        for _, paths in recordings:
+            for path in paths:
+                self.assertFalse(os.path.exists(path), path)
+        self.assertFalse(AudioArtifact.objects.exists())
+
+    def test_rolled_back_delete_keeps_the_files(self):
+        audio_file, paths = self.make_recording_with_artifacts()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                audio_file.delete()
+                raise RuntimeError
+        self.assertEqual(callbacks, [])
+        for path in paths:
+            self.assertTrue(os.path.exists(path), path)
+        self.assertEqual(AudioArtifact.objects.count(), len(paths) - 1)
+
+
+class PredictionCacheTests(SpeechTestCase):
+    def setUp(self):
+        super().setUp()
+        self.model = self.use_stub_model()
+        self.owner = self.make_user('owner')
+        self.audio_file = self.make_audio_file(self.owner)
+
+    def predict(self, audio_file):
+        # Runs on the calling thread, like the batcher's dispatcher would
+        with mock.patch('speech.views.get_predictor', return_value=self.model.predict):
+            return self.call_view(PredictionView, self.owner, 'get', '/api/predict/',
+                                  {'audio_url': f'/media/{audio_file.audio_file.name}'})
+
+    def test_repeat_predictions_are_served_from_the_cache(self):
+        with mock.patch.object(self.model, 'predict_batch', wraps=self.model.predict_batch) as predict_batch:
+            first = self.predict(self.audio_file)
+            second = self.predict(self.audio_file)
+        self.assertEqual(predict_batch.call_count, 1)
+        self.assertEqual((first.status_code, first.data['cached']), (200, False))
+        self.assertEqual((second.status_code, second.data['cached']), (200, True))
+        self.assertEqual(second.data['msclap_result'], first.data['msclap_result'])
+
+    def test_identical_audio_shares_a_result(self):
+        self.predict(self.audio_file)
+        copy = self.make_audio_file(self.owner)
+        self.assertEqual(copy.ensure_content_hash(), self.audio_file.ensure_content_hash())
+        self.assertTrue(self.predict(copy).data['cached'])
+        self.assertEqual(PredictionResult.objects.count(), 1)
+
+    def test_configuration_changes_miss_the_cache(self):
+        self.predict(self.audio_file)
+        with self.captureOnCommitCallbacks(execute=True):
+            ClassificationPrompt.objects.create(name='Interjection', prompt='a person saying um')
+        self.assertFalse(self.predict(self.audio_file).data['cached'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            PredictionSettings.get_active().save()
+        self.assertFalse(PredictionResult.objects.exists())
+        self.assertFalse(self.predict(self.audio_file).data['cached'])
+
+
+class SegmentPredictionTests(SpeechTestCase):
+    def setUp(self):
+        super().setUp()
+        self.model = self.use_stub_model()
+        self.owner = self.make_user('owner')
+        self.audio_file = self.make_audio_file(self.owner, seconds=8)
+
+    def get_segments(self, user, audio_url=None):
+        return self.call_view(SegmentPredictionView, user, 'get', '/api/predict/segments/',
+                              {'audio_url': audio_url or f'/media/{self.audio_file.audio_file.name}'})
+
+    def test_segments_cover_the_recording(self):
+        response = self.get_segments(self.owner)
+        self.assertEqual(response.status_code, 200)
+        segments = response.data['segments']
+        self.assertGreater(len(segments), 1)
+        self.assertLessEqual(segments[-1]['segment_end'], 8.0)
+        for segment in segments:
+            self.assertLess(segment['segment_start'], segment['segment_end'])
+
+    def test_other_users_recordings_are_not_found(self):
+        self.assertEqual(self.get_segments(self.make_user('other')).status_code, 404)
+
+    def test_paths_outside_media_root_are_rejected(self):
+        self.assertEqual(self.get_segments(self.owner, '/media/../manage.py').status_code, 400)
+
+
+class BatchPredictionTests(SpeechTestCase):
+    def setUp(self):
+        super().setUp()
+        self.model = self.use_stub_model()
+        self.owner = self.make_user('owner')
+        self.audio_files = [self.make_audio_file(self.owner, seed=seed) for seed in range(3)]
+
+    def predict(self, audio_file_ids, user=None):
+        return self.call_view(BatchPredictionView, user or self.owner, 'post', '/api/predict/batch/',
+                              {'audio_file_ids': audio_file_ids}, format='json')
+
+    def test_results_come_back_in_request_order(self):
+        other = self.make_audio_file(self.make_user('other'))
+        ids = [self.audio_files[2].id, other.id, self.audio_files[0].id, 99999]
+        with mock.patch.object(self.model, 'predict_many', wraps=self.model.predict_many) as predict_many:
+            response = self.predict(ids)
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual([item['audio_file_id'] for item in results], ids)
+        self.assertEqual([item['status'] for item in results], ['success', 'error', 'success', 'error'])
+        self.assertEqual(results[1]['error'], 'Audio file not found')
+        # Both of the user's files go through the encoder together
+        predict_many.assert_called_once()
+        self.assertEqual(len(predict_many.call_args.args[0]), 2)
+
+    def test_cached_files_skip_the_model(self):
+        self.predict([self.audio_files[0].id])
+        with mock.patch.object(self.model, 'predict_many', wraps=self.model.predict_many) as predict_many:
+            results = self.predict([audio_file.id for audio_file in self.audio_files]).data['results']
+        self.assertEqual([item['cached'] for item in results], [True, False, False])
+        self.assertEqual({audio_file.id for audio_file in predict_many.call_args.args[0]},
+                         {audio_file.id for audio_file in self.audio_files[1:]})
+
+    def test_one_bad_file_doesnt_fail_the_rest(self):
+        with open(self.audio_files[1].audio_file.path, 'wb') as f:
+            f.write(b'not audio')
+        results = self.predict([audio_file.id for audio_file in self.audio_files]).data['results']
+        self.assertEqual([item['status'] for item in results], ['success', 'error', 'success'])
+
+    def test_invalid_requests_are_rejected(self):
+        for audio_file_ids in [[], ['x'], [0]]:
+            self.assertEqual(self.predict(audio_file_ids).status_code, 400, audio_file_ids)
+
+    @override_settings(ADMISSION_USER_RATE=0.01, ADMISSION_USER_BURST=3)
+    def test_each_uncached_file_costs_a_token(self):
+        self.assertEqual(self.predict([audio_file.id for audio_file in self.audio_files]).status_code, 200)
+        self.assertEqual(self.predict([self.audio_files[0].id]).status_code, 429)
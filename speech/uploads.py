@@ -0,0 +1,85 @@
+"""Upload handler writing audio uploads straight into MEDIA_ROOT/audio_files.
+
+Django's default handlers spool a large upload to FILE_UPLOAD_TEMP_DIR (and
+keep a small one in memory), after which it had to be copied again into
+audio_files/. AudioUploadHandler instead writes each chunk to a hidden temp
+file in audio_files/ as it arrives, hashing it on the way, so keeping the
+upload is a same-filesystem rename. A temp file that is never kept is
+removed when the request closes its files; one left by a worker that died
+is collected by the media janitor.
+"""
+import os
+import hashlib
+import tempfile
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+UPLOAD_PREFIX = '.upload-'
+UPLOAD_CHUNK_SIZE = 64 * 1024  # bytes
+
+
+def upload_directory():
+    return os.path.join(settings.MEDIA_ROOT, 'audio_files')
+
+
+class StagedUploadedFile(UploadedFile):
+    """An upload already on disk under audio_files/, with its sha256 digest."""
+
+    def __init__(self, name, content_type, charset, content_type_extra=None):
+        directory = upload_directory()
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=directory, prefix=UPLOAD_PREFIX,
+                                         suffix=os.path.splitext(name)[1])
+        super().__init__(os.fdopen(fd, 'w+b'), name, content_type, 0, charset, content_type_extra)
+        self.content_hash = None
+        self.kept = False
+
+    def temporary_file_path(self):
+        return self.path
+
+    def keep(self, path):
+        """Move the upload to ``path``, which must be in the same directory tree."""
+        self.file.close()
+        # mkstemp creates 0600 files; match what FileSystemStorage would write
+        os.chmod(self.path, settings.FILE_UPLOAD_PERMISSIONS or 0o644)
+        os.replace(self.path, path)
+        self.path, self.kept = path, True
+
+    def close(self):
+        try:
+            return self.file.close()
+        finally:
+            if not self.kept:
+                discard(self.path)
+
+
+def discard(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class AudioUploadHandler(FileUploadHandler):
+    chunk_size = UPLOAD_CHUNK_SIZE
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.file = StagedUploadedFile(self.file_name, self.content_type, self.charset, self.content_type_extra)
+        self.digest = hashlib.sha256()
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.digest.update(raw_data)
+        self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        self.file.seek(0)
+        self.file.size = file_size
+        self.file.content_hash = self.digest.hexdigest()
+        return self.file
+
+    def upload_interrupted(self):
+        if hasattr(self, 'file'):
+            self.file.close()
@@ -1,7 +1,14 @@
 from django.urls import path
-from .views import AudioFileUploadView, PredictionView
+from .offload import offloaded
+from .views import (AudioFileUploadView, PredictionView, BatchPredictionView, SegmentPredictionView,
+                    TimelinePredictionView, PredictionJobView, PredictionJobDetailView)
 
 urlpatterns = [
-    path('upload/', AudioFileUploadView.as_view(), name='audio_upload'),
-    path('predict/', PredictionView.as_view(), name='predict'),
+    path('upload/', offloaded(AudioFileUploadView.as_view()), name='audio_upload'),
+    path('predict/', offloaded(PredictionView.as_view()), name='predict'),
+    path('predict/batch/', offloaded(BatchPredictionView.as_view()), name='predict_batch'),
+    path('predict/segments/', offloaded(SegmentPredictionView.as_view()), name='predict_segments'),
+    path('predict/timeline/', offloaded(TimelinePredictionView.as_view()), name='predict_timeline'),
+    path('predict/jobs/', PredictionJobView.as_view(), name='prediction_jobs'),
+    path('predict/jobs/<int:job_id>/', PredictionJobDetailView.as_view(), name='prediction_job_detail'),
 ] 
\ No newline at end of file
@@ -1,16 +1,192 @@
 import os
-import librosa
+import math
+import shutil
+import subprocess
+import tempfile
+from contextlib import contextmanager
 import numpy as np
 from pydub import AudioSegment
-import torch
-import torch.nn.functional as F
 from django.conf import settings
+from urllib.parse import urlparse, unquote
+import logging
+
+logger = logging.getLogger(__name__)
 
 # Constants
 SAMPLE_RATE = 16000
 SILENCE_THRESHOLD = 30
 MIN_SEGMENT_LENGTH = 500  # milliseconds
 SEGMENT_LENGTH = 3000  # 3 seconds in milliseconds
+SILENCE_FLOOR_DB = -60  # frames below this (dBFS) are silent whatever the peak
+
+def resolve_media_path(audio_url):
+    """Map a playback URL to (path relative to MEDIA_ROOT, absolute path).
+
+    Raises ValueError if the URL points outside MEDIA_ROOT.
+    """
+    audio_url = unquote(audio_url)
+    parsed_url = urlparse(audio_url)
+    media_root = os.path.abspath(settings.MEDIA_ROOT)
+    audio_path = os.path.abspath(os.path.join(media_root, parsed_url.path.split('/media/')[-1]))
+    if audio_path == media_root or os.path.commonpath([audio_path, media_root]) != media_root:
+        raise ValueError('audio_url must point to a file under /media/')
+    return os.path.relpath(audio_path, media_root), audio_path
+
+def probe_duration(audio_path):
+    """Duration in seconds from the container headers, without decoding the audio."""
+    try:
+        import soundfile
+        return soundfile.info(audio_path).duration
+    except Exception:
+        # Formats libsndfile can't read (m4a, webm, ...) fall through to ffprobe
+        pass
+
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+         '-of', 'default=noprint_wrappers=1:nokey=1', audio_path],
+        capture_output=True, text=True, timeout=30,
+    )
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        raise ValueError(f"Could not determine audio duration: {result.stderr.strip() or 'unsupported format'}")
+
+def waveform_cache_path(audio_path, sample_rate):
+    return f"{audio_path}.{sample_rate}.npy"
+
+def load_waveform(audio_path, sample_rate=SAMPLE_RATE, cache=True, duration=None):
+    """Decode audio once to mono float32 at ``sample_rate``.
+
+    The resampled waveform is kept as a .npy sidecar next to the source file
+    and memory-mapped on later calls, so decoding and resampling happen once
+    per file rather than once per prediction. Recordings longer than
+    WAVEFORM_CACHE_MAX_SECONDS are not kept.
+
+    With ``duration`` only the first that many seconds are decoded (or read
+    from an existing sidecar), and nothing is written.
+    """
+    cache_path = waveform_cache_path(audio_path, sample_rate)
+    if cache and os.path.exists(cache_path):
+        waveform = np.load(cache_path, mmap_mode='r')
+        return waveform if duration is None else waveform[:int(duration * sample_rate)]
+
+    import librosa
+    waveform, _ = librosa.load(audio_path, sr=sample_rate, mono=True, dtype=np.float32, duration=duration)
+
+    if cache and duration is None and len(waveform) <= settings.WAVEFORM_CACHE_MAX_SECONDS * sample_rate:
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                np.save(f, waveform)
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            logger.warning(f"Could not cache waveform for {audio_path}: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    return waveform
+
+def segment_on_silence(waveform, sample_rate, min_duration, max_duration, silence_threshold_db,
+                       frame_length=1024):
+    """Split a waveform into voiced segments, dropping silence.
+
+    Frames quieter than ``silence_threshold_db`` below the loudest frame, or
+    than SILENCE_FLOOR_DB, are silent. Voiced runs separated by pauses shorter than ``min_duration`` are
+    merged (so short blocks stay inside their utterance), runs shorter than
+    ``min_duration`` are widened to it, and runs longer than ``max_duration``
+    are split evenly. Durations are in seconds.
+
+    Returns a list of (start_seconds, end_seconds, samples) where samples is a
+    view into ``waveform``.
+    """
+    n_frames = len(waveform) // frame_length
+    if n_frames == 0:
+        return []
+
+    # Mean power per non-overlapping frame; einsum avoids materialising squares
+    frames = np.asarray(waveform[:n_frames * frame_length]).reshape(n_frames, frame_length)
+    power = np.einsum('ij,ij->i', frames, frames) / frame_length
+    power_db = 10 * np.log10(np.maximum(power, 1e-10))
+    voiced = (power_db > power_db.max() - silence_threshold_db) & (power_db > SILENCE_FLOOR_DB)
+
+    # Frame indices where voiced runs start and (exclusively) end
+    edges = np.diff(np.concatenate(([0], voiced.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    if len(starts) == 0:
+        return []
+
+    min_frames = int(min_duration * sample_rate / frame_length)
+    new_run = np.concatenate(([True], starts[1:] - ends[:-1] >= min_frames))
+    starts = starts[new_run] * frame_length
+    ends = ends[np.concatenate((new_run[1:], [True]))] * frame_length
+    if ends[-1] == n_frames * frame_length:
+        ends[-1] = len(waveform)
+
+    min_samples = int(min_duration * sample_rate)
+    max_samples = max(1, int(max_duration * sample_rate))
+    segments = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        if end - start < min_samples:
+            start = max(0, start - (min_samples - (end - start)) // 2)
+            end = min(len(waveform), start + min_samples)
+            start = max(0, end - min_samples)
+        pieces = int(np.ceil((end - start) / max_samples))
+        bounds = np.linspace(start, end, pieces + 1).astype(int)
+        for piece_start, piece_end in zip(bounds[:-1], bounds[1:]):
+            segments.append((piece_start / sample_rate, piece_end / sample_rate, waveform[piece_start:piece_end]))
+    return segments
+
+def sliding_windows(waveform, sample_rate, window, hop):
+    """Overlapping windows of ``window`` seconds every ``hop`` seconds.
+
+    The last window is aligned to the end of the audio so the tail is always
+    covered. Returns (start_seconds, end_seconds, samples) with samples a view
+    into ``waveform``.
+    """
+    window_samples = max(1, int(window * sample_rate))
+    hop_samples = max(1, int(hop * sample_rate))
+    if len(waveform) == 0:
+        return []
+
+    starts = list(range(0, max(len(waveform) - window_samples, 0) + 1, hop_samples))
+    if starts[-1] + window_samples < len(waveform):
+        starts.append(len(waveform) - window_samples)
+    return [
+        (start / sample_rate, min(start + window_samples, len(waveform)) / sample_rate,
+         waveform[start:start + window_samples])
+        for start in starts
+    ]
+
+def count_windows(duration, window, hop):
+    """How many windows sliding_windows() yields for ``duration`` seconds of audio."""
+    if duration <= 0:
+        return 0
+    # One more for the window aligned to the end, if the grid misses the tail
+    return math.ceil(max(duration - window, 0) / hop) + 1
+
+def merge_window_scores(starts, ends, scores, hop, duration):
+    """Average overlapping window scores onto a grid of ``hop``-second slots.
+
+    ``scores`` has one row per window. Returns (slot_starts, slot_ends,
+    slot_scores); each slot gets the mean of every window overlapping it.
+    """
+    n_slots = max(1, int(np.ceil(duration / hop - 1e-9)))
+    first = np.clip(np.floor(np.asarray(starts) / hop + 1e-9).astype(int), 0, n_slots - 1)
+    last = np.clip(np.ceil(np.asarray(ends) / hop - 1e-9).astype(int), first + 1, n_slots)
+
+    # Difference arrays: add each window's scores at its first slot, subtract
+    # after its last, and a cumulative sum yields per-slot totals
+    totals = np.zeros((n_slots + 1, scores.shape[1]))
+    counts = np.zeros(n_slots + 1)
+    np.add.at(totals, first, scores)
+    np.add.at(totals, last, -scores)
+    np.add.at(counts, first, 1)
+    np.add.at(counts, last, -1)
+    slot_scores = np.cumsum(totals, axis=0)[:-1] / np.maximum(np.cumsum(counts)[:-1], 1)[:, None]
+
+    slot_starts = np.arange(n_slots) * hop
+    slot_ends = np.minimum(slot_starts + hop, duration)
+    return slot_starts, slot_ends, slot_scores
 
 def create_segment_folders(filename):
     base_name = os.path.splitext(os.path.basename(filename))[0]
@@ -21,16 +197,36 @@ def create_segment_folders(filename):
         os.makedirs(folder, exist_ok=True)
     return base_folder, fluent_folder, disfluent_folder
 
-def preprocess_and_split_audio(audio_path):
+@contextmanager
+def request_temp_dir(prefix='request-'):
+    """A directory of its own under TEMP_ROOT, removed with its contents on exit."""
+    os.makedirs(settings.TEMP_ROOT, exist_ok=True)
+    path = tempfile.mkdtemp(dir=settings.TEMP_ROOT, prefix=prefix)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+def preprocess_and_split_audio(audio_path, audio_file=None, temp_dir=None):
+    """Split audio into SEGMENT_LENGTH wav files in ``temp_dir``.
+
+    Pass a directory from request_temp_dir() to have the segments removed
+    once the caller is done. Without one, a new directory is created under
+    TEMP_ROOT; it belongs to the caller, and clean_media reclaims it if it
+    is left behind. Segments of an ``audio_file`` are recorded as its
+    artifacts.
+    """
+    created_dir = None
     try:
-        print(f"Loading audio from: {audio_path}")  # Debug print
+        logger.debug("Loading audio from: %s", audio_path)
         audio_segment = AudioSegment.from_file(audio_path)
         duration = len(audio_segment)
         segments = []
 
-        # Create temp directory if it doesn't exist
-        temp_dir = os.path.join(settings.MEDIA_ROOT, 'temp')
-        os.makedirs(temp_dir, exist_ok=True)
+        # Unique per call, so concurrent requests never overwrite each other's segments
+        if temp_dir is None:
+            os.makedirs(settings.TEMP_ROOT, exist_ok=True)
+            temp_dir = created_dir = tempfile.mkdtemp(dir=settings.TEMP_ROOT, prefix='segments-')
 
         # Split into 3-second segments
         for start in range(0, duration, SEGMENT_LENGTH):
@@ -40,24 +236,29 @@ def preprocess_and_split_audio(audio_path):
                 # Save segment temporarily
                 temp_path = os.path.join(temp_dir, f'segment_{start}_{end}.wav')
                 segment.export(temp_path, format='wav')
-                
+                if audio_file is not None:
+                    from .models import AudioArtifact
+                    AudioArtifact.record(audio_file, temp_path, AudioArtifact.KIND_SEGMENT)
+
                 segments.append({
                     'path': temp_path,
                     'start_time': start,
                     'end_time': end
                 })
-                print(f"Created segment: {temp_path}")  # Debug print
+                logger.debug("Created segment: %s", temp_path)
 
         return segments
     except Exception as e:
-        import traceback
-        print(f"Error preprocessing audio: {e}")
-        print(traceback.format_exc())
+        logger.exception(f"Error preprocessing audio: {e}")
+        if created_dir:
+            shutil.rmtree(created_dir, ignore_errors=True)
         return None
 
 def analyze_audio_with_msclap(audio_path, clap_model):
+    import torch.nn.functional as F
+
     try:
-        print(f"Analyzing segment: {audio_path}")  # Debug print
+        logger.debug("Analyzing segment: %s", audio_path)
         classes = {
             'speech with stuttering characterized by repeated sounds or syllables, like "b-b-ball"': 'repetition',
             'speech with stuttering featuring prolonged sounds, such as "ssssun" or "mmmmmilk"': 'prolongation',
@@ -90,7 +291,5 @@ def analyze_audio_with_msclap(audio_path, clap_model):
             ]
         }
     except Exception as e:
-        import traceback
-        print(f"MSCLAP analysis failed: {e}")
-        print(traceback.format_exc())
+        logger.exception(f"MSCLAP analysis failed: {e}")
         return None 
\ No newline at end of file
@@ -1,94 +1,95 @@
-from django.shortcuts import render
+from django.shortcuts import render, get_object_or_404
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework_simplejwt.authentication import JWTAuthentication
-from .models import AudioFile
-from .serializers import AudioFileSerializer
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
+from .models import AudioFile, PredictionJob, PredictionResult
+from .serializers import AudioFileSerializer, PredictionJobSerializer, BatchPredictionRequestSerializer
 import os
-from pydub import AudioSegment
 from django.conf import settings
+from django.urls import reverse
 import uuid
-from .utils import preprocess_and_split_audio
+from .utils import preprocess_and_split_audio, resolve_media_path, probe_duration, count_windows
+from .uploads import AudioUploadHandler
 from .serializers import AudioPredictionSerializer
-import shutil
-from urllib.parse import urlparse, unquote
-from speech.ms_clap import clap_model
+from speech.registry import get_predictor, get_inference_model
+from .metrics import TimedAPIViewMixin, timed
+from .admission import AdmissionControlMixin, TokenBucketThrottle, take_tokens
 from datetime import datetime
+import logging
+
+logger = logging.getLogger(__name__)
 
 # Create your views here.
 
-class AudioFileUploadView(APIView):
+class AudioFileUploadView(TimedAPIViewMixin, AdmissionControlMixin, APIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
+    throttle_classes = [TokenBucketThrottle]
 
     def post(self, request):
-        audio_file = request.FILES.get('audio_file')
+        # Must be set before request.FILES is first read: the upload is written
+        # and hashed chunk by chunk straight into audio_files/, so memory use
+        # doesn't grow with the file size and it is never copied again
+        request.upload_handlers = [AudioUploadHandler(request)]
+        with timed('upload_write'):
+            audio_file = request.FILES.get('audio_file')
         if not audio_file:
             return Response({'error': 'No audio file provided'}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            # Create a temporary file to check duration
-            temp_path = default_storage.save(f'temp_{audio_file.name}', ContentFile(audio_file.read()))
-            temp_full_path = os.path.join(settings.MEDIA_ROOT, temp_path)
-
-            try:
-                # Check file duration
-                audio = AudioSegment.from_file(temp_full_path)
-                duration = len(audio) / 1000  # Convert to seconds
+            # Generate unique filename
+            file_extension = os.path.splitext(audio_file.name)[1]
+            unique_filename = f"{uuid.uuid4()}{file_extension}"
+            final_path = os.path.join('audio_files', unique_filename)
+            final_full_path = os.path.join(settings.MEDIA_ROOT, final_path)
 
-                if duration > 10:
-                    os.remove(temp_full_path)
-                    return Response({'error': 'Audio duration exceeds 10 seconds'}, status=status.HTTP_400_BAD_REQUEST)
+            # Check file duration from the headers, without decoding
+            with timed('upload_decode'):
+                duration = probe_duration(audio_file.temporary_file_path())
 
-                # Generate unique filename
-                file_extension = os.path.splitext(audio_file.name)[1]
-                unique_filename = f"{uuid.uuid4()}{file_extension}"
-                final_path = os.path.join('audio_files', unique_filename)
+            if duration > settings.AUDIO_MAX_DURATION:
+                return Response({'error': f'Audio duration exceeds {settings.AUDIO_MAX_DURATION:g} seconds'},
+                                status=status.HTTP_400_BAD_REQUEST)
 
-                # Save the file to its final location
-                with open(temp_full_path, 'rb') as temp_file:
-                    final_path = default_storage.save(final_path, ContentFile(temp_file.read()))
+            # Rename the staged file into place
+            audio_file.keep(final_full_path)
 
+            try:
                 # Create the AudioFile instance
                 audio_file_instance = AudioFile.objects.create(
                     user=request.user,
                     audio_file=final_path,
-                    duration=duration
+                    duration=duration,
+                    content_hash=audio_file.content_hash
                 )
+            except Exception:
+                os.remove(final_full_path)
+                raise
 
-                # Generate the playback URL
-                playback_url = request.build_absolute_uri(settings.MEDIA_URL + str(audio_file_instance.audio_file))
-
-                # Serialize the response
-                serializer = AudioFileSerializer(audio_file_instance)
-                response_data = serializer.data
-                response_data['playback_url'] = playback_url
+            # Generate the playback URL
+            playback_url = request.build_absolute_uri(settings.MEDIA_URL + str(audio_file_instance.audio_file))
 
-                return Response(response_data, status=status.HTTP_201_CREATED)
+            # Serialize the response
+            serializer = AudioFileSerializer(audio_file_instance)
+            response_data = serializer.data
+            response_data['playback_url'] = playback_url
 
-            finally:
-                # Clean up temporary file
-                if os.path.exists(temp_full_path):
-                    os.remove(temp_full_path)
+            return Response(response_data, status=status.HTTP_201_CREATED)
 
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        finally:
+            # Removes the staged file unless it was kept
+            audio_file.close()
 
-class PredictionView(APIView):
+class PredictionView(TimedAPIViewMixin, AdmissionControlMixin, APIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
+    throttle_classes = [TokenBucketThrottle]
 
     def get(self, request):
-        if clap_model is None:
-            return Response({
-                'error': 'MS-CLAP model not initialized properly',
-                'details': 'Please check server logs for initialization errors'
-            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
         try:
             # Get and clean the audio_url parameter
             audio_url = request.query_params.get('audio_url')
@@ -97,10 +98,11 @@ class PredictionView(APIView):
                               status=status.HTTP_400_BAD_REQUEST)
 
             # Clean the URL and get the file path
-            audio_url = unquote(audio_url)
-            parsed_url = urlparse(audio_url)
-            relative_path = parsed_url.path.split('/media/')[-1]
-            audio_path = os.path.join(settings.MEDIA_ROOT, relative_path)
+            try:
+                relative_path, audio_path = resolve_media_path(audio_url)
+            except ValueError as e:
+                return Response({'error': 'Invalid audio_url', 'details': str(e)},
+                                status=status.HTTP_400_BAD_REQUEST)
 
             if not os.path.exists(audio_path):
                 return Response({
@@ -112,9 +114,28 @@ class PredictionView(APIView):
                     }
                 }, status=status.HTTP_404_NOT_FOUND)
 
+            # Repeat requests for the same audio and configuration are served
+            # from stored results without touching the model
+            with timed('cache_lookup'):
+                audio_file_instance = AudioFile.objects.filter(audio_file=relative_path).first()
+                cache_key = PredictionResult.cache_key(audio_file_instance) if audio_file_instance else None
+                prediction = PredictionResult.lookup(cache_key) if cache_key else None
+            cached = prediction is not None
+
+            if not cached:
+                predictor = get_predictor()
+                if predictor is None:
+                    return Response({
+                        'error': 'MS-CLAP model not initialized properly',
+                        'details': 'Please check server logs for initialization errors'
+                    }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
             # Get direct prediction from MS-CLAP model
             try:
-                prediction = clap_model.predict(audio_path)
+                if not cached:
+                    prediction = predictor(audio_file_instance or audio_path)
+                    if prediction and cache_key:
+                        PredictionResult.store(audio_file_instance, cache_key, prediction)
                 if not prediction:
                     return Response({
                         'error': 'Failed to get prediction',
@@ -126,6 +147,7 @@ class PredictionView(APIView):
                     'filename': os.path.basename(audio_path),
                     'timestamp': datetime.now().strftime('%Y%m%d_%H%M%S'),
                     'msclap_result': prediction,
+                    'cached': cached,
                     'status': 'success'
                 }
 
@@ -139,8 +161,247 @@ class PredictionView(APIView):
 
         except Exception as e:
             import traceback
-            print(traceback.format_exc())
+            logger.exception(f"Unexpected prediction error: {e}")
             return Response({
                 'error': str(e),
                 'traceback': traceback.format_exc()
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+class BatchPredictionView(TimedAPIViewMixin, AdmissionControlMixin, APIView):
+    """Classify several of the user's AudioFiles, given by id, in one request.
+
+    Results come back in request order, each with its own status, so one
+    missing or undecodable file doesn't fail the rest.
+    """
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    throttle_classes = [TokenBucketThrottle]
+
+    def post(self, request):
+        serializer = BatchPredictionRequestSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({'error': 'Invalid request', 'details': serializer.errors},
+                            status=status.HTTP_400_BAD_REQUEST)
+        audio_file_ids = serializer.validated_data['audio_file_ids']
+
+        audio_files = AudioFile.objects.filter(user=request.user, id__in=audio_file_ids).in_bulk()
+        predictions, errors = {}, {}
+
+        with timed('cache_lookup'):
+            cache_keys = {}
+            for audio_file in audio_files.values():
+                try:
+                    cache_key = PredictionResult.cache_key(audio_file)
+                except OSError as e:
+                    errors[audio_file.id] = f'Audio file unreadable: {e}'
+                    continue
+                if cache_key:
+                    cache_keys[audio_file.id] = cache_key
+            stored = PredictionResult.lookup_many(list(cache_keys.values()))
+            for audio_file_id, cache_key in cache_keys.items():
+                if cache_key[0] in stored:
+                    predictions[audio_file_id] = stored[cache_key[0]]
+        cached = set(predictions)
+
+        # Everything else goes through the audio encoder together
+        pending = [audio_file for audio_file in audio_files.values()
+                   if audio_file.id not in predictions and audio_file.id not in errors]
+        # One token per file to encode; the throttle already took the first
+        take_tokens(request, len(pending) - 1)
+        if pending:
+            clap_model = get_inference_model()
+            if clap_model is None:
+                return Response({
+                    'error': 'MS-CLAP model not initialized properly',
+                    'details': 'Please check server logs for initialization errors'
+                }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            try:
+                results = clap_model.predict_many(pending)
+            except Exception as e:
+                return Response({'error': 'Prediction failed', 'details': str(e)},
+                                status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            for audio_file, result in zip(pending, results):
+                if isinstance(result, Exception):
+                    errors[audio_file.id] = f'Prediction failed: {str(result) or type(result).__name__}'
+                    continue
+                predictions[audio_file.id] = result
+                if audio_file.id in cache_keys:
+                    PredictionResult.store(audio_file, cache_keys[audio_file.id], result)
+
+        items = []
+        for audio_file_id in audio_file_ids:
+            if audio_file_id in predictions:
+                items.append({'audio_file_id': audio_file_id, 'status': 'success',
+                              'msclap_result': predictions[audio_file_id],
+                              'cached': audio_file_id in cached})
+            else:
+                items.append({'audio_file_id': audio_file_id, 'status': 'error',
+                              'error': errors.get(audio_file_id, 'Audio file not found')})
+
+        return Response({
+            'timestamp': datetime.now().strftime('%Y%m%d_%H%M%S'),
+            'results': items,
+        }, status=status.HTTP_200_OK)
+
+class SegmentPredictionView(TimedAPIViewMixin, AdmissionControlMixin, APIView):
+    """Per-segment classification of a whole recording, for clips longer than the model window."""
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    throttle_classes = [TokenBucketThrottle]
+
+    def get(self, request):
+        audio_url = request.query_params.get('audio_url')
+        if not audio_url:
+            return Response({'error': 'audio_url parameter is required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            relative_path, audio_path = resolve_media_path(audio_url)
+        except ValueError as e:
+            return Response({'error': 'Invalid audio_url', 'details': str(e)},
+                            status=status.HTTP_400_BAD_REQUEST)
+        # Only the requesting user's own recordings
+        audio_file = AudioFile.objects.filter(audio_file=relative_path, user=request.user).first()
+        if audio_file is None or not os.path.exists(audio_path):
+            return Response({
+                'error': 'Audio file not found',
+                'details': {'relative_path': relative_path}
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        clap_model = get_inference_model()
+        if clap_model is None:
+            return Response({
+                'error': 'MS-CLAP model not initialized properly',
+                'details': 'Please check server logs for initialization errors'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        try:
+            segments = clap_model.predict_segments(audio_file)
+        except Exception as e:
+            return Response({
+                'error': 'Prediction failed',
+                'details': str(e)
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        serializer = AudioPredictionSerializer({'audio_url': audio_url, 'segments': segments})
+        response_data = serializer.data
+        response_data.update({
+            'filename': os.path.basename(audio_path),
+            'timestamp': datetime.now().strftime('%Y%m%d_%H%M%S'),
+            'status': 'success'
+        })
+        return Response(response_data, status=status.HTTP_200_OK)
+
+class TimelinePredictionView(TimedAPIViewMixin, AdmissionControlMixin, APIView):
+    """Overlapping-window disfluency timeline of a recording.
+
+    Optional ``window`` and ``hop`` query parameters (seconds) override
+    TIMELINE_WINDOW_SECONDS and TIMELINE_HOP_SECONDS. Requests needing more
+    than TIMELINE_MAX_WINDOWS encoder passes are refused.
+    """
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    throttle_classes = [TokenBucketThrottle]
+
+    def get(self, request):
+        audio_url = request.query_params.get('audio_url')
+        if not audio_url:
+            return Response({'error': 'audio_url parameter is required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            window = float(request.query_params.get('window', settings.TIMELINE_WINDOW_SECONDS))
+            hop = float(request.query_params.get('hop', settings.TIMELINE_HOP_SECONDS))
+        except ValueError:
+            return Response({'error': 'window and hop must be numbers of seconds'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if not 0.1 <= hop <= window <= 30:
+            return Response({'error': 'Expected 0.1 <= hop <= window <= 30 seconds'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            relative_path, audio_path = resolve_media_path(audio_url)
+        except ValueError as e:
+            return Response({'error': 'Invalid audio_url', 'details': str(e)},
+                            status=status.HTTP_400_BAD_REQUEST)
+        # Only the requesting user's own recordings
+        audio_file = AudioFile.objects.filter(audio_file=relative_path, user=request.user).first()
+        if audio_file is None or not os.path.exists(audio_path):
+            return Response({
+                'error': 'Audio file not found',
+                'details': {'relative_path': relative_path}
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        windows = count_windows(audio_file.duration, window, hop)
+        if windows > settings.TIMELINE_MAX_WINDOWS:
+            return Response({
+                'error': f'Timeline would need {windows} windows, at most {settings.TIMELINE_MAX_WINDOWS} are allowed',
+                'details': 'Use a larger hop, or /api/predict/segments/ for long recordings'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        clap_model = get_inference_model()
+        if clap_model is None:
+            return Response({
+                'error': 'MS-CLAP model not initialized properly',
+                'details': 'Please check server logs for initialization errors'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        try:
+            timeline = clap_model.predict_timeline(audio_file, window=window, hop=hop)
+        except Exception as e:
+            return Response({
+                'error': 'Prediction failed',
+                'details': str(e)
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        response_data = {
+            'filename': os.path.basename(audio_path),
+            'timestamp': datetime.now().strftime('%Y%m%d_%H%M%S'),
+            **timeline,
+            'status': 'success'
+        }
+        return Response(response_data, status=status.HTTP_200_OK)
+
+class PredictionJobView(TimedAPIViewMixin, AdmissionControlMixin, APIView):
+    """Queue a prediction and return immediately; run_prediction_worker does the inference."""
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    throttle_classes = [TokenBucketThrottle]
+
+    def post(self, request):
+        audio_url = request.data.get('audio_url')
+        if not audio_url:
+            return Response({'error': 'audio_url is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            relative_path, audio_path = resolve_media_path(audio_url)
+        except ValueError as e:
+            return Response({'error': 'Invalid audio_url', 'details': str(e)},
+                            status=status.HTTP_400_BAD_REQUEST)
+        # Only the requesting user's own recordings
+        audio_file = AudioFile.objects.filter(audio_file=relative_path, user=request.user).first()
+        if audio_file is None or not os.path.exists(audio_path):
+            return Response({
+                'error': 'Audio file not found',
+                'details': {'relative_path': relative_path}
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        job = PredictionJob.objects.create(
+            user=request.user,
+            audio_file=audio_file,
+            audio_path=relative_path,
+        )
+
+        response_data = PredictionJobSerializer(job).data
+        response_data['status_url'] = request.build_absolute_uri(
+            reverse('prediction_job_detail', args=[job.id])
+        )
+        return Response(response_data, status=status.HTTP_202_ACCEPTED)
+
+class PredictionJobDetailView(APIView):
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, job_id):
+        job = get_object_or_404(PredictionJob, id=job_id, user=request.user)
+        return Response(PredictionJobSerializer(job).data, status=status.HTTP_200_OK)
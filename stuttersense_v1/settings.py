@@ -136,6 +136,14 @@ MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 TEMP_ROOT = os.path.join(MEDIA_ROOT, 'temp')
 
+# `manage.py clean_media` removes temp files and orphaned prediction folders
+# older than MEDIA_JANITOR_MAX_AGE_HOURS, then the oldest of the rest while
+# they take more than MEDIA_JANITOR_BUDGET_MB. Anything newer than
+# MEDIA_JANITOR_MIN_AGE_MINUTES may still be in use and is always kept.
+MEDIA_JANITOR_MAX_AGE_HOURS = float(os.environ.get('MEDIA_JANITOR_MAX_AGE_HOURS', 24))
+MEDIA_JANITOR_MIN_AGE_MINUTES = float(os.environ.get('MEDIA_JANITOR_MIN_AGE_MINUTES', 10))
+MEDIA_JANITOR_BUDGET_MB = float(os.environ.get('MEDIA_JANITOR_BUDGET_MB', 2048))
+
 # Create directories if they don't exist
 os.makedirs(os.path.join(BASE_DIR, 'static'), exist_ok=True)
 os.makedirs(MEDIA_ROOT, exist_ok=True)
@@ -146,6 +154,85 @@ STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'static'),
 ]
 
+# MS-CLAP inference
+CLAP_VERSION = '2023'
+
+# Concurrent predictions are grouped into one audio-encoder pass of up to
+# CLAP_BATCH_MAX_SIZE files, waiting at most CLAP_BATCH_MAX_WAIT_MS for peers.
+CLAP_BATCH_MAX_SIZE = int(os.environ.get('CLAP_BATCH_MAX_SIZE', 8))
+CLAP_BATCH_MAX_WAIT_MS = float(os.environ.get('CLAP_BATCH_MAX_WAIT_MS', 10))
+# Upper bound on clips per audio-encoder forward pass, e.g. when a long
+# recording is split into segments; bounds peak memory of a single pass.
+CLAP_ENCODER_MAX_BATCH = int(os.environ.get('CLAP_ENCODER_MAX_BATCH', 32))
+
+# Runtime for the CLAP audio encoder: 'eager' (plain PyTorch), 'torchscript' or
+# 'onnx' (needs onnxruntime). The latter two are exported once to
+# CLAP_ARTIFACT_DIR and reused by every process after that.
+CLAP_BACKEND = os.environ.get('CLAP_BACKEND', 'eager')
+CLAP_ARTIFACT_DIR = os.environ.get('CLAP_ARTIFACT_DIR', os.path.join(BASE_DIR, 'artifacts'))
+# Threads per process for one encoder pass (intra-op) and for running
+# independent ops concurrently (inter-op). 0 for intra-op gives each gunicorn
+# worker an even share of the cores; see speech/cpu.py.
+CLAP_INTRA_OP_THREADS = int(os.environ.get('CLAP_INTRA_OP_THREADS', 0))
+CLAP_INTER_OP_THREADS = int(os.environ.get('CLAP_INTER_OP_THREADS', 1))
+# Pin each gunicorn worker to its own disjoint set of cores (Linux only)
+CLAP_CPU_AFFINITY = os.environ.get('CLAP_CPU_AFFINITY', '0') == '1'
+# Run the encoders' linear layers in dynamic int8: smaller workers and faster
+# predictions for a small accuracy cost (check with validate_quantization).
+CLAP_QUANTIZE = os.environ.get('CLAP_QUANTIZE', '0') == '1'
+
+# Unix socket of a `manage.py run_inference_server` daemon. When set, web
+# workers send predictions there instead of each loading their own model.
+CLAP_INFERENCE_SOCKET = os.environ.get('CLAP_INFERENCE_SOCKET', '')
+CLAP_INFERENCE_TIMEOUT = float(os.environ.get('CLAP_INFERENCE_TIMEOUT', 60))
+# Segment and timeline requests encode a whole recording, so they get longer
+CLAP_INFERENCE_LONG_TIMEOUT = float(os.environ.get('CLAP_INFERENCE_LONG_TIMEOUT', 600))
+# Port the daemon serves its own Prometheus metrics on; 0 turns that off
+CLAP_INFERENCE_METRICS_PORT = int(os.environ.get('CLAP_INFERENCE_METRICS_PORT', 0))
+
+# Most AudioFile ids accepted by one POST /api/predict/batch/
+PREDICTION_BATCH_MAX_ITEMS = int(os.environ.get('PREDICTION_BATCH_MAX_ITEMS', 64))
+
+# Default window and hop, in seconds, for /api/predict/timeline/
+TIMELINE_WINDOW_SECONDS = 3.0
+TIMELINE_HOP_SECONDS = 1.0
+# Most encoder passes one timeline request may take, e.g. 20 minutes at a 1 s hop
+TIMELINE_MAX_WINDOWS = int(os.environ.get('TIMELINE_MAX_WINDOWS', 1200))
+
+# Upload and prediction requests run on a bounded thread pool per process
+# (speech/offload.py): at most OFFLOAD_MAX_WORKERS at once and
+# OFFLOAD_MAX_PENDING waiting. Beyond that clients get 503 with Retry-After.
+OFFLOAD_MAX_WORKERS = int(os.environ.get('OFFLOAD_MAX_WORKERS', 8))
+OFFLOAD_MAX_PENDING = int(os.environ.get('OFFLOAD_MAX_PENDING', 16))
+OFFLOAD_RETRY_AFTER = int(os.environ.get('OFFLOAD_RETRY_AFTER', 5))
+
+# Admission control for upload and inference endpoints (speech/admission.py), shared by
+# every worker on the host through a SQLite file. Each user may send
+# ADMISSION_USER_BURST requests at once, refilled at ADMISSION_USER_RATE per
+# second (0 disables). At most ADMISSION_MAX_CONCURRENT requests run at once
+# across all workers (0 disables); the default keeps one batch of inference
+# running and the next one filling.
+ADMISSION_DB_PATH = os.environ.get('ADMISSION_DB_PATH', '/tmp/stuttersense-admission.sqlite3')
+ADMISSION_USER_RATE = float(os.environ.get('ADMISSION_USER_RATE', 1.0))
+ADMISSION_USER_BURST = float(os.environ.get('ADMISSION_USER_BURST', 20))
+ADMISSION_MAX_CONCURRENT = int(os.environ.get('ADMISSION_MAX_CONCURRENT', 2 * CLAP_BATCH_MAX_SIZE))
+
+# Live streaming over the ASGI app (/ws/stream/): threads running model calls
+# and concurrent connections, per process.
+STREAM_MAX_WORKERS = int(os.environ.get('STREAM_MAX_WORKERS', 4))
+STREAM_MAX_CONNECTIONS = int(os.environ.get('STREAM_MAX_CONNECTIONS', 32))
+
+# Touched whenever PredictionSettings or ClassificationPrompts change, so every
+# process on the host knows to reload its cached copy (see speech/config.py)
+SPEECH_CONFIG_VERSION_FILE = os.path.join(BASE_DIR, '.speech_config_version')
+
+# Longest accepted upload, in seconds. Longer recordings such as full therapy
+# sessions are analysed per segment via /api/predict/segments/.
+AUDIO_MAX_DURATION = float(os.environ.get('AUDIO_MAX_DURATION', 3600))
+# Longest recording whose decoded waveform is kept as a .npy sidecar. At
+# 44.1 kHz float32 a sidecar takes about 635 MB per hour of audio.
+WAVEFORM_CACHE_MAX_SECONDS = float(os.environ.get('WAVEFORM_CACHE_MAX_SECONDS', 600))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -232,7 +319,7 @@ LOGGING = {
     'loggers': {
         'speech': {
             'handlers': ['console', 'file'],
-            'level': 'INFO',
+            'level': os.environ.get('SPEECH_LOG_LEVEL', 'INFO'),
             'propagate': False,
         },
     },
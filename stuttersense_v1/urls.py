@@ -3,9 +3,11 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 from .admin import custom_admin_site
+from speech.metrics import metrics_view
 
 urlpatterns = [
     path('admin/', custom_admin_site.urls),
+    path('metrics', metrics_view, name='metrics'),
     path('api/', include('auth_app.urls')),
     path('api/', include('speech.urls')),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)